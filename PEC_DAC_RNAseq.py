@@ -1,19 +1,29 @@
 import os
+import sys
 import subprocess
 import re
 import json
 from datetime import datetime
 from chunkypipes.components import Software, Parameter, Redirect, BasePipeline
+# Shared FASTQ helpers, installed next to the pipelines
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fastq_tools import (LaneStream, TRIMMED_OUTPUT_MODES, TRIMMED_STREAM_MODE, TRIMMERS, TrimmedStream,
+                         cached_count_gzipped_lines, cutadapt_report_args, cutadapt_trimming_args,
+                         cutadapt_writes_json, extrapolate_preview_qc, preview_fraction, read_cutadapt_report,
+                         subsample_reads, trim_reads, trimmed_compression_level, trimmed_fastq_filepath)
 
 FIRST_READS_PAIR = 0
 
 
+# QC counts scaled up to the full run from a preview, and duplication rates extrapolated to it
+PREVIEW_COUNT_QC = ['trimmed_reads_counts', 'num_reads_mapped']
+PREVIEW_DUPLICATION_QC = []
+
+
 class Pipeline(BasePipeline):
     @staticmethod
     def count_gzipped_lines(filepath):
-        zcat = subprocess.Popen(['zcat', filepath], stdout=subprocess.PIPE)
-        num_lines = subprocess.check_output(['wc', '-l'], stdin=zcat.stdout)
-        return num_lines.strip()
+        return cached_count_gzipped_lines(filepath)
 
     def description(self):
         return """This is an exact replication of the ENCODE long-rna pipeline."""
@@ -36,6 +46,22 @@ class Pipeline(BasePipeline):
                             help='Adapter sequence for the reverse strand.')
         parser.add_argument('--is-stranded', action='store_true',
                             help='Provide this argument if library is stranded.')
+        parser.add_argument('--trim-cores', default=1, type=int,
+                            help='Number of cores cutadapt trims on, if its version supports it.')
+        parser.add_argument('--trimmed-output', default='gzip',
+                            choices=TRIMMED_OUTPUT_MODES + [TRIMMED_STREAM_MODE],
+                            help=('How trimmed reads are written: gzipped at the default level (gzip, '
+                                  'the default), gzipped at level 1 (fast), uncompressed (plain), or '
+                                  'streamed to STAR as they are trimmed, through named pipes, without '
+                                  'being written (fifo).'))
+        parser.add_argument('--trimmer', default='cutadapt', choices=TRIMMERS,
+                            help=('Trim reads with cutadapt, or with the built-in trimmer, which trims '
+                                  'them the same way in batches on --trim-cores processes, whatever '
+                                  'the cutadapt version. It needs numpy.'))
+        parser.add_argument('--preview', default=None, type=preview_fraction, metavar='FRACTION',
+                            help=('Run on this fraction of read pairs, picked by a hash of their '
+                                  'names so mates stay together across files and lanes, and '
+                                  'extrapolate QC to all of them.'))
         return parser
 
     def configure(self):
@@ -80,13 +106,17 @@ class Pipeline(BasePipeline):
         forward_adapter = pipeline_args['forward_adapter']
         reverse_adapter = pipeline_args['reverse_adapter']
         run_is_stranded = pipeline_args['is_stranded']
+        trim_cores = pipeline_args['trim_cores']
+        trimmed_output = pipeline_args['trimmed_output']
+        trimmer = pipeline_args['trimmer']
+        preview = pipeline_args['preview']
 
         # Determine if run is paired-end from input
         run_is_paired_end = len(reads[FIRST_READS_PAIR].split(':')) > 1
 
         # Create output, tmp, and logs directories
-        subprocess.call(['mkdir', '-p', output_dir,
-                         logs_dir, os.path.join(output_dir, 'tmp')])
+        tmp_dir = os.path.join(output_dir, 'tmp')
+        subprocess.call(['mkdir', '-p', output_dir, logs_dir, tmp_dir])
 
         # Timing functions for getting running time
         start_time = datetime.now()
@@ -101,11 +131,11 @@ class Pipeline(BasePipeline):
         }
 
         # Keep list of items to delete
-        staging_delete = [os.path.join(output_dir, 'tmp')]
+        staging_delete = [tmp_dir]
 
         # Establish software instances
-        cat = Software('cat', '/bin/cat')
         cutadapt = Software('cutadapt', pipeline_config['cutadapt']['path'])
+        cutadapt_json = step <= 2 and cutadapt_writes_json(pipeline_config['cutadapt']['path'])
         star = Software('STAR', pipeline_config['STAR']['path'])
         rsem_calculate_expression = Software('RSEM', pipeline_config['RSEM']['path-calculate-expression'])
         rsem_plot_model = Software('RSEM', pipeline_config['RSEM']['path-plot-model'])
@@ -113,114 +143,128 @@ class Pipeline(BasePipeline):
         bed_sort = Software('bedSort', pipeline_config['bedSort']['path'])
         samtools_flagstat = Software('samtools flagstat', pipeline_config['samtools']['path'] + ' flagstat')
 
-        # Step 1: If more than one reads pairs are provided, combine them
-        if step <= 1 and len(reads) >= 2:
-            if run_is_paired_end:
-                # Aggregate read1s and read2s
-                read1s, read2s = [], []
-                for reads_set in reads:
-                    read1, read2 = reads_set.split(':')
-                    read1s.append(read1)
-                    read2s.append(read2)
-
-                # Combine reads groups
-                combined_reads = []
-                for name, reads_group in [('read1', read1s), ('read2', read2s)]:
-                    combined_read_filename = os.path.join(output_dir, '{}.combined.{}.fastq.gz'.format(lib_prefix, name))
-                    combined_reads.append(combined_read_filename)
-                    staging_delete.append(combined_read_filename)
-                    cat.run(
-                        Parameter(*[read for read in reads_group]),
-                        Redirect(stream=Redirect.STDOUT, dest=combined_read_filename)
-                    )
-
-                # Update reads list
-                reads = [':'.join(combined_reads)]
-            else:
-                # Combine reads
-                combined_read_filename = os.path.join(output_dir, '{}.combined.fastq.gz'.format(lib_prefix))
-                staging_delete.append(combined_read_filename)
-                cat.run(
-                    Parameter(*[read for read in reads]),
-                    Redirect(stream=Redirect.STDOUT, dest=combined_read_filename)
-                )
+        # Preview: Run on the read pairs a hash of their names picks, subsampled into tmp
+        preview_read_counts = None
+        if preview is not None and step <= 2:
+            reads, preview_read_counts = subsample_reads(reads, tmp_dir, preview, trim_cores)
+
+        # Step 1: If more than one reads pairs are provided, stream them to cutadapt as one,
+        # rather than combining them on disk
+        if run_is_paired_end:
+            # Aggregate read1s and read2s
+            read1s, read2s = [], []
+            for reads_set in reads:
+                read1, read2 = reads_set.split(':')
+                read1s.append(read1)
+                read2s.append(read2)
 
-                # Update reads list
-                reads = [combined_read_filename]
+            lane_streams = [
+                LaneStream(reads_group, os.path.join(tmp_dir, '{}.combined.{}.fastq'.format(lib_prefix, name)))
+                for name, reads_group in [('read1', read1s), ('read2', read2s)]
+            ]
+        else:
+            lane_streams = [LaneStream(reads, os.path.join(tmp_dir, '{}.combined.fastq'.format(lib_prefix)))]
 
         # Step 2: Trim adapters with cutadapt
+        trimmed_stream = None
         if step <= 2:
-            reads_set = reads[FIRST_READS_PAIR]
-            if run_is_paired_end:
-                # Get paired-end reads, construct new filenames
-                read1, read2 = reads_set.split(':')
-
-                # QC: Get raw fastq read counts
-                qc_data['total_raw_reads_counts'].extend([
-                    str(int(self.count_gzipped_lines(read1))/4),
-                    str(int(self.count_gzipped_lines(read2))/4)
-                ])
-
-                trimmed_read1_filename = os.path.join(output_dir, lib_prefix + '_read1.trimmed.fastq.gz')
-                trimmed_read2_filename = os.path.join(output_dir, lib_prefix + '_read2.trimmed.fastq.gz')
-
-                staging_delete.append(trimmed_read1_filename)
-                staging_delete.append(trimmed_read2_filename)
+            cutadapt_common = [
+                Parameter('--quality-base={}'.format(pipeline_config['cutadapt']['quality-base'])),
+                Parameter('--minimum-length=5'),
+                Parameter('-q', '30'),
+                Parameter(*cutadapt_trimming_args(pipeline_config['cutadapt']['path'], trim_cores,
+                                                  trimmed_output))
+            ]
 
-                # Run cutadapt
-                cutadapt.run(
-                    Parameter('--quality-base={}'.format(pipeline_config['cutadapt']['quality-base'])),
-                    Parameter('--minimum-length=5'),
-                    Parameter('--output={}'.format(trimmed_read1_filename)),
-                    Parameter('--paired-output={}'.format(trimmed_read2_filename)),
-                    Parameter('-a', forward_adapter),
-                    Parameter('-A', reverse_adapter),
-                    Parameter('-q', '30'),
-                    Parameter(read1),
-                    Parameter(read2),
-                    Redirect(stream=Redirect.STDOUT, dest=os.path.join(logs_dir, 'cutadapt.summary.log'))
-                )
-
-                # QC: Get trimmed fastq read counts
-                qc_data['trimmed_reads_counts'].extend([
-                    str(int(self.count_gzipped_lines(trimmed_read1_filename))/4),
-                    str(int(self.count_gzipped_lines(trimmed_read2_filename))/4)
-                ])
+            if run_is_paired_end:
+                # Construct new filenames
+                trimmed_read1_filename = trimmed_fastq_filepath(
+                    os.path.join(output_dir, lib_prefix + '_read1.trimmed'), trimmed_output)
+                trimmed_read2_filename = trimmed_fastq_filepath(
+                    os.path.join(output_dir, lib_prefix + '_read2.trimmed'), trimmed_output)
+                trimmed_filenames = [trimmed_read1_filename, trimmed_read2_filename]
+                raw_read_groups = [read1s, read2s]
+                cutadapt_summary = os.path.join(logs_dir, 'cutadapt.summary.log')
 
                 # Update reads list
                 reads = ':'.join([trimmed_read1_filename, trimmed_read2_filename])
-
             else:
-                # QC: Get raw fastq read count
-                qc_data['total_raw_reads_counts'].append(
-                    str(int(self.count_gzipped_lines(
-                        os.path.join(output_dir, '{}.combined.fastq.gz'.format(lib_prefix))
-                    ))/4)
-                )
-
                 # Construct new filename
-                trimmed_read_filename = os.path.join(output_dir, lib_prefix + '.trimmed.fastq.gz')
+                trimmed_read_filename = trimmed_fastq_filepath(
+                    os.path.join(output_dir, lib_prefix + '.trimmed'), trimmed_output)
+                trimmed_filenames = [trimmed_read_filename]
+                raw_read_groups = [reads]
+                cutadapt_summary = os.path.join(logs_dir, 'cutadapt.summary')
 
-                staging_delete.append(trimmed_read_filename)
+                # Update reads list
+                reads = [trimmed_read_filename]
 
-                # Run cutadapt
-                cutadapt.run(
-                    Parameter('--quality-base={}'.format(pipeline_config['cutadapt']['quality-base'])),
-                    Parameter('--minimum-length=5'),
-                    Parameter('--output={}'.format(trimmed_read_filename)),
-                    Parameter('-a', forward_adapter),
-                    Parameter('-q', '30'),
-                    Parameter(reads[FIRST_READS_PAIR]),
-                    Redirect(stream=Redirect.STDOUT, dest=os.path.join(logs_dir, 'cutadapt.summary'))
-                )
+            staging_delete.extend(trimmed_filenames)
 
-                # QC: Get trimmed fastq read count
-                qc_data['trimmed_reads_counts'].append(
-                    str(int(self.count_gzipped_lines(trimmed_read_filename))/4)
-                )
+            # Streamed, cutadapt writes into pipes relayed to the trimmed filenames STAR reads
+            if trimmed_output == TRIMMED_STREAM_MODE:
+                trimmed_stream = TrimmedStream(trimmed_filenames, tmp_dir)
+                cutadapt_outputs = trimmed_stream.source_filepaths
+            else:
+                cutadapt_outputs = trimmed_filenames
 
-                # Update reads list
-                reads = [trimmed_read_filename]
+            cutadapt_common.extend([
+                Parameter(*cutadapt_report_args(cutadapt_summary, cutadapt_json)),
+                Redirect(stream=Redirect.STDOUT, dest=cutadapt_summary)
+            ])
+            if run_is_paired_end:
+                cutadapt_specific = [
+                    Parameter('--output={}'.format(cutadapt_outputs[0])),
+                    Parameter('--paired-output={}'.format(cutadapt_outputs[1])),
+                    Parameter('-a', forward_adapter),
+                    Parameter('-A', reverse_adapter)
+                ]
+            else:
+                cutadapt_specific = [
+                    Parameter('--output={}'.format(cutadapt_outputs[0])),
+                    Parameter('-a', forward_adapter)
+                ]
+
+            def run_cutadapt():
+                # The built-in trimmer reads the lanes themselves, one after another
+                if trimmer == 'builtin':
+                    trim_reads(raw_read_groups, cutadapt_outputs,
+                               [forward_adapter, reverse_adapter][:len(raw_read_groups)], 30,
+                               int(pipeline_config['cutadapt']['quality-base']), 5, trim_cores,
+                               trimmed_compression_level(trimmed_output), cutadapt_summary)
+                elif run_is_paired_end:
+                    with lane_streams[0] as read1, lane_streams[1] as read2:
+                        cutadapt.run(*(cutadapt_common + cutadapt_specific + [Parameter(read1, read2)]))
+                else:
+                    with lane_streams[0] as read:
+                        cutadapt.run(*(cutadapt_common + cutadapt_specific + [Parameter(read)]))
+
+            def record_trimming_qc():
+                # QC: Get raw and trimmed fastq read counts from the cutadapt report, or by
+                # reading the fastqs if it can't be read. Streamed trimmed reads can't be reread.
+                cutadapt_report = read_cutadapt_report(cutadapt_summary)
+                if cutadapt_report is not None:
+                    qc_data['total_raw_reads_counts'].extend(
+                        [str(cutadapt_report['reads_processed'])] * len(trimmed_filenames))
+                    qc_data['trimmed_reads_counts'].extend(
+                        [str(cutadapt_report['reads_written'])] * len(trimmed_filenames))
+                else:
+                    qc_data['total_raw_reads_counts'].extend([
+                        str(sum([int(self.count_gzipped_lines(read)) for read in raw_reads])/4)
+                        for raw_reads in raw_read_groups
+                    ])
+                    qc_data['trimmed_reads_counts'].extend([
+                        'NA' if trimmed_stream is not None else
+                        str(int(self.count_gzipped_lines(trimmed_filename))/4)
+                        for trimmed_filename in trimmed_filenames
+                    ])
+
+            # Run cutadapt, alongside STAR in step 3 if streamed
+            if trimmed_stream is not None:
+                trimmed_stream.start(run_cutadapt)
+            else:
+                run_cutadapt()
+                record_trimming_qc()
 
         # Step 3: Alignment
         if step <= 3:
@@ -238,7 +282,8 @@ class Pipeline(BasePipeline):
                 Parameter('--outFileNamePrefix', star_outfile_prefix),
                 Parameter('--genomeDir', pipeline_config['STAR']['genome-dir']),
                 Parameter('--readFilesIn', read1, read2),
-                Parameter('--readFilesCommand', 'zcat'),
+                # Trimmed reads written uncompressed, or streamed, are read as is
+                Parameter('--readFilesCommand', 'zcat') if read1.endswith('.gz') else Parameter(),
                 Parameter('--outFilterType', 'BySJout'),
                 Parameter('--outFilterMultimapNmax', '20'),
                 Parameter('--alignSJoverhangMin', '8'),
@@ -276,7 +321,13 @@ class Pipeline(BasePipeline):
             star_meta = []
 
             # Run STAR alignment step
-            star.run(*(star_common + star_run + star_bam + star_strand + star_meta))
+            try:
+                star.run(*(star_common + star_run + star_bam + star_strand + star_meta))
+            finally:
+                # Trimming ends once STAR has read the reads streamed to it, or has failed
+                if trimmed_stream is not None:
+                    trimmed_stream.wait()
+                    record_trimming_qc()
 
             # Store STAR output files
             star_output_bam = star_outfile_prefix + 'Aligned.sortedByCoord.out.bam'
@@ -470,6 +521,14 @@ class Pipeline(BasePipeline):
         qc_data['running_time_seconds'] = str(elapsed_time.seconds)
         qc_data['running_time_readable'] = str(elapsed_time)
 
+        # QC: Extrapolate QC from a preview to the full run
+        if preview_read_counts is not None:
+            # Lanes of a mate are trimmed as one
+            qc_data = extrapolate_preview_qc(qc_data, preview, PREVIEW_COUNT_QC, PREVIEW_DUPLICATION_QC, {
+                'total_raw_reads_counts': [str(sum([lane[mate][0] for lane in preview_read_counts]))
+                                           for mate in range(len(preview_read_counts[0]))]
+            }, preview_read_counts)
+
         # QC: Output QC data to file
         with open(os.path.join(logs_dir, 'qc_metrics.txt'), 'w') as qc_data_file:
             qc_data_file.write(json.dumps(qc_data, indent=4) + '\n')
@@ -1,7 +1,11 @@
 import os
+import sys
 import pysam
 import subprocess
 from chunkypipes.components import Software, Parameter, BasePipeline
+# Shared FASTQ helpers, installed next to the pipelines
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fastq_tools import run_fastq_qc
 
 
 class Pipeline(BasePipeline):
@@ -16,6 +20,9 @@ class Pipeline(BasePipeline):
         parser.add_argument('--is-paired-end', action='store_true', help='Whether sample was sequenced as paired-end')
         parser.add_argument('--is-stranded', action='store_true', help=('Whether library was created with a stranded '
                                                                         'protocol'))
+        parser.add_argument('--external-fastqc', action='store_true',
+                            help=('Run FastQC on each fastq instead of the built-in FASTQ QC, which writes '
+                                  'fastqc_data.txt and summary.txt in its formats.'))
 
     def configure(self):
         return {
@@ -52,7 +59,8 @@ class Pipeline(BasePipeline):
     @staticmethod
     def run_fastqc(**kwargs):
         """
-        Run FastQC over all fastqs associated with this sample.
+        Run FastQC over all fastqs associated with this sample, or the built-in FASTQ QC
+        unless --external-fastqc is given or numpy is missing.
         Expects the following keyword arguments:
             - fastq::Software
             - pipeline_args
@@ -63,6 +71,8 @@ class Pipeline(BasePipeline):
         fastqc_output_dir = os.path.join(pipeline_args['output_dir'], 'fastqc')
         subprocess.call('mkdir -p {}'.format(fastqc_output_dir), shell=True)
         for fastq in pipeline_args['fastqs']:
+            if not pipeline_args.get('external_fastqc') and run_fastq_qc(fastq, fastqc_output_dir) is not None:
+                continue
             fastqc.run(
                 Parameter('--outdir={}'.format(fastqc_output_dir)),
                 Parameter('--threads', '8'),
@@ -0,0 +1,112 @@
+import os
+import time
+import heapq
+import subprocess
+from chunkypipes.components import BasePipeline
+
+FIRST_CHAR = 0
+
+DEFAULT_MIN_SAMPLES = 2
+
+
+def read_peaks(peaks_filepath, sample_index):
+    """
+    Lazily reads a sorted peaks BED, such as an atacseq {lib}.peaks.bed, as
+    (chrom, start, end, sample_index) tuples. Raises ValueError if the BED is not
+    sorted the way bedtools sort sorts it, since the merge sweep relies on it.
+    """
+    previous_peak = None
+    with open(peaks_filepath) as peaks_bed:
+        for line in peaks_bed:
+            if line[FIRST_CHAR] == '#' or line.startswith('track') or not line.strip():
+                continue
+            record = line.split('\t', 3)
+            peak = (record[0], int(record[1]), int(record[2]), sample_index)
+            if previous_peak is not None and peak[:2] < previous_peak[:2]:
+                raise ValueError('Peaks file {} is not sorted, at {}:{}'.format(
+                    peaks_filepath, peak[0], peak[1]
+                ))
+            previous_peak = peak
+            yield peak
+
+
+class Pipeline(BasePipeline):
+    def description(self):
+        return """Builds a consensus peak set from the peaks of many atacseq libraries."""
+
+    def add_pipeline_args(self, parser):
+        parser.add_argument('--peaks', action='append', default=[],
+                            help='Sorted peaks BED of one library. Can be given many times.')
+        parser.add_argument('--peaks-list',
+                            help='File listing the sorted peaks BED of one library per line.')
+        parser.add_argument('--output', required=True)
+        parser.add_argument('--lib', default=str(time.time()))
+        parser.add_argument('--min-samples', default=DEFAULT_MIN_SAMPLES, type=int,
+                            help=('Minimum number of libraries with a peak in a merged region for it '
+                                  'to be kept. Defaults to {}.'.format(DEFAULT_MIN_SAMPLES)))
+        return parser
+
+    @staticmethod
+    def merge_peaks(peaks_filepaths, output_bed_filepath, min_samples):
+        """
+        Streams the peaks of every file through a k-way merge, ordered by chromosome
+        and start, and merges overlapping and book-ended peaks across files as bedtools
+        merge would. A merged region is written, with its number of supporting files as
+        the name column, if peaks from at least min_samples files fall in it. Only the
+        region being built and one pending peak per file are held in memory. Returns
+        the number of peaks read, regions merged, and regions written.
+        """
+        counts = {'peaks': 0, 'regions': 0, 'consensus': 0}
+        region = {'chrom': None, 'start': 0, 'end': 0, 'samples': set()}
+
+        def write_region(output_bed):
+            counts['regions'] += 1
+            if len(region['samples']) >= min_samples:
+                counts['consensus'] += 1
+                output_bed.write('{}\t{}\t{}\t{}\n'.format(region['chrom'], region['start'],
+                                                           region['end'], len(region['samples'])))
+
+        peaks = heapq.merge(*[read_peaks(peaks_filepath, sample_index)
+                              for sample_index, peaks_filepath in enumerate(peaks_filepaths)])
+        with open(output_bed_filepath, 'w') as output_bed:
+            for chrom, start, end, sample_index in peaks:
+                counts['peaks'] += 1
+                if chrom == region['chrom'] and start <= region['end']:
+                    region['end'] = max(region['end'], end)
+                    region['samples'].add(sample_index)
+                    continue
+
+                if region['chrom'] is not None:
+                    write_region(output_bed)
+                region['chrom'], region['start'], region['end'] = chrom, start, end
+                region['samples'] = set([sample_index])
+
+            if region['chrom'] is not None:
+                write_region(output_bed)
+
+        return counts
+
+    def run_pipeline(self, pipeline_args, pipeline_config):
+        # Instantiate variables from argparse
+        peaks_filepaths = list(pipeline_args['peaks'])
+        if pipeline_args['peaks_list']:
+            with open(pipeline_args['peaks_list']) as peaks_list:
+                peaks_filepaths.extend([line.strip() for line in peaks_list if line.strip()])
+        output_dir = os.path.abspath(pipeline_args['output'])
+        logs_dir = os.path.join(output_dir, 'logs')
+        lib_prefix = pipeline_args['lib']
+        min_samples = pipeline_args['min_samples']
+
+        # Create output and logs directories
+        subprocess.call(['mkdir', '-p', output_dir, logs_dir])
+
+        consensus_bed = os.path.join(output_dir, '{}.consensus.bed'.format(lib_prefix))
+        counts = self.merge_peaks(peaks_filepaths, consensus_bed, min_samples)
+
+        # QC: Output merge counts to file
+        with open(os.path.join(logs_dir, 'consensus.log'), 'w') as consensus_log:
+            consensus_log.write('num_samples\t{}\n'.format(len(peaks_filepaths)))
+            consensus_log.write('min_samples\t{}\n'.format(min_samples))
+            consensus_log.write('num_peaks\t{}\n'.format(counts['peaks']))
+            consensus_log.write('num_merged_regions\t{}\n'.format(counts['regions']))
+            consensus_log.write('num_consensus_peaks\t{}\n'.format(counts['consensus']))
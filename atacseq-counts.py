@@ -0,0 +1,254 @@
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import subprocess
+import multiprocessing
+import pysam
+import numpy as np
+from chunkypipes.components import BasePipeline
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fastq_tools import fastq_stats_key
+
+# Suffixes stripped from sample filenames to name their matrix columns
+SAMPLE_SUFFIXES = r'(\.processed)?\.(bam|bed)$'
+
+# Approximate number of bytes of BED read into memory per chunk
+BED_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def load_peaks(peaks_bed_filepath):
+    """
+    Reads a sorted, merged peaks BED, such as from atacseq-consensus, into lists of
+    chromosomes and arrays of starts and ends, one entry per row of the matrix.
+    """
+    chroms, starts, ends = [], [], []
+    with open(peaks_bed_filepath) as peaks_bed:
+        for line in peaks_bed:
+            if line.startswith('#') or line.startswith('track') or not line.strip():
+                continue
+            record = line.split('\t', 3)
+            chroms.append(record[0])
+            starts.append(int(record[1]))
+            ends.append(int(record[2]))
+    return chroms, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+def count_sample(sample):
+    """
+    Worker for Pipeline.count_samples. Counts the reads of one sample overlapping each
+    peak. A BAM is counted a peak at a time through its index, skipping unmapped,
+    secondary, QC-failed, and duplicate reads. A BED is swept once in chunks, each
+    record adding one to every peak it overlaps. Returns the sample name, the rows with
+    reads and their counts, and the sample's total number of reads.
+    """
+    sample_name, sample_filepath, peaks_bed_filepath = sample
+    chroms, starts, ends = load_peaks(peaks_bed_filepath)
+    counts = np.zeros(len(chroms), dtype=np.int64)
+
+    if sample_filepath.endswith('.bam'):
+        sample_bam = pysam.AlignmentFile(sample_filepath, 'rb')
+        references = set(sample_bam.references)
+        for row, (chrom, start, end) in enumerate(zip(chroms, starts.tolist(), ends.tolist())):
+            if chrom in references:
+                counts[row] = sample_bam.count(chrom, start, end, read_callback='all')
+        total_reads = sum([stats.mapped for stats in sample_bam.get_index_statistics()])
+        sample_bam.close()
+    else:
+        # Rows of each chromosome, whose peaks are sorted and don't overlap
+        chrom_rows = {}
+        for row, chrom in enumerate(chroms):
+            chrom_rows.setdefault(chrom, []).append(row)
+        chrom_rows = dict((chrom, np.array(rows)) for chrom, rows in chrom_rows.items())
+
+        total_reads = 0
+        with open(sample_filepath) as sample_bed:
+            while True:
+                lines = sample_bed.readlines(BED_CHUNK_SIZE)
+                if not lines:
+                    break
+                total_reads += len(lines)
+
+                records = [line.split('\t', 3) for line in lines]
+                read_chroms = np.array([record[0] for record in records])
+                read_starts = np.array([record[1] for record in records], dtype=np.int64)
+                read_ends = np.array([record[2] for record in records], dtype=np.int64)
+
+                block_chroms, chrom_indices = np.unique(read_chroms, return_inverse=True)
+                for i, chrom in enumerate(block_chroms.tolist()):
+                    if chrom not in chrom_rows:
+                        continue
+                    rows = chrom_rows[chrom]
+                    in_chrom = chrom_indices == i
+                    first = np.searchsorted(ends[rows], read_starts[in_chrom], side='right')
+                    last = np.searchsorted(starts[rows], read_ends[in_chrom], side='left')
+                    overlapping = first < last
+
+                    # Each read adds one to the peaks from its first to its last overlap
+                    overlaps = (np.bincount(first[overlapping], minlength=len(rows) + 1) -
+                                np.bincount(last[overlapping], minlength=len(rows) + 1))
+                    counts[rows] += np.cumsum(overlaps)[:len(rows)]
+
+    nonzero_rows = np.flatnonzero(counts)
+    return sample_name, nonzero_rows, counts[nonzero_rows], total_reads
+
+
+class Pipeline(BasePipeline):
+    def description(self):
+        return """Builds a matrix of read counts per peak for many atacseq libraries, adding
+        new libraries to an existing matrix without recounting the others."""
+
+    def add_pipeline_args(self, parser):
+        parser.add_argument('--peaks', required=True,
+                            help='Sorted, merged peaks BED, such as from atacseq-consensus.')
+        parser.add_argument('--sample', action='append', default=[],
+                            help=('Indexed processed BAM, or processed BED, of one library. Can be given '
+                                  'many times.'))
+        parser.add_argument('--samples-list',
+                            help='File listing the processed BAM or BED of one library per line.')
+        parser.add_argument('--output', required=True,
+                            help='Matrix directory. Libraries already counted there are not recounted.')
+        parser.add_argument('--processes', default=1, type=int,
+                            help='Number of libraries counted in parallel.')
+        return parser
+
+    @staticmethod
+    def file_checksum(filepath):
+        md5 = hashlib.md5()
+        with open(filepath, 'rb') as checksum_file:
+            for block in iter(lambda: checksum_file.read(1024 * 1024), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    @staticmethod
+    def read_samples(samples_filepath):
+        """Reads the sample name, path, and read counts of every column already in a matrix."""
+        samples = []
+        if os.path.isfile(samples_filepath):
+            with open(samples_filepath) as samples_file:
+                next(samples_file)
+                for line in samples_file:
+                    sample_name, sample_filepath, total_reads, reads_in_peaks = line.rstrip('\n').split('\t')
+                    samples.append([sample_name, sample_filepath, int(total_reads), int(reads_in_peaks)])
+        return samples
+
+    @staticmethod
+    def count_samples(samples, peaks_bed_filepath, columns_dir, peaks_checksum, processes):
+        """
+        Counts every sample without a column from the same peaks and the same sample file,
+        by its size, mtime, and fingerprint, in columns_dir, across a process pool, and
+        saves each as its own compressed column. Returns the total reads and reads in
+        peaks of the samples counted.
+        """
+        to_count, sample_keys = [], {}
+        for sample_name, sample_filepath in samples:
+            sample_keys[sample_name] = fastq_stats_key(sample_filepath)
+            column_filepath = os.path.join(columns_dir, sample_name + '.npz')
+            if os.path.isfile(column_filepath):
+                with np.load(column_filepath) as column:
+                    if (str(column['peaks_checksum']) == peaks_checksum and 'sample_key' in column and
+                            json.loads(str(column['sample_key'])) == sample_keys[sample_name]):
+                        continue
+            to_count.append((sample_name, sample_filepath, peaks_bed_filepath))
+
+        if processes > 1 and len(to_count) > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                counted = pool.map(count_sample, to_count, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            counted = [count_sample(sample) for sample in to_count]
+
+        read_counts = {}
+        for sample_name, rows, counts, total_reads in counted:
+            np.savez_compressed(os.path.join(columns_dir, sample_name + '.npz'),
+                                rows=rows.astype(np.int32), counts=counts,
+                                peaks_checksum=np.array(peaks_checksum),
+                                sample_key=np.array(json.dumps(sample_keys[sample_name])))
+            read_counts[sample_name] = (total_reads, int(counts.sum()))
+        return read_counts
+
+    @staticmethod
+    def write_matrix(sample_names, num_peaks, columns_dir, matrix_filepath):
+        """
+        Assembles the columns of every sample into a peaks by samples matrix, saved in
+        the compressed sparse column layout that scipy.sparse.load_npz reads.
+        """
+        indptr = [0]
+        indices, data = [], []
+        for sample_name in sample_names:
+            with np.load(os.path.join(columns_dir, sample_name + '.npz')) as column:
+                indices.append(column['rows'])
+                data.append(column['counts'])
+            indptr.append(indptr[-1] + len(indices[-1]))
+
+        np.savez_compressed(matrix_filepath,
+                            format=np.array('csc'),
+                            shape=np.array([num_peaks, len(sample_names)]),
+                            indices=np.concatenate(indices + [np.zeros(0, dtype=np.int32)]).astype(np.int32),
+                            indptr=np.array(indptr, dtype=np.int32),
+                            data=np.concatenate(data + [np.zeros(0, dtype=np.int64)]))
+
+    def run_pipeline(self, pipeline_args, pipeline_config):
+        # Instantiate variables from argparse
+        peaks_bed = os.path.abspath(pipeline_args['peaks'])
+        sample_filepaths = list(pipeline_args['sample'])
+        if pipeline_args['samples_list']:
+            with open(pipeline_args['samples_list']) as samples_list:
+                sample_filepaths.extend([line.strip() for line in samples_list if line.strip()])
+        output_dir = os.path.abspath(pipeline_args['output'])
+        columns_dir = os.path.join(output_dir, 'columns')
+        processes = pipeline_args['processes']
+
+        # Create output and columns directories
+        subprocess.call(['mkdir', '-p', output_dir, columns_dir])
+
+        # Libraries already in the matrix keep their column order, new ones are appended.
+        # Columns are named by file, so two files with the same name can't both be counted
+        samples_tsv = os.path.join(output_dir, 'samples.tsv')
+        samples = self.read_samples(samples_tsv)
+        sample_names = [sample[0] for sample in samples]
+        for sample_filepath in sample_filepaths:
+            sample_filepath = os.path.abspath(sample_filepath)
+            sample_name = re.sub(SAMPLE_SUFFIXES, '', os.path.basename(sample_filepath))
+            if sample_name in sample_names:
+                named_filepath = samples[sample_names.index(sample_name)][1]
+                if named_filepath != sample_filepath:
+                    raise ValueError('Samples {} and {} are both named {}'.format(
+                        named_filepath, sample_filepath, sample_name
+                    ))
+            else:
+                samples.append([sample_name, sample_filepath, 0, 0])
+                sample_names.append(sample_name)
+
+        # The peaks define the rows, so changing them means recounting every library
+        matrix_peaks_bed = os.path.join(output_dir, 'peaks.bed')
+        peaks_checksum = self.file_checksum(peaks_bed)
+        if not os.path.isfile(matrix_peaks_bed) or self.file_checksum(matrix_peaks_bed) != peaks_checksum:
+            shutil.copyfile(peaks_bed, matrix_peaks_bed)
+
+        read_counts = self.count_samples(
+            samples=[(sample_name, sample_filepath) for sample_name, sample_filepath, _, _ in samples],
+            peaks_bed_filepath=matrix_peaks_bed,
+            columns_dir=columns_dir,
+            peaks_checksum=peaks_checksum,
+            processes=processes
+        )
+
+        with open(samples_tsv, 'w') as samples_file:
+            samples_file.write('sample\tpath\ttotal_reads\treads_in_peaks\n')
+            for sample in samples:
+                if sample[0] in read_counts:
+                    sample[2], sample[3] = read_counts[sample[0]]
+                samples_file.write('\t'.join([str(value) for value in sample]) + '\n')
+
+        self.write_matrix(
+            sample_names=sample_names,
+            num_peaks=len(load_peaks(matrix_peaks_bed)[0]),
+            columns_dir=columns_dir,
+            matrix_filepath=os.path.join(output_dir, 'matrix.npz')
+        )
@@ -1,9 +1,27 @@
 import os
+import sys
 import subprocess
 import re
+import math
 import time
+import bisect
+import copy
+import gzip
+import collections
+import heapq
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import select
 import pysam
-from chunkypipes.components import Software, Parameter, Redirect, Pipe, BasePipeline
+import numpy as np
+from chunkypipes.components import Software, Parameter, Redirect, BasePipeline
+# Shared FASTQ helpers, installed next to the pipelines
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fastq_tools import (TRIMMED_OUTPUT_MODES, TRIMMERS, cached_count_gzipped_lines, cutadapt_report_args,
+                         cutadapt_trimming_args, cutadapt_writes_json, extrapolate_preview_qc, fastq_pair_stats,
+                         preview_fraction, read_cutadapt_report, run_fastq_qc, store_fastq_stats, subsample_reads,
+                         trim_reads, trimmed_compression_level, trimmed_fastq_filepath)
 
 """
 TODO It would be cool to input paired-end fastq as /path/to/sample.R*.fastq.gz, but it would
@@ -18,6 +36,786 @@ PLUS_STRAND_SHIFT = 4
 
 STERIC_HINDRANCE_CUTOFF = 38
 
+# Memory samtools sort holds per thread for each read pair's alignments before spilling
+# them to temporary files, the samtools default
+SORT_MEMORY_PER_THREAD = '768M'
+# If bwa fails without opening the FIFO samtools sorts, it's checked for at this interval,
+# in seconds
+FIFO_POLL_INTERVAL = 0.1
+
+# Equivalent to samtools view -F 256 -q 10, and samtools view -F 12
+UNIQUE_EXCLUDE_FLAGS = 256
+UNIQUE_MIN_MAPQ = 10
+UNMAPPED_EXCLUDE_FLAGS = 12
+
+KEPT_CHROMOSOMES = ['chr{}'.format(chromosome) for chromosome in range(1, 23)] + ['chrX', 'chrY']
+MITOCHONDRIAL_CHROMOSOME = 'chrM'
+
+# A duplicate can only start this far behind the first read seen with its signature, so
+# a set of duplicates is judged once the sweep is this far past it
+DUPLICATE_WINDOW_SIZE = 1000
+# Pairs whose second mate starts at most this far down the reference wait for it, to be
+# scored on both mates
+DUPLICATE_MATE_WAIT = 10000
+# Base qualities counted towards a duplicate's score, as in Picard's SUM_OF_BASE_QUALITIES
+DUPLICATE_MIN_BASE_QUALITY = 15
+UNKNOWN_LIBRARY = 'Unknown Library'
+
+# Codes of pysam cigartuples operations, in the order of their SAM characters
+CIGAR_OPERATIONS = 'MIDNSHP=X'
+CIGAR_REFERENCE_OPERATIONS = (0, 2, 3, 7, 8)
+CIGAR_CLIP_OPERATIONS = (4, 5)
+
+# Columns of Picard DuplicationMetrics counted by DuplicateFilter. Pair columns are
+# counted per read, and halved when written out
+DUPLICATION_METRICS_COLUMNS = ['UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED', 'UNMAPPED_READS',
+                               'UNPAIRED_READ_DUPLICATES', 'READ_PAIR_DUPLICATES',
+                               'READ_PAIR_OPTICAL_DUPLICATES']
+
+# Fragment length classes written by --fragment-classes, as inclusive ranges of absolute
+# template length: nucleosome-free, mono-nucleosome, and di-nucleosome fragments
+FRAGMENT_CLASSES = [('nfr', 1, 99), ('mono', 180, 247), ('di', 315, 473)]
+FRAGMENT_CLASS_BGZF_THREADS = 2
+
+# Threads each BAM read or written by the alignment filters compresses on, serially or
+# on each shard of a parallel pass
+FILTER_BGZF_THREADS = 2
+
+# Equivalent to bedtools intersect -v -f 0.5 against the blacklist
+BLACKLIST_MIN_OVERLAP_FRACTION = 0.5
+BLACKLIST_INDEX_SUFFIX = '.index.npz'
+
+# Insert sizes at or above the histogram length are counted in its last bin
+INSERT_SIZE_HISTOGRAM_LENGTH = 10000
+INSERT_SIZE_FLUSH_SIZE = 1000000
+
+# Same defaults as Picard CollectInsertSizeMetrics
+INSERT_SIZE_DEVIATIONS = 10
+INSERT_SIZE_MINIMUM_PCT = 0.05
+INSERT_SIZE_WIDTH_PERCENTS = [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99]
+
+# Same as HOMER findPeaks -style dnase -size 150 -minDist 50 -localSize 50000 -fdr 0.01,
+# with its default local fold enrichment and local Poisson p-value thresholds
+PEAK_SIZE = 150
+PEAK_MIN_DISTANCE = 50
+PEAK_LOCAL_SIZE = 50000
+PEAK_FDR = 0.01
+PEAK_LOCAL_FOLD = 4.0
+PEAK_LOCAL_PVALUE = 1e-4
+PEAK_MIN_TAGS = 2
+# The most cut sites counted at a single position, like HOMER's -tbp, so tags piled on
+# one base by clonal amplification don't make a peak on their own
+PEAK_MAX_TAGS_PER_BP = 1
+
+# Cut sites are aggregated this many bases either side of each TSS. The profile is
+# normalized by the mean of its outermost TSS_FLANK_SIZE bases at each end, and
+# smoothed with a moving average before taking the enrichment score at its peak
+TSS_WINDOW = 2000
+TSS_FLANK_SIZE = 100
+TSS_SMOOTHING_WINDOW = 50
+
+# Approximate number of bytes of BED read into memory per shift_reads chunk
+SHIFT_READS_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Number of BAM records converted and shifted together by bam_to_shifted_bed
+BAM_TO_BED_CHUNK_SIZE = 500000
+
+# Status codes assigned to each record by shift_intervals, and the message logged when
+# a record is skipped for that reason
+SHIFT_OK = 0
+SHIFT_MALFORMED = 1
+SHIFT_START_OUT_OF_BOUNDS = 2
+SHIFT_END_OUT_OF_BOUNDS = 3
+SHIFT_SKIP_MESSAGES = {
+    SHIFT_MALFORMED: 'Mal-formatted line in file, skipping:',
+    SHIFT_START_OUT_OF_BOUNDS: 'Shift start site beyond chromosome boundry:',
+    SHIFT_END_OUT_OF_BOUNDS: 'Shift end site beyond chromosome boundry:'
+}
+SHIFT_SKIP_LABELS = {
+    SHIFT_MALFORMED: 'malformed',
+    SHIFT_START_OUT_OF_BOUNDS: 'start_out_of_bounds',
+    SHIFT_END_OUT_OF_BOUNDS: 'end_out_of_bounds'
+}
+
+
+# QC counts scaled up to the full run from a preview, and duplication rates extrapolated to it
+PREVIEW_COUNT_QC = ['trimmed_reads_counts', 'num_reads_mapped', 'num_unique_reads_mapped',
+                    'num_mtDNA_reads_mapped', 'num_reads_mapped_after_filtering']
+PREVIEW_DUPLICATION_QC = ['percent_duplicate_reads']
+
+
+class ReadFilter(object):
+    """A named step in an alignment filter chain, which counts the reads keep() rejects."""
+    # Filters whose verdicts depend on other reads set this to False
+    per_read = True
+    # On the serial pass over deferred reads, where the read being filtered was deferred:
+    # its shard index and this filter's place() there
+    origin = None
+
+    def __init__(self, name):
+        self.name = name
+        self.dropped = 0
+
+    def keep(self, read):
+        raise NotImplementedError
+
+    def filter(self, reads):
+        for read in reads:
+            if self.keep(read):
+                yield read
+            else:
+                self.dropped += 1
+
+    def merge(self, other):
+        """Adds the counts of another instance of this filter, e.g. from another shard."""
+        self.dropped += other.dropped
+
+    def shard(self, shard_index, references=None):
+        """
+        Returns the instance of this filter to run on one shard of a parallel pass,
+        holding the reads of a set of reference ids, or of every reference if None.
+        """
+        return self
+
+    def place(self):
+        """Where this instance's own output stands on a shard, noted as each read is deferred."""
+        return None
+
+    def defers(self, read):
+        """
+        Whether this instance passed a read on unjudged, as its verdict depends on reads
+        outside the shard. Deferred reads are judged once every shard is done.
+        """
+        return False
+
+    def finish(self):
+        """Called once the whole BAM has been filtered, after any shards are merged."""
+        pass
+
+
+class TemplateLengthFilter(ReadFilter):
+    """Drops reads with an absolute template length below min_length."""
+    def __init__(self, name, min_length):
+        super(TemplateLengthFilter, self).__init__(name)
+        self.min_length = min_length
+
+    def keep(self, read):
+        return abs(read.template_length) >= self.min_length
+
+
+class FlagFilter(ReadFilter):
+    """Drops reads the way samtools view -F exclude_flags -q min_mapq would."""
+    def __init__(self, name, exclude_flags, min_mapq=0):
+        super(FlagFilter, self).__init__(name)
+        self.exclude_flags = exclude_flags
+        self.min_mapq = min_mapq
+
+    def keep(self, read):
+        return not read.flag & self.exclude_flags and read.mapping_quality >= self.min_mapq
+
+
+class ReferenceFilter(ReadFilter):
+    """Drops reads outside a whitelist of references, tallying drops per reference."""
+    def __init__(self, name, references):
+        super(ReferenceFilter, self).__init__(name)
+        self.references = set(references)
+        self.dropped_per_reference = {}
+
+    def keep(self, read):
+        if read.reference_name in self.references:
+            return True
+        self.dropped_per_reference[read.reference_name] = (
+            self.dropped_per_reference.get(read.reference_name, 0) + 1
+        )
+        return False
+
+    def merge(self, other):
+        super(ReferenceFilter, self).merge(other)
+        for reference, dropped in other.dropped_per_reference.items():
+            self.dropped_per_reference[reference] = self.dropped_per_reference.get(reference, 0) + dropped
+
+
+class BlacklistFilter(ReadFilter):
+    """
+    Drops reads overlapping a blacklisted region by at least min_overlap_fraction of
+    their aligned span, like bedtools intersect -v -f.
+    """
+    def __init__(self, name, index, min_overlap_fraction):
+        super(BlacklistFilter, self).__init__(name)
+        self.index = index
+        self.min_overlap_fraction = min_overlap_fraction
+
+    def keep(self, read):
+        if read.reference_name not in self.index:
+            return True
+        starts, ends, max_length = self.index[read.reference_name]
+        read_start = read.reference_start
+        read_end = read.reference_end if read.reference_end is not None else read_start
+        min_overlap = self.min_overlap_fraction * (read_end - read_start)
+
+        # Only regions starting within max_length of the read start can reach into it
+        first = bisect.bisect_right(starts, read_start - max_length)
+        last = bisect.bisect_left(starts, read_end)
+        for i in range(first, last):
+            overlap = min(read_end, ends[i]) - max(read_start, starts[i])
+            if overlap > 0 and overlap >= min_overlap:
+                return False
+        return True
+
+
+class DuplicateCandidate(object):
+    """
+    A read without a mapped mate, or a pair judged on its first mate, competing
+    with its duplicates to be kept.
+    """
+    def __init__(self, entry, mate_position=None, waits=False):
+        self.entries = [entry]
+        self.mate_position = mate_position
+        self.waits = waits
+        self.mate_seen = not waits
+        self.keep = None
+
+    def score(self):
+        """Sum of the base qualities of at least DUPLICATE_MIN_BASE_QUALITY of its scored reads."""
+        score = 0
+        for entry in self.entries[:2 if self.waits else 1]:
+            qualities = entry[0].query_qualities
+            if qualities is not None:
+                score += sum([quality for quality in qualities if quality >= DUPLICATE_MIN_BASE_QUALITY])
+        return score
+
+
+class DuplicateSet(object):
+    """The candidates sharing a signature, and whether a paired read had its end."""
+    def __init__(self, reference_id, start, waits):
+        self.reference_id = reference_id
+        self.start = start
+        self.waits = waits
+        self.candidates = []
+        self.has_pair = False
+
+
+class DuplicateFilter(ReadFilter):
+    """
+    Drops duplicate fragments from a coordinate-sorted BAM, like Picard MarkDuplicates
+    with REMOVE_DUPLICATES=true, keeping the pair with the highest base quality sum.
+    """
+    per_read = False
+
+    def __init__(self, name, libraries):
+        super(DuplicateFilter, self).__init__(name)
+        self.libraries = libraries
+        self.references = None
+        self.metrics = {}
+        self.reference_id = None
+        self.position = None
+        self.held = collections.deque()
+        self.sets = {}
+        self.open_sets = collections.deque()
+        self.pair_ends = set()
+        self.pair_end_window = collections.deque()
+        self.pending_mates = {}
+        self.pending_positions = []
+
+    @staticmethod
+    def five_prime(reference_start, cigar, is_reverse):
+        """Unclipped 5' position of an alignment, counting its clipped bases as aligned."""
+        if not is_reverse:
+            position = reference_start
+            for operation, length in cigar:
+                if operation not in CIGAR_CLIP_OPERATIONS:
+                    break
+                position -= length
+            return position
+
+        position = reference_start + sum([length for operation, length in cigar
+                                          if operation in CIGAR_REFERENCE_OPERATIONS])
+        for operation, length in reversed(cigar):
+            if operation not in CIGAR_CLIP_OPERATIONS:
+                break
+            position += length
+        return position
+
+    @staticmethod
+    def mate_five_prime(read):
+        """
+        Unclipped 5' position of the mate, exact when the MC tag holds its CIGAR. Without
+        it, a reverse mate is assumed to end where the template does.
+        """
+        if read.has_tag('MC'):
+            mate_cigar = [(CIGAR_OPERATIONS.index(operation), int(length))
+                          for length, operation in re.findall(r'(\d+)(\D)', read.get_tag('MC'))]
+            return DuplicateFilter.five_prime(read.next_reference_start, mate_cigar, read.mate_is_reverse)
+        if not read.mate_is_reverse:
+            return read.next_reference_start
+        if read.next_reference_id == read.reference_id and read.template_length != 0:
+            return min(read.reference_start, read.next_reference_start) + abs(read.template_length)
+        return read.next_reference_start + read.query_length
+
+    def library_metrics(self, library):
+        if library not in self.metrics:
+            self.metrics[library] = dict((column, 0) for column in DUPLICATION_METRICS_COLUMNS)
+        return self.metrics[library]
+
+    def ready(self, duplicate_set):
+        if duplicate_set.reference_id != self.reference_id:
+            return True
+        if duplicate_set.start >= self.position - DUPLICATE_WINDOW_SIZE:
+            return False
+        return all([candidate.mate_seen or candidate.mate_position[1] < self.position
+                    for candidate in duplicate_set.candidates])
+
+    def judge(self, signature, duplicate_set):
+        """Keeps the best candidate of a set, unless a paired read shares its end."""
+        if self.sets.get(signature) is duplicate_set:
+            del self.sets[signature]
+        best = None
+        if len(duplicate_set.candidates) == 1 and not duplicate_set.has_pair:
+            best = duplicate_set.candidates[0]
+        elif duplicate_set.candidates and not duplicate_set.has_pair:
+            best = max(duplicate_set.candidates, key=lambda candidate: candidate.score())
+        for candidate in duplicate_set.candidates:
+            candidate.keep = candidate is best
+            for entry in candidate.entries:
+                entry[1] = candidate.keep
+
+    def advance(self, read):
+        """
+        Moves the sweep to this read, judging the sets of duplicates and forgetting the
+        ends of paired reads it has left behind.
+        """
+        if read.reference_id != self.reference_id:
+            self.pair_ends.clear()
+            self.pair_end_window.clear()
+        self.reference_id, self.position = read.reference_id, read.reference_start
+        while self.open_sets and self.ready(self.open_sets[0][1]):
+            self.judge(*self.open_sets.popleft())
+        while self.pair_end_window and self.pair_end_window[0][0] < self.position - DUPLICATE_WINDOW_SIZE:
+            self.pair_ends.discard(self.pair_end_window.popleft()[1])
+
+    def forget_pending(self, read):
+        """Forgets the verdicts waiting on mates the sweep has passed without seeing."""
+        position = (read.reference_id, read.reference_start)
+        while self.pending_positions and self.pending_positions[0][:2] < position:
+            mate_position = heapq.heappop(self.pending_positions)
+            query_name = mate_position[2]
+            if (query_name in self.pending_mates and
+                    self.pending_mates[query_name].mate_position == mate_position[:2]):
+                del self.pending_mates[query_name]
+
+    def duplicate_set(self, signature, read, waits=False):
+        if signature not in self.sets:
+            self.sets[signature] = DuplicateSet(read.reference_id, read.reference_start, waits)
+            self.open_sets.append((signature, self.sets[signature]))
+        return self.sets[signature]
+
+    def add_pair_end(self, signature, read):
+        """Notes the end of a paired read, making reads without a mapped mate there duplicates."""
+        if signature not in self.pair_ends:
+            self.pair_ends.add(signature)
+            self.pair_end_window.append((read.reference_start, signature))
+            if signature in self.sets:
+                self.sets[signature].has_pair = True
+
+    def hold(self, read):
+        """Holds a read until it is judged, joining it to its set of duplicates."""
+        entry = [read, True, None, None]
+        self.held.append(entry)
+        self.advance(read)
+        if read.is_secondary or read.is_supplementary:
+            return
+        library = (self.libraries.get(read.get_tag('RG'), UNKNOWN_LIBRARY) if read.has_tag('RG')
+                   else UNKNOWN_LIBRARY)
+        metrics = self.library_metrics(library)
+        if read.is_unmapped:
+            metrics['UNMAPPED_READS'] += 1
+            return
+
+        self.forget_pending(read)
+        end = (read.reference_id, self.five_prime(read.reference_start, read.cigartuples, read.is_reverse),
+               read.is_reverse)
+        fragment_signature = (library, end)
+
+        if self.defers(read):
+            self.add_pair_end(fragment_signature, read)
+            return
+
+        if read.is_paired and not read.mate_is_unmapped:
+            # Pairs are judged on their first mate, and the second mate follows suit
+            metrics['READ_PAIRS_EXAMINED'] += 1
+            entry[1:] = [None, metrics, 'READ_PAIR_DUPLICATES']
+            candidate = self.pending_mates.pop(read.query_name, None)
+            if candidate is not None:
+                candidate.entries.append(entry)
+                entry[1] = candidate.keep
+                candidate.mate_seen = True
+            else:
+                mate_end = (read.next_reference_id, self.mate_five_prime(read), read.mate_is_reverse)
+                pair_signature = (library,) + tuple(sorted([end, mate_end]))
+                mate_position = (read.next_reference_id, read.next_reference_start)
+                duplicate_set = self.duplicate_set(
+                    pair_signature, read,
+                    waits=(read.next_reference_id == read.reference_id and
+                           read.next_reference_start <= read.reference_start + DUPLICATE_MATE_WAIT)
+                )
+                candidate = DuplicateCandidate(entry, mate_position, duplicate_set.waits)
+                duplicate_set.candidates.append(candidate)
+                self.pending_mates[read.query_name] = candidate
+                heapq.heappush(self.pending_positions, mate_position + (read.query_name,))
+            self.add_pair_end(fragment_signature, read)
+            return
+
+        metrics['UNPAIRED_READS_EXAMINED'] += 1
+        entry[1:] = [None, metrics, 'UNPAIRED_READ_DUPLICATES']
+        duplicate_set = self.duplicate_set(fragment_signature, read)
+        duplicate_set.candidates.append(DuplicateCandidate(entry))
+        if fragment_signature in self.pair_ends:
+            duplicate_set.has_pair = True
+
+    def release(self):
+        """Passes on the judged reads at the head of the held reads, in input order."""
+        while self.held and self.held[0][1] is not None:
+            read, keep, metrics, column = self.held.popleft()
+            if keep:
+                yield read
+            else:
+                self.dropped += 1
+                metrics[column] += 1
+
+    def filter(self, reads):
+        for read in reads:
+            self.hold(read)
+            for kept_read in self.release():
+                yield kept_read
+
+        # Nothing left to join the open sets once the input is exhausted
+        while self.open_sets:
+            self.judge(*self.open_sets.popleft())
+        for kept_read in self.release():
+            yield kept_read
+        self.reference_id = None
+        self.position = None
+        self.sets.clear()
+        self.pair_ends.clear()
+        self.pair_end_window.clear()
+        self.pending_mates.clear()
+        self.pending_positions = []
+
+    def shard(self, shard_index, references=None):
+        shard_filter = DuplicateFilter(self.name, self.libraries)
+        shard_filter.references = references
+        return shard_filter
+
+    def defers(self, read):
+        return (self.references is not None and read.is_paired and not read.is_unmapped and
+                not read.mate_is_unmapped and not read.is_secondary and not read.is_supplementary and
+                read.next_reference_id not in self.references)
+
+    def merge(self, other):
+        super(DuplicateFilter, self).merge(other)
+        for library, other_metrics in other.metrics.items():
+            metrics = self.library_metrics(library)
+            for column, value in other_metrics.items():
+                metrics[column] += value
+
+
+class InsertSizeCollector(ReadFilter):
+    """
+    Accumulates an insert size histogram per pair orientation, never dropping a read,
+    from the reads Picard CollectInsertSizeMetrics selects.
+    """
+    ORIENTATIONS = ('FR', 'RF', 'TANDEM')
+
+    def __init__(self, name, histogram_length=INSERT_SIZE_HISTOGRAM_LENGTH):
+        super(InsertSizeCollector, self).__init__(name)
+        self.histograms = dict((orientation, np.zeros(histogram_length, dtype=np.int64))
+                               for orientation in InsertSizeCollector.ORIENTATIONS)
+        self.max_insert_size = dict((orientation, 0) for orientation in InsertSizeCollector.ORIENTATIONS)
+        self.pending = dict((orientation, []) for orientation in InsertSizeCollector.ORIENTATIONS)
+        self.num_pending = 0
+
+    def keep(self, read):
+        if (not read.is_paired or read.is_unmapped or read.mate_is_unmapped or read.is_read1 or
+                read.is_secondary or read.is_supplementary or read.is_duplicate or
+                read.template_length == 0):
+            return True
+
+        # Same as htsjdk SamPairUtil.getPairOrientation, in 0-based coordinates
+        if read.is_reverse == read.mate_is_reverse:
+            orientation = 'TANDEM'
+        elif read.is_reverse:
+            orientation = 'FR' if read.next_reference_start + 1 < read.reference_end else 'RF'
+        else:
+            orientation = 'FR' if read.template_length > 0 else 'RF'
+
+        self.pending[orientation].append(abs(read.template_length))
+        self.num_pending += 1
+        if self.num_pending == INSERT_SIZE_FLUSH_SIZE:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Adds the pending insert sizes to the histograms in one operation per orientation."""
+        for orientation, insert_sizes in self.pending.items():
+            if insert_sizes:
+                insert_sizes = np.array(insert_sizes, dtype=np.int64)
+                histogram = self.histograms[orientation]
+                histogram += np.bincount(np.minimum(insert_sizes, len(histogram) - 1),
+                                         minlength=len(histogram))
+                self.max_insert_size[orientation] = max(self.max_insert_size[orientation],
+                                                        int(insert_sizes.max()))
+                self.pending[orientation] = []
+        self.num_pending = 0
+
+    def merge(self, other):
+        super(InsertSizeCollector, self).merge(other)
+        self.flush()
+        other.flush()
+        for orientation in InsertSizeCollector.ORIENTATIONS:
+            self.histograms[orientation] += other.histograms[orientation]
+            self.max_insert_size[orientation] = max(self.max_insert_size[orientation],
+                                                    other.max_insert_size[orientation])
+
+
+def fragment_class(template_length):
+    """Index of the FRAGMENT_CLASSES class a template length falls in, or None."""
+    template_length = abs(template_length)
+    for class_index, (_, min_length, max_length) in enumerate(FRAGMENT_CLASSES):
+        if min_length <= template_length <= max_length:
+            return class_index
+    return None
+
+
+class FragmentClassWriter(ReadFilter):
+    """
+    Writes the reads passing through it, never dropping any, to one BAM per class of
+    FRAGMENT_CLASSES, named output_prefix.{class}.bam.
+    """
+    def __init__(self, name, output_prefix, header):
+        super(FragmentClassWriter, self).__init__(name)
+        self.output_prefix = output_prefix
+        self.header = header
+        self.shard_index = None
+        self.shard_filepaths = [[] for _ in FRAGMENT_CLASSES]
+        self.written = [0] * len(FRAGMENT_CLASSES)
+        self.outputs = None
+        self.origins = [[] for _ in FRAGMENT_CLASSES]
+        self.deferred = []
+
+    def class_filepath(self, class_index, shard_index=None):
+        if shard_index is None:
+            return '{}.{}.bam'.format(self.output_prefix, FRAGMENT_CLASSES[class_index][0])
+        return '{}.{}.shard{}.bam'.format(self.output_prefix, FRAGMENT_CLASSES[class_index][0], shard_index)
+
+    def keep(self, read):
+        class_index = fragment_class(read.template_length)
+        if class_index is not None:
+            self.outputs[class_index].write(read)
+            self.written[class_index] += 1
+            if self.origin is not None:
+                self.origins[class_index].append((self.origin[0], self.origin[1][class_index]))
+        return True
+
+    def filter(self, reads):
+        self.outputs = [pysam.AlignmentFile(self.class_filepath(class_index, self.shard_index), 'wb',
+                                            header=self.header, threads=FRAGMENT_CLASS_BGZF_THREADS)
+                        for class_index in range(len(FRAGMENT_CLASSES))]
+        for read in super(FragmentClassWriter, self).filter(reads):
+            yield read
+        for output in self.outputs:
+            output.close()
+        self.outputs = None
+
+    def place(self):
+        return tuple(self.written)
+
+    def shard(self, shard_index, references=None):
+        shard_writer = copy.copy(self)
+        shard_writer.shard_index = shard_index
+        shard_writer.shard_filepaths = [[] for _ in FRAGMENT_CLASSES]
+        shard_writer.written = [0] * len(FRAGMENT_CLASSES)
+        shard_writer.origins = [[] for _ in FRAGMENT_CLASSES]
+        shard_writer.deferred = []
+        return shard_writer
+
+    def merge(self, other):
+        super(FragmentClassWriter, self).merge(other)
+        for class_index in range(len(FRAGMENT_CLASSES)):
+            self.written[class_index] += other.written[class_index]
+            if other.origins[class_index]:
+                # Reads written on the serial pass over deferred reads go back in their shards
+                self.deferred.append((self.class_filepath(class_index, other.shard_index),
+                                      other.origins[class_index], self.shard_filepaths[class_index]))
+            else:
+                self.shard_filepaths[class_index].append(self.class_filepath(class_index, other.shard_index))
+
+    def finish(self):
+        for deferred_filepath, origins, shard_filepaths in self.deferred:
+            put_back_reads(deferred_filepath, origins, shard_filepaths)
+            os.remove(deferred_filepath)
+        self.deferred = []
+        for class_index, shard_filepaths in enumerate(self.shard_filepaths):
+            if shard_filepaths:
+                pysam.cat('-o', self.class_filepath(class_index), *shard_filepaths)
+                for shard_filepath in shard_filepaths:
+                    os.remove(shard_filepath)
+        self.shard_filepaths = [[] for _ in FRAGMENT_CLASSES]
+
+
+def filter_alignments_shard(shard):
+    """
+    Worker for Pipeline.filter_alignments_parallel. Runs the filter chain over the
+    reads of one reference, or the unplaced reads if it is '*', into the shard's own BAM.
+    """
+    input_bam_filepath, shard_bam_filepath, deferred_bam_filepath, reference, read_filters, threads = shard
+    input_bam = pysam.AlignmentFile(input_bam_filepath, 'rb', threads=threads)
+    shard_bam = pysam.AlignmentFile(shard_bam_filepath, 'wb', template=input_bam, threads=threads)
+    deferred_bam = pysam.AlignmentFile(deferred_bam_filepath, 'wb', template=input_bam)
+
+    counts = {'in': 0, 'out': 0}
+    deferred_places = []
+
+    def count_in(reads):
+        for read in reads:
+            counts['in'] += 1
+            yield read
+
+    def divert(reads, read_filter):
+        # The filters after this one are per_read, so every read yielded earlier has
+        # already been written or dropped
+        for read in reads:
+            if read_filter.defers(read):
+                deferred_bam.write(read)
+                deferred_places.append((counts['out'], [chain_filter.place() for chain_filter in read_filters]))
+            else:
+                yield read
+
+    reads = count_in(input_bam.fetch(reference))
+    for read_filter in read_filters:
+        reads = read_filter.filter(reads)
+        if not read_filter.per_read:
+            reads = divert(reads, read_filter)
+    for read in reads:
+        shard_bam.write(read)
+        counts['out'] += 1
+
+    input_bam.close()
+    shard_bam.close()
+    deferred_bam.close()
+    return read_filters, counts['in'], counts['out'], deferred_places
+
+
+def interleave_reads(reads, inserted_reads):
+    """
+    Yields reads with inserted_reads, pairs of the number of reads to come ahead of an
+    inserted read and the read, in ascending order, put back in their places.
+    """
+    inserted_reads = iter(inserted_reads)
+    inserted = next(inserted_reads, None)
+    for num_reads, read in enumerate(reads):
+        while inserted is not None and inserted[0] == num_reads:
+            yield inserted[1]
+            inserted = next(inserted_reads, None)
+        yield read
+    while inserted is not None:
+        yield inserted[1]
+        inserted = next(inserted_reads, None)
+
+
+def put_back_reads(bam_filepath, places, shard_bam_filepaths):
+    """
+    Puts the reads of a BAM back in the shard BAMs they were deferred from, each at its
+    place, the index of its shard and the number of that shard's reads to come before it.
+    """
+    bam = pysam.AlignmentFile(bam_filepath, 'rb')
+    placed_reads = ((places[i], read) for i, read in enumerate(bam.fetch(until_eof=True)))
+    for shard_index, shard_placed_reads in itertools.groupby(placed_reads, key=lambda placed: placed[0][0]):
+        shard_bam_filepath = shard_bam_filepaths[shard_index]
+        merged_bam_filepath = shard_bam_filepath + '.merged'
+        shard_bam = pysam.AlignmentFile(shard_bam_filepath, 'rb', threads=FILTER_BGZF_THREADS)
+        merged_bam = pysam.AlignmentFile(merged_bam_filepath, 'wb', template=shard_bam,
+                                         threads=FILTER_BGZF_THREADS)
+        for read in interleave_reads(shard_bam.fetch(until_eof=True),
+                                     ((place[1], read) for place, read in shard_placed_reads)):
+            merged_bam.write(read)
+        shard_bam.close()
+        merged_bam.close()
+        os.rename(merged_bam_filepath, shard_bam_filepath)
+    bam.close()
+
+
+def call_peaks_chromosome(chromosome):
+    """
+    Worker for Pipeline.call_peaks. Counts the cut sites of one chromosome around each
+    cut site and picks peaks greedily from the most tags down, as HOMER does.
+    """
+    reference, cut_sites = chromosome
+    centers, tags_per_bp = np.unique(cut_sites, return_counts=True)
+    cumulative_tags = np.concatenate([[0], np.cumsum(np.minimum(tags_per_bp, PEAK_MAX_TAGS_PER_BP))])
+
+    def count_tags(window_centers, window_size):
+        return (cumulative_tags[np.searchsorted(centers, window_centers + window_size // 2)] -
+                cumulative_tags[np.searchsorted(centers, window_centers - window_size // 2)])
+
+    tag_counts = count_tags(centers, PEAK_SIZE)
+    candidates = np.flatnonzero(tag_counts >= PEAK_MIN_TAGS)
+    candidates = candidates[np.argsort(-tag_counts[candidates], kind='mergesort')]
+    excluded_starts = np.searchsorted(centers, centers - PEAK_MIN_DISTANCE, side='right')
+    excluded_ends = np.searchsorted(centers, centers + PEAK_MIN_DISTANCE)
+    is_excluded = np.zeros(len(centers), dtype=bool)
+    peaks = []
+    for candidate in candidates.tolist():
+        if not is_excluded[candidate]:
+            peaks.append(candidate)
+            is_excluded[excluded_starts[candidate]:excluded_ends[candidate]] = True
+
+    peaks = np.sort(np.array(peaks, dtype=np.int64))
+    centers = centers[peaks]
+    return reference, int(cumulative_tags[-1]), centers, tag_counts[peaks], count_tags(centers, PEAK_LOCAL_SIZE)
+
+
+def map_forked(function, items, processes):
+    """
+    Maps function over items in up to processes forked processes at once, in order.
+    Unlike a multiprocessing.Pool, function can be a closure running pools of its own.
+    """
+    context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+
+    def run_item(item, result_connection):
+        result_connection.send(function(item))
+        result_connection.close()
+
+    results = [None] * len(items)
+    pending = list(range(len(items)))
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < processes:
+                index = pending.pop(0)
+                result_receiver, result_connection = context.Pipe(False)
+                process = context.Process(target=run_item, args=(items[index], result_connection))
+                process.start()
+                result_connection.close()
+                running[result_receiver.fileno()] = (index, process, result_receiver)
+
+            ready, _, _ = select.select(list(running.keys()), [], [])
+            for fileno in ready:
+                index, process, result_receiver = running.pop(fileno)
+                try:
+                    results[index] = result_receiver.recv()
+                except EOFError:
+                    pass
+                result_receiver.close()
+                process.join()
+                if process.exitcode != 0:
+                    raise subprocess.CalledProcessError(process.exitcode, 'forked item {}'.format(index))
+    finally:
+        for _, process, result_receiver in running.values():
+            process.terminate()
+            process.join()
+            result_receiver.close()
+    return results
+
 
 class Pipeline(BasePipeline):
     def description(self):
@@ -31,35 +829,19 @@ class Pipeline(BasePipeline):
             },
             'bwa': {
                 'path': 'Full path to bwa executable',
-                'threads': 'Number of threads to use for bwa aln',
+                'threads': 'Number of threads to use for bwa aln or mem',
                 'index-dir': 'Directory of the bwa reference index [Ex. /path/to/bwa/index/genome.fa]'
             },
             'fastqc': {
                 'path': 'Full path to FastQC'
             },
             'samtools': {
-                'path': 'Full path to samtools'
-            },
-            'novosort': {
-                'path': 'Full path to novosort',
-                'threads': 'Number of threads to use for Novosort'
-            },
-            'picard': {
-                'path': 'Full path to Picard [Ex. java -jar /path/to/picard.jar]'
+                'path': 'Full path to samtools',
+                'threads': 'Number of threads to use for samtools sort and merge'
             },
             'bedtools': {
-                'path': 'Full path to bedtools >= 2.25.0',
                 'blacklist-bed': 'Full path to the BED of blacklisted genomic regions',
                 'genome-sizes': 'Full path to a genome sizes file'
-            },
-            'makeTagDirectory': {
-                'path': 'Full path to HOMER makeTagDirectory'
-            },
-            'findPeaks': {
-                'path': 'Full path to HOMER findPeaks'
-            },
-            'pos2bed': {
-                'path': 'Full path to HOMER pos2bed.pl'
             }
         }
 
@@ -70,64 +852,910 @@ class Pipeline(BasePipeline):
         parser.add_argument('--step', default=0)
         parser.add_argument('--forward-adapter', default='ZZZ')
         parser.add_argument('--reverse-adapter', default='ZZZ')
+        parser.add_argument('--filter-processes', default=1, type=int,
+                            help=('Number of processes used to filter alignments. Above 1, the BAM is '
+                                  'sharded by reference and filtered in parallel.'))
+        parser.add_argument('--pair-processes', default=1, type=int,
+                            help=('Number of read pairs trimmed, checked, and aligned at once, sharing '
+                                  'the bwa threads. Above 1, the mates of each pair are aligned at once.'))
+        parser.add_argument('--tss', default=None,
+                            help=('BED or GTF of transcription start sites. If given, a TSS enrichment '
+                                  'score and profile are computed from the cut sites.'))
+        parser.add_argument('--peak-processes', default=1, type=int,
+                            help='Number of processes used to call peaks, one chromosome at a time.')
+        parser.add_argument('--aligner', default='aln', choices=['aln', 'mem'],
+                            help=('bwa algorithm used to align read pairs: aln and sampe, or mem, which '
+                                  'streams alignments straight to the sorter without .sai files.'))
+        parser.add_argument('--fragment-classes', action='store_true',
+                            help=('Also write the processed BAM and BED split into nucleosome-free, '
+                                  'mono-nucleosome, and di-nucleosome fragments.'))
+        parser.add_argument('--external-fastqc', action='store_true',
+                            help=('Run FastQC on each FASTQ instead of the built-in FASTQ QC, which writes '
+                                  'fastqc_data.txt and summary.txt in its formats while counting reads.'))
+        parser.add_argument('--trim-cores', default=1, type=int,
+                            help=('Number of cores cutadapt trims on, if its version supports it, '
+                                  'split between the read pairs run at once.'))
+        parser.add_argument('--trimmed-output', default='gzip', choices=TRIMMED_OUTPUT_MODES,
+                            help=('How trimmed reads are written: gzipped at the default level (gzip, '
+                                  'the default), gzipped at level 1 (fast), or uncompressed (plain), '
+                                  'which is fastest and largest.'))
+        parser.add_argument('--trimmer', default='cutadapt', choices=TRIMMERS,
+                            help=('Trim reads with cutadapt, or with the built-in trimmer, which trims '
+                                  'them the same way in batches on --trim-cores processes, whatever '
+                                  'the cutadapt version. It needs numpy.'))
+        parser.add_argument('--preview', default=None, type=preview_fraction, metavar='FRACTION',
+                            help=('Run on this fraction of read pairs, picked by a hash of their '
+                                  'names so mates stay together across files and lanes, and '
+                                  'extrapolate QC to all of them.'))
         return parser
 
     @staticmethod
     def count_gzipped_lines(filepath):
-        zcat = subprocess.Popen(['zcat', filepath], stdout=subprocess.PIPE)
-        num_lines = subprocess.check_output(['wc', '-l'], stdin=zcat.stdout)
-        return num_lines.strip()
+        return cached_count_gzipped_lines(filepath)
 
     @staticmethod
-    def shift_reads(input_bed_filepath, output_bed_filepath, genome_sizes_filepath,
-                    log_filepath, minus_strand_shift, plus_strand_shift):
-        def to_log(msg, log_filepath):
-            with open(log_filepath, 'a') as log_file:
-                log_file.write(msg + '\n')
-
-        def within_genome_boundry(chrom, check_pos, genome_sizes_dict):
-            if check_pos < 1:
-                return False
-            if check_pos > genome_sizes_dict[chrom]:
-                return False
-            return True
-
+    def load_genome_sizes(genome_sizes_filepath):
         genome_sizes = {}
         with open(genome_sizes_filepath) as genome_sizes_file:
             for line in genome_sizes_file:
                 chrom, size = line.strip().split('\t')
                 genome_sizes[chrom] = int(size)
+        return genome_sizes
 
-        output_bed = open(output_bed_filepath, 'w')
-        with open(input_bed_filepath) as input_bed:
-            for line in input_bed:
-                record = line.strip().split('\t')
-                chrom, start, end, strand = record[0], int(record[1]), int(record[2]), record[5]
-
-                if strand == '+':
-                    new_start = start + plus_strand_shift
-                    new_end = end + plus_strand_shift
-                elif strand == '-':
-                    new_start = start + minus_strand_shift
-                    new_end = end + minus_strand_shift
-                else:
-                    to_log('Mal-formatted line in file, skipping:', log_filepath)
-                    to_log(line.strip(), log_filepath)
+    @staticmethod
+    def shift_intervals(chroms, starts, ends, strands, genome_sizes,
+                        minus_strand_shift, plus_strand_shift):
+        """
+        Shifts a block of intervals by strand as whole-array operations. Returns the shifted
+        starts and ends and a SHIFT_* status per interval.
+        """
+        strands = np.asarray(strands)
+        is_plus = strands == '+'
+        is_minus = strands == '-'
+        shift = np.where(is_plus, plus_strand_shift, minus_strand_shift)
+        new_starts = starts + shift
+        new_ends = ends + shift
+
+        # Look up the size of every interval's chromosome through its unique chromosomes
+        unique_chroms, chrom_indices = np.unique(np.asarray(chroms), return_inverse=True)
+        chrom_sizes = np.array([genome_sizes.get(chrom, -1) for chrom in unique_chroms.tolist()],
+                               dtype=np.int64)[chrom_indices]
+
+        status = np.full(len(strands), SHIFT_OK, dtype=np.int8)
+        status[~(is_plus | is_minus)] = SHIFT_MALFORMED
+        unknown_chrom = (status == SHIFT_OK) & (chrom_sizes < 0)
+        if unknown_chrom.any():
+            raise KeyError(np.asarray(chroms)[unknown_chrom][0])
+
+        end_out_of_bounds = (new_ends < 1) | (new_ends > chrom_sizes)
+        status[(status == SHIFT_OK) & end_out_of_bounds] = SHIFT_END_OUT_OF_BOUNDS
+        start_out_of_bounds = (new_starts < 1) | (new_starts > chrom_sizes)
+        status[(status != SHIFT_MALFORMED) & start_out_of_bounds] = SHIFT_START_OUT_OF_BOUNDS
+
+        return new_starts, new_ends, status
+
+    @staticmethod
+    def write_shift_skips(log_file, records, status, skip_counts):
+        """
+        Writes the skip log entries for one block of records in a single call and
+        tallies the skip reasons into skip_counts.
+        """
+        skipped = np.flatnonzero(status != SHIFT_OK)
+        skip_status = status[skipped].tolist()
+        log_file.write(''.join([
+            '{}\n{}\n'.format(SHIFT_SKIP_MESSAGES[code], '\t'.join(records[i]))
+            for i, code in zip(skipped.tolist(), skip_status)
+        ]))
+        for code in skip_status:
+            skip_counts[code] = skip_counts.get(code, 0) + 1
+
+    @staticmethod
+    def write_shift_summary(log_file, num_records, skip_counts):
+        log_file.write('Summary: {} of {} records skipped\n'.format(sum(skip_counts.values()),
+                                                                   num_records))
+        for code in sorted(SHIFT_SKIP_LABELS):
+            log_file.write('\t{}\t{}\n'.format(SHIFT_SKIP_LABELS[code], skip_counts.get(code, 0)))
+
+    @staticmethod
+    def shift_block(records, starts, ends, output_bed, log_filepath, skip_counts, genome_sizes,
+                    minus_strand_shift, plus_strand_shift, record_classes=None, class_beds=None):
+        """
+        Shifts one block of BED6 records and writes the kept ones, and each to the BED of
+        its fragment class if class_beds is given.
+        """
+        new_starts, new_ends, status = Pipeline.shift_intervals(
+            chroms=[record[0] for record in records],
+            starts=starts,
+            ends=ends,
+            strands=[record[5] for record in records],
+            genome_sizes=genome_sizes,
+            minus_strand_shift=minus_strand_shift,
+            plus_strand_shift=plus_strand_shift
+        )
+
+        kept = np.flatnonzero(status == SHIFT_OK).tolist()
+        new_starts, new_ends = new_starts.tolist(), new_ends.tolist()
+        lines = ['\t'.join([records[i][0], str(new_starts[i]), str(new_ends[i])] + records[i][3:]) + '\n'
+                 for i in kept]
+        output_bed.write(''.join(lines))
+
+        if class_beds is not None:
+            class_lines = [[] for _ in class_beds]
+            for i, line in zip(kept, lines):
+                if record_classes[i] is not None:
+                    class_lines[record_classes[i]].append(line)
+            for class_bed, lines in zip(class_beds, class_lines):
+                class_bed.write(''.join(lines))
+
+        if len(kept) < len(records):
+            with open(log_filepath, 'a') as log_file:
+                Pipeline.write_shift_skips(log_file, records, status, skip_counts)
+
+    @staticmethod
+    def shift_reads(input_bed_filepath, output_bed_filepath, genome_sizes_filepath,
+                    log_filepath, minus_strand_shift, plus_strand_shift):
+        """
+        Shifts every record of a BED6 file by strand in blocks of roughly
+        SHIFT_READS_CHUNK_SIZE bytes, logging the records skipped.
+        """
+        genome_sizes = Pipeline.load_genome_sizes(genome_sizes_filepath)
+
+        num_records = 0
+        skip_counts = {}
+        with open(input_bed_filepath) as input_bed, open(output_bed_filepath, 'w') as output_bed:
+            while True:
+                lines = input_bed.readlines(SHIFT_READS_CHUNK_SIZE)
+                if not lines:
+                    break
+                num_records += len(lines)
+
+                records = [line.strip().split('\t') for line in lines]
+                Pipeline.shift_block(
+                    records=records,
+                    starts=np.array([record[1] for record in records], dtype=np.int64),
+                    ends=np.array([record[2] for record in records], dtype=np.int64),
+                    output_bed=output_bed,
+                    log_filepath=log_filepath,
+                    skip_counts=skip_counts,
+                    genome_sizes=genome_sizes,
+                    minus_strand_shift=minus_strand_shift,
+                    plus_strand_shift=plus_strand_shift
+                )
+
+        if skip_counts:
+            with open(log_filepath, 'a') as log_file:
+                Pipeline.write_shift_summary(log_file, num_records, skip_counts)
+
+    @staticmethod
+    def bam_to_shifted_bed(input_bam_filepath, output_bed_filepath, genome_sizes,
+                           log_filepath, minus_strand_shift, plus_strand_shift,
+                           fragment_class_bed_filepaths=None):
+        """
+        Streams the mapped reads of a BAM into a strand-shifted BED6, like bedtools bamtobed
+        then shift_reads, split by fragment class too if fragment_class_bed_filepaths is given.
+        """
+        num_records = 0
+        skip_counts = {}
+        input_bam = pysam.AlignmentFile(input_bam_filepath, 'rb')
+        class_beds = None
+        if fragment_class_bed_filepaths is not None:
+            class_beds = [open(filepath, 'w') for filepath in fragment_class_bed_filepaths]
+        with open(output_bed_filepath, 'w') as output_bed:
+            records, starts, ends, record_classes = [], [], [], []
+            for read in input_bam.fetch(until_eof=True):
+                if read.is_unmapped:
                     continue
 
-                if not within_genome_boundry(chrom, new_start, genome_sizes):
-                    to_log('Shift start site beyond chromosome boundry:', log_filepath)
-                    to_log(line.strip(), log_filepath)
+                # Same name, score, and strand columns as bedtools bamtobed
+                name = read.query_name
+                if read.is_read1:
+                    name += '/1'
+                elif read.is_read2:
+                    name += '/2'
+                start = read.reference_start
+                end = read.reference_end if read.reference_end is not None else start
+                records.append([read.reference_name, str(start), str(end), name,
+                                str(read.mapping_quality), '-' if read.is_reverse else '+'])
+                starts.append(start)
+                ends.append(end)
+                if class_beds is not None:
+                    record_classes.append(fragment_class(read.template_length))
+
+                if len(records) == BAM_TO_BED_CHUNK_SIZE:
+                    num_records += len(records)
+                    Pipeline.shift_block(records, np.array(starts, dtype=np.int64),
+                                         np.array(ends, dtype=np.int64), output_bed, log_filepath,
+                                         skip_counts, genome_sizes, minus_strand_shift, plus_strand_shift,
+                                         record_classes, class_beds)
+                    records, starts, ends, record_classes = [], [], [], []
+
+            if records:
+                num_records += len(records)
+                Pipeline.shift_block(records, np.array(starts, dtype=np.int64),
+                                     np.array(ends, dtype=np.int64), output_bed, log_filepath,
+                                     skip_counts, genome_sizes, minus_strand_shift, plus_strand_shift,
+                                     record_classes, class_beds)
+        input_bam.close()
+        if class_beds is not None:
+            for class_bed in class_beds:
+                class_bed.close()
+
+        if skip_counts:
+            with open(log_filepath, 'a') as log_file:
+                Pipeline.write_shift_summary(log_file, num_records, skip_counts)
+
+    @staticmethod
+    def load_blacklist_index(blacklist_bed_filepath):
+        """
+        Loads the per-reference blacklist index BlacklistFilter uses, cached next to the
+        BED with BLACKLIST_INDEX_SUFFIX while it's newer than the BED.
+        """
+        cache_filepath = blacklist_bed_filepath + BLACKLIST_INDEX_SUFFIX
+        if (not os.path.isfile(cache_filepath) or
+                os.path.getmtime(cache_filepath) < os.path.getmtime(blacklist_bed_filepath)):
+            regions = {}
+            with open(blacklist_bed_filepath) as blacklist_bed:
+                for line in blacklist_bed:
+                    if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                        continue
+                    record = line.strip().split('\t')
+                    regions.setdefault(record[0], []).append((int(record[1]), int(record[2])))
+
+            references = sorted(regions)
+            intervals = np.array([interval for reference in references
+                                  for interval in sorted(regions[reference])],
+                                 dtype=np.int64).reshape(-1, 2)
+            offsets = np.cumsum([0] + [len(regions[reference]) for reference in references])
+
+            # Write to a temporary file first so concurrent runs never read a partial cache
+            tmp_cache_filepath = '{}.{}.tmp'.format(cache_filepath, os.getpid())
+            try:
+                with open(tmp_cache_filepath, 'wb') as cache_file:
+                    np.savez(cache_file, references=np.array(references), offsets=offsets,
+                             starts=intervals[:, 0], ends=intervals[:, 1])
+                os.rename(tmp_cache_filepath, cache_filepath)
+            except (IOError, OSError):
+                if os.path.isfile(tmp_cache_filepath):
+                    os.remove(tmp_cache_filepath)
+        else:
+            cache = np.load(cache_filepath)
+            references = cache['references'].tolist()
+            offsets = cache['offsets']
+            intervals = np.column_stack([cache['starts'], cache['ends']])
+
+        index = {}
+        for i, reference in enumerate(references):
+            starts = intervals[offsets[i]:offsets[i + 1], 0]
+            ends = intervals[offsets[i]:offsets[i + 1], 1]
+            index[reference] = (starts.tolist(), ends.tolist(), int((ends - starts).max()))
+        return index
+
+    @staticmethod
+    def sort_alignments(samtools_path, input_sam_filepath, output_bam_prefix, sort_threads):
+        """
+        Sorts an aligner's SAM output into output_bam_prefix.sorted.bam, teeing it to
+        samtools flagstat. Returns the number of QC-passed reads mapped.
+        """
+        flagstat_fifo = input_sam_filepath + '.flagstat'
+        if os.path.exists(flagstat_fifo):
+            os.remove(flagstat_fifo)
+        os.mkfifo(flagstat_fifo)
+        processes = []
+        try:
+            with open(output_bam_prefix + '.flagstat', 'w') as flagstat_file:
+                processes.append(('samtools flagstat', subprocess.Popen([samtools_path, 'flagstat', flagstat_fifo],
+                                                                        stdout=flagstat_file, close_fds=True)))
+            samtools_sort = subprocess.Popen([samtools_path, 'sort',
+                                              '-m', SORT_MEMORY_PER_THREAD,
+                                              '-@', str(sort_threads),
+                                              '-T', output_bam_prefix + '.sort',
+                                              '-o', output_bam_prefix + '.sorted.bam', '-'],
+                                             stdin=subprocess.PIPE, close_fds=True)
+            processes.insert(0, ('samtools sort', samtools_sort))
+            # Opening the FIFO waits for the aligner to start writing to it
+            with open(input_sam_filepath, 'rb') as input_sam:
+                processes.insert(0, ('tee', subprocess.Popen(['tee', flagstat_fifo], stdin=input_sam,
+                                                             stdout=samtools_sort.stdin, close_fds=True)))
+            samtools_sort.stdin.close()
+
+            for name, process in processes:
+                if process.wait() != 0:
+                    raise subprocess.CalledProcessError(process.returncode, '{} {}'.format(name, output_bam_prefix))
+        except Exception:
+            # samtools flagstat waits on its FIFO until tee opens it
+            for _, process in processes:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+            raise
+        finally:
+            os.remove(flagstat_fifo)
+
+        with open(output_bam_prefix + '.flagstat') as flagstat_file:
+            mapped = re.search(r'(\d+) \+ \d+ mapped', flagstat_file.read())
+        return int(mapped.group(1)) if mapped else 0
+
+    @staticmethod
+    def filter_alignments(input_bam_filepath, output_bam_filepath, read_filters):
+        """
+        Applies a chain of ReadFilters to a BAM in one streaming pass. Returns the number
+        of reads read and written.
+        """
+        input_bam = pysam.AlignmentFile(input_bam_filepath, 'rb', threads=FILTER_BGZF_THREADS)
+        output_bam = pysam.AlignmentFile(output_bam_filepath, 'wb', template=input_bam,
+                                         threads=FILTER_BGZF_THREADS)
+
+        counts = {'in': 0, 'out': 0}
+
+        def count_in(reads):
+            for read in reads:
+                counts['in'] += 1
+                yield read
+
+        reads = count_in(input_bam.fetch(until_eof=True))
+        for read_filter in read_filters:
+            reads = read_filter.filter(reads)
+        for read in reads:
+            output_bam.write(read)
+            counts['out'] += 1
+
+        input_bam.close()
+        output_bam.close()
+        for read_filter in read_filters:
+            read_filter.finish()
+        return counts['in'], counts['out']
+
+    @staticmethod
+    def filter_alignments_parallel(input_bam_filepath, output_bam_filepath, read_filters,
+                                   processes, tmp_dir):
+        """
+        Parallel version of filter_alignments, sharding the BAM by reference across a
+        process pool. Deferred reads go through the chain serially and are put back in place.
+        """
+        deferring_filters = [i for i, read_filter in enumerate(read_filters) if not read_filter.per_read]
+        if len(deferring_filters) > 1:
+            raise ValueError('Alignments can only be filtered in parallel with one filter that is not per_read')
+        serial_filters = read_filters[deferring_filters[0]:] if deferring_filters else []
+
+        if not os.path.isfile(input_bam_filepath + '.bai'):
+            pysam.index(input_bam_filepath)
+
+        input_bam = pysam.AlignmentFile(input_bam_filepath, 'rb')
+        shard_references = [(reference, set([reference_id]), length) for reference_id, (reference, length)
+                            in enumerate(zip(input_bam.references, input_bam.lengths))]
+        shard_references.append(('*', set(), 0))
+        input_bam.close()
+
+        shard_prefix = os.path.join(tmp_dir, os.path.basename(output_bam_filepath))
+        shards = []
+        for reference, reference_ids, _ in shard_references:
+            shard_index = len(shards)
+            shards.append((input_bam_filepath, '{}.shard{}.bam'.format(shard_prefix, shard_index),
+                           '{}.shard{}.deferred.bam'.format(shard_prefix, shard_index), reference,
+                           [read_filter.shard(shard_index, reference_ids) for read_filter in read_filters],
+                           FILTER_BGZF_THREADS))
+
+        # Pool.map hands out shards in order, so the longest references start first
+        order = sorted(range(len(shards)), key=lambda i: -shard_references[i][2])
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(filter_alignments_shard, [shards[i] for i in order], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        shard_results = [None] * len(shards)
+        for shard_index, result in zip(order, results):
+            shard_results[shard_index] = result
+
+        num_reads_in, num_reads_out = 0, 0
+        for shard_filters, shard_reads_in, shard_reads_out, _ in shard_results:
+            for read_filter, shard_filter in zip(read_filters, shard_filters):
+                read_filter.merge(shard_filter)
+            num_reads_in += shard_reads_in
+            num_reads_out += shard_reads_out
+
+        # Deferred reads are judged in one serial pass, in reference order, noting the
+        # place in its shard of every read kept
+        kept_bam_filepath = '{}.deferred.bam'.format(shard_prefix)
+        kept_places = []
+        if serial_filters:
+            side_filters = [read_filter.shard(len(shards)) for read_filter in serial_filters]
+            pending = collections.deque()
+            current = {}
+
+            def deferred_reads():
+                for shard_index, shard in enumerate(shards):
+                    deferred_bam = pysam.AlignmentFile(shard[2], 'rb')
+                    shard_places = iter(shard_results[shard_index][3])
+                    for read in deferred_bam.fetch(until_eof=True):
+                        pending.append((read, (shard_index,) + next(shard_places)))
+                        yield read
+                    deferred_bam.close()
+
+            def placed_reads(reads):
+                # The filters after the first are per_read, so each read is written or
+                # dropped before the next one's origin is set
+                for read in reads:
+                    while pending[0][0] is not read:
+                        pending.popleft()
+                    current['place'] = pending.popleft()[1]
+                    shard_index, _, filter_places = current['place']
+                    for side_filter, filter_place in zip(side_filters, filter_places[deferring_filters[0]:]):
+                        side_filter.origin = (shard_index, filter_place)
+                    yield read
+
+            input_bam = pysam.AlignmentFile(input_bam_filepath, 'rb')
+            kept_bam = pysam.AlignmentFile(kept_bam_filepath, 'wb', template=input_bam)
+            input_bam.close()
+            reads = placed_reads(side_filters[0].filter(deferred_reads()))
+            for side_filter in side_filters[1:]:
+                reads = side_filter.filter(reads)
+            for read in reads:
+                kept_places.append(current['place'][:2])
+                kept_bam.write(read)
+            kept_bam.close()
+            for read_filter, side_filter in zip(serial_filters, side_filters):
+                side_filter.origin = None
+                if side_filter is not read_filter:
+                    read_filter.merge(side_filter)
+            num_reads_out += len(kept_places)
+        for read_filter in read_filters:
+            read_filter.finish()
+
+        shard_bam_filepaths = [shard[1] for shard in shards]
+        if kept_places:
+            put_back_reads(kept_bam_filepath, kept_places, shard_bam_filepaths)
+
+        # BAM shards can be concatenated without recompressing
+        pysam.cat('-o', output_bam_filepath, *shard_bam_filepaths)
+        for shard in shards:
+            os.remove(shard[1])
+            os.remove(shard[2])
+        if os.path.isfile(kept_bam_filepath):
+            os.remove(kept_bam_filepath)
+
+        return num_reads_in, num_reads_out
+
+    @staticmethod
+    def format_metric(value):
+        """Formats a metric value the way Picard metrics files do."""
+        if isinstance(value, float):
+            return '{:.6f}'.format(value).rstrip('0').rstrip('.')
+        return str(value)
+
+    @staticmethod
+    def estimate_library_size(read_pairs, unique_read_pairs):
+        """Estimates a library's unique molecules from its pair counts, as Picard does."""
+        def f(x, c, n):
+            return c / x - 1 + math.exp(-n / x)
+
+        if read_pairs <= 0 or read_pairs - unique_read_pairs <= 0:
+            return None
+        n, c = float(read_pairs), float(unique_read_pairs)
+        m, M = 1.0, 100.0
+        if c >= n or f(m * c, c, n) < 0:
+            return None
+        while f(M * c, c, n) > 0:
+            M *= 10.0
+        for _ in range(40):
+            r = (m + M) / 2.0
+            u = f(r * c, c, n)
+            if u == 0:
+                break
+            elif u > 0:
+                m = r
+            else:
+                M = r
+        return int(c * (m + M) / 2.0)
+
+    @staticmethod
+    def write_duplication_metrics(duplicate_filter, metrics_filepath, input_bam_filepath):
+        """Writes the counts of a DuplicateFilter as a Picard MarkDuplicates metrics file."""
+        with open(metrics_filepath, 'w') as metrics_file:
+            metrics_file.write('## htsjdk.samtools.metrics.StringHeader\n')
+            metrics_file.write('# atacseq DuplicateFilter INPUT={} REMOVE_DUPLICATES=true\n'.format(
+                input_bam_filepath
+            ))
+            metrics_file.write('## htsjdk.samtools.metrics.StringHeader\n')
+            metrics_file.write('# Started on: {}\n\n'.format(time.strftime('%a %b %d %H:%M:%S %Z %Y')))
+            metrics_file.write('## METRICS CLASS\tpicard.sam.DuplicationMetrics\n')
+            metrics_file.write('\t'.join(['LIBRARY'] + DUPLICATION_METRICS_COLUMNS +
+                                         ['PERCENT_DUPLICATION', 'ESTIMATED_LIBRARY_SIZE']) + '\n')
+            for library in sorted(duplicate_filter.metrics):
+                metrics = dict(duplicate_filter.metrics[library])
+                for column in ['READ_PAIRS_EXAMINED', 'READ_PAIR_DUPLICATES']:
+                    metrics[column] //= 2
+
+                examined = metrics['UNPAIRED_READS_EXAMINED'] + metrics['READ_PAIRS_EXAMINED'] * 2
+                duplicates = metrics['UNPAIRED_READ_DUPLICATES'] + metrics['READ_PAIR_DUPLICATES'] * 2
+                percent_duplication = duplicates / float(examined) if examined else 0.0
+                library_size = Pipeline.estimate_library_size(
+                    metrics['READ_PAIRS_EXAMINED'] - metrics['READ_PAIR_OPTICAL_DUPLICATES'],
+                    metrics['READ_PAIRS_EXAMINED'] - metrics['READ_PAIR_DUPLICATES']
+                )
+                row = ([library] + [str(metrics[column]) for column in DUPLICATION_METRICS_COLUMNS] +
+                       [Pipeline.format_metric(percent_duplication),
+                        str(library_size) if library_size is not None else ''])
+                metrics_file.write('\t'.join(row) + '\n')
+            metrics_file.write('\n')
+
+    @staticmethod
+    def histogram_median(values, counts):
+        """Median of a histogram, computed the way htsjdk Histogram.getMedian() does."""
+        total = counts.sum()
+        if total % 2 == 0:
+            mid_low, mid_high = total // 2, total // 2 + 1
+        else:
+            mid_low = mid_high = total // 2 + 1
+        cumulative_counts = np.cumsum(counts)
+        return (values[np.searchsorted(cumulative_counts, mid_low)] +
+                values[np.searchsorted(cumulative_counts, mid_high)]) / 2.0
+
+    @staticmethod
+    def insert_size_metrics(histogram, max_insert_size):
+        """
+        Computes the Picard InsertSizeMetrics columns for one orientation's histogram.
+        Returns the metrics and the histogram trimmed as Picard trims it.
+        """
+        insert_sizes = np.arange(len(histogram))
+        observed = histogram > 0
+        total = histogram.sum()
+
+        median = Pipeline.histogram_median(insert_sizes[observed], histogram[observed])
+        deviations = np.abs(insert_sizes[observed] - median)
+        deviation_order = np.argsort(deviations, kind='mergesort')
+        mad = Pipeline.histogram_median(deviations[deviation_order], histogram[observed][deviation_order])
+
+        # Widths of the windows centred on the median covering each percent of pairs
+        center = int(median)
+        padded = np.concatenate([np.zeros(len(histogram)), histogram, np.zeros(len(histogram))])
+        cumulative = np.cumsum(padded)
+        half_widths = np.arange(len(histogram))
+        covered = (cumulative[center + len(histogram) + half_widths] -
+                   cumulative[center + len(histogram) - half_widths - 1])
+        widths = [2 * int(np.argmax(covered >= total * percent / 100.0)) + 1
+                  for percent in INSERT_SIZE_WIDTH_PERCENTS]
+
+        trimmed = histogram.copy()
+        trimmed[int(median + INSERT_SIZE_DEVIATIONS * mad) + 1:] = 0
+        trimmed_total = float(trimmed.sum())
+        mean = (insert_sizes * trimmed).sum() / trimmed_total
+        standard_deviation = (math.sqrt(((insert_sizes - mean) ** 2 * trimmed).sum() / (trimmed_total - 1))
+                              if trimmed_total > 1 else 0.0)
+
+        metrics = [median, mad, int(insert_sizes[observed][0]), max_insert_size, mean,
+                   standard_deviation, int(total)]
+        return metrics, widths, trimmed
+
+    @staticmethod
+    def write_insert_size_metrics(insert_size_collector, metrics_filepath, histogram_filepath,
+                                  input_bam_filepath):
+        """
+        Writes an InsertSizeCollector's histograms as a Picard CollectInsertSizeMetrics
+        metrics file, and plots them if matplotlib is available.
+        """
+        insert_size_collector.flush()
+        histograms = insert_size_collector.histograms
+        total_pairs = sum([histogram.sum() for histogram in histograms.values()])
+
+        columns = (['MEDIAN_INSERT_SIZE', 'MEDIAN_ABSOLUTE_DEVIATION', 'MIN_INSERT_SIZE',
+                    'MAX_INSERT_SIZE', 'MEAN_INSERT_SIZE', 'STANDARD_DEVIATION', 'READ_PAIRS',
+                    'PAIR_ORIENTATION'] +
+                   ['WIDTH_OF_{}_PERCENT'.format(percent) for percent in INSERT_SIZE_WIDTH_PERCENTS] +
+                   ['SAMPLE', 'LIBRARY', 'READ_GROUP'])
+        metrics_rows, trimmed_histograms = [], []
+        for orientation in InsertSizeCollector.ORIENTATIONS:
+            histogram = histograms[orientation]
+            if histogram.sum() == 0 or histogram.sum() < total_pairs * INSERT_SIZE_MINIMUM_PCT:
+                continue
+            metrics, widths, trimmed = Pipeline.insert_size_metrics(
+                histogram, insert_size_collector.max_insert_size[orientation]
+            )
+            metrics_rows.append([Pipeline.format_metric(value) for value in metrics] + [orientation] +
+                                [str(width) for width in widths] + ['', '', ''])
+            trimmed_histograms.append((orientation, trimmed))
+
+        with open(metrics_filepath, 'w') as metrics_file:
+            metrics_file.write('## htsjdk.samtools.metrics.StringHeader\n')
+            metrics_file.write('# atacseq InsertSizeCollector INPUT={}\n'.format(input_bam_filepath))
+            metrics_file.write('## htsjdk.samtools.metrics.StringHeader\n')
+            metrics_file.write('# Started on: {}\n\n'.format(time.strftime('%a %b %d %H:%M:%S %Z %Y')))
+            metrics_file.write('## METRICS CLASS\tpicard.analysis.InsertSizeMetrics\n')
+            metrics_file.write('\t'.join(columns) + '\n')
+            for row in metrics_rows:
+                metrics_file.write('\t'.join(row) + '\n')
+            metrics_file.write('\n')
+
+            if trimmed_histograms:
+                metrics_file.write('## HISTOGRAM\tjava.lang.Integer\n')
+                metrics_file.write('\t'.join(['insert_size'] + ['All_Reads.{}_count'.format(orientation.lower())
+                                                               for orientation, _ in trimmed_histograms]) + '\n')
+                observed = np.flatnonzero(np.any([trimmed > 0 for _, trimmed in trimmed_histograms], axis=0))
+                for insert_size in observed.tolist():
+                    metrics_file.write('\t'.join([str(insert_size)] + [str(trimmed[insert_size])
+                                                                       for _, trimmed in trimmed_histograms]) + '\n')
+                metrics_file.write('\n')
+
+        try:
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot as plt
+        except ImportError:
+            return
+
+        figure = plt.figure()
+        for orientation, trimmed in trimmed_histograms:
+            plt.plot(np.arange(len(trimmed)), trimmed, label='{} ({} pairs)'.format(orientation, trimmed.sum()))
+        if trimmed_histograms:
+            observed = np.flatnonzero(np.any([trimmed > 0 for _, trimmed in trimmed_histograms], axis=0))
+            plt.xlim(0, observed[-1] + 1)
+        plt.xlabel('Insert Size')
+        plt.ylabel('Count')
+        plt.title('Insert Size Histogram for All_Reads\nin file {}'.format(os.path.basename(input_bam_filepath)))
+        plt.legend()
+        figure.savefig(histogram_filepath)
+        plt.close(figure)
+
+    @staticmethod
+    def load_cut_sites(bed_filepath):
+        """
+        Reads the cut site of every record of a shifted BED6 as HOMER does. Returns a
+        sorted array of cut sites per chromosome.
+        """
+        cut_site_blocks = {}
+        with open(bed_filepath) as bed:
+            while True:
+                lines = bed.readlines(SHIFT_READS_CHUNK_SIZE)
+                if not lines:
+                    break
+                records = [line.rstrip('\n').split('\t') for line in lines]
+                chroms = np.array([record[0] for record in records])
+                starts = np.array([record[1] for record in records], dtype=np.int64)
+                ends = np.array([record[2] for record in records], dtype=np.int64)
+                is_minus = np.array([record[5] == '-' for record in records], dtype=bool)
+                cut_sites = np.where(is_minus, ends - 1, starts)
+
+                block_chroms, chrom_indices = np.unique(chroms, return_inverse=True)
+                for i, chrom in enumerate(block_chroms.tolist()):
+                    cut_site_blocks.setdefault(chrom, []).append(cut_sites[chrom_indices == i])
+
+        return dict((chrom, np.sort(np.concatenate(blocks))) for chrom, blocks in cut_site_blocks.items())
+
+    @staticmethod
+    def write_cut_site_bigwig(cut_sites, genome_sizes, bigwig_filepath):
+        """
+        Writes cut sites per million cut sites as a bigWig. Returns False, writing
+        nothing, if pyBigWig is not available.
+        """
+        try:
+            import pyBigWig
+        except ImportError:
+            return False
+
+        total_tags = sum([len(chrom_cut_sites) for chrom_cut_sites in cut_sites.values()])
+        scale = 1e6 / total_tags if total_tags else 0.0
+        chroms = sorted(genome_sizes)
+
+        bigwig = pyBigWig.open(bigwig_filepath, 'w')
+        bigwig.addHeader([(chrom, genome_sizes[chrom]) for chrom in chroms])
+        for chrom in chroms:
+            if chrom not in cut_sites or len(cut_sites[chrom]) == 0:
+                continue
+            positions, counts = np.unique(cut_sites[chrom], return_counts=True)
+            run_starts = np.flatnonzero(np.concatenate([[True], (np.diff(positions) != 1) |
+                                                        (np.diff(counts) != 0)]))
+            run_ends = np.append(run_starts[1:], len(positions)) - 1
+            bigwig.addEntries([chrom] * len(run_starts), positions[run_starts].tolist(),
+                              ends=(positions[run_ends] + 1).tolist(),
+                              values=(counts[run_starts] * scale).tolist())
+        bigwig.close()
+        return True
+
+    @staticmethod
+    def poisson_tail(k, expected):
+        """Probability of at least k events for a Poisson rate, elementwise over arrays."""
+        k = np.asarray(k, dtype=np.float64)
+        expected = np.asarray(expected, dtype=np.float64) * np.ones(k.shape)
+        log_gamma = np.array([math.lgamma(value + 1) for value in k.ravel()]).reshape(k.shape)
+        term = np.exp(k * np.log(expected) - expected - log_gamma)
+        tail = term.copy()
+        for i in range(1, 1000):
+            term = term * expected / (k + i)
+            tail += term
+            if not np.any(term > tail * 1e-12):
+                break
+        return np.minimum(tail, 1.0)
+
+    @staticmethod
+    def call_peaks(cut_sites, genome_sizes, output_bed_filepath, log_filepath, processes):
+        """
+        Calls peaks from cut sites as HOMER findPeaks -style dnase does, by chromosome
+        across a process pool, and writes them merged. Returns the number of merged peaks.
+        """
+        chromosomes = [(chrom, chrom_cut_sites) for chrom, chrom_cut_sites in sorted(cut_sites.items())
+                       if chrom in genome_sizes]
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                candidates = pool.map(call_peaks_chromosome, chromosomes, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            candidates = [call_peaks_chromosome(chromosome) for chromosome in chromosomes]
+
+        # Global threshold from the tags expected per window over the chromosomes with tags
+        total_tags = sum([num_tags for _, num_tags, _, _, _ in candidates])
+        genome_size = sum([genome_sizes[chrom] for chrom, _ in chromosomes])
+        expected_tags = total_tags * PEAK_SIZE / float(genome_size) if genome_size else 0.0
+        all_tag_counts = np.concatenate([tag_counts for _, _, _, tag_counts, _ in candidates] +
+                                        [np.zeros(0, dtype=np.int64)])
+        num_candidates_at = np.cumsum(np.bincount(all_tag_counts)[::-1])[::-1]
+        thresholds = np.arange(PEAK_MIN_TAGS, len(num_candidates_at))
+        expected_peaks = genome_size / float(PEAK_SIZE) * Pipeline.poisson_tail(thresholds, expected_tags)
+        passing = np.flatnonzero(expected_peaks <= PEAK_FDR * num_candidates_at[thresholds])
+        min_tags = int(thresholds[passing[0]]) if len(passing) else len(num_candidates_at)
+
+        num_peaks = {'candidates': len(all_tag_counts), 'fdr': 0, 'local': 0, 'merged': 0}
+        with open(output_bed_filepath, 'w') as output_bed:
+            for chrom, _, centers, tag_counts, local_tag_counts in candidates:
+                keep = tag_counts >= min_tags
+                num_peaks['fdr'] += int(keep.sum())
+                centers, tag_counts = centers[keep], tag_counts[keep]
+                local_expected = local_tag_counts[keep] * PEAK_SIZE / float(PEAK_LOCAL_SIZE)
+                keep = tag_counts >= PEAK_LOCAL_FOLD * local_expected
+                keep[keep] = Pipeline.poisson_tail(tag_counts[keep], local_expected[keep]) <= PEAK_LOCAL_PVALUE
+                num_peaks['local'] += int(keep.sum())
+                if not keep.any():
                     continue
-                if not within_genome_boundry(chrom, new_end, genome_sizes):
-                    to_log('Shift end site beyond chromosome boundry:', log_filepath)
-                    to_log(line.strip(), log_filepath)
+
+                # Overlapping and book-ended peaks are merged
+                starts = np.maximum(centers[keep] - PEAK_SIZE // 2, 0)
+                ends = np.minimum(centers[keep] + PEAK_SIZE // 2, genome_sizes[chrom])
+                new_peak = np.concatenate([[True], starts[1:] > np.maximum.accumulate(ends)[:-1]])
+                peak_indices = np.flatnonzero(new_peak)
+                merged_starts = starts[peak_indices]
+                merged_ends = np.maximum.reduceat(ends, peak_indices)
+                num_peaks['merged'] += len(peak_indices)
+                output_bed.write(''.join(['{}\t{}\t{}\n'.format(chrom, start, end) for start, end
+                                          in zip(merged_starts.tolist(), merged_ends.tolist())]))
+
+        with open(log_filepath, 'w') as log_file:
+            log_file.write('total_tags\t{}\n'.format(total_tags))
+            log_file.write('genome_size\t{}\n'.format(genome_size))
+            log_file.write('expected_tags_per_peak\t{}\n'.format(Pipeline.format_metric(expected_tags)))
+            log_file.write('fdr_tag_threshold\t{}\n'.format(min_tags))
+            log_file.write('candidate_peaks\t{}\n'.format(num_peaks['candidates']))
+            log_file.write('peaks_passing_fdr\t{}\n'.format(num_peaks['fdr']))
+            log_file.write('peaks_passing_local_filter\t{}\n'.format(num_peaks['local']))
+            log_file.write('merged_peaks\t{}\n'.format(num_peaks['merged']))
+
+        return num_peaks['merged']
+
+    @staticmethod
+    def load_peak_index(peaks_bed_filepath):
+        """
+        Reads a sorted, merged peaks BED into sorted arrays of peak starts and ends per
+        chromosome.
+        """
+        peaks = {}
+        with open(peaks_bed_filepath) as peaks_bed:
+            for line in peaks_bed:
+                chrom, start, end = line.strip().split('\t')[:3]
+                chrom_peaks = peaks.setdefault(chrom, ([], []))
+                chrom_peaks[0].append(int(start))
+                chrom_peaks[1].append(int(end))
+        return dict((chrom, (np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)))
+                    for chrom, (starts, ends) in peaks.items())
+
+    @staticmethod
+    def count_reads_in_peaks(bed_filepath, peak_index):
+        """
+        Counts the records of a BED overlapping any peak, like bedtools intersect -u.
+        Returns the number of records and of those in peaks.
+        """
+        num_reads, num_reads_in_peaks = 0, 0
+        with open(bed_filepath) as bed:
+            while True:
+                lines = bed.readlines(SHIFT_READS_CHUNK_SIZE)
+                if not lines:
+                    break
+                num_reads += len(lines)
+
+                records = [line.split('\t', 3) for line in lines]
+                chroms = np.array([record[0] for record in records])
+                starts = np.array([record[1] for record in records], dtype=np.int64)
+                ends = np.array([record[2] for record in records], dtype=np.int64)
+
+                block_chroms, chrom_indices = np.unique(chroms, return_inverse=True)
+                for i, chrom in enumerate(block_chroms.tolist()):
+                    if chrom not in peak_index:
+                        continue
+                    peak_starts, peak_ends = peak_index[chrom]
+                    in_chrom = chrom_indices == i
+                    nearest = np.searchsorted(peak_ends, starts[in_chrom], side='right')
+                    has_peak = nearest < len(peak_starts)
+                    num_reads_in_peaks += int(np.count_nonzero(
+                        peak_starts[nearest[has_peak]] < ends[in_chrom][has_peak]
+                    ))
+
+        return num_reads, num_reads_in_peaks
+
+    @staticmethod
+    def load_tss(tss_filepath):
+        """
+        Reads TSS from a BED or the transcripts of a GTF, either may be gzipped. Returns
+        sorted TSS positions and whether each is on the - strand, per chromosome.
+        """
+        is_gtf = re.search(r'\.gtf(\.gz)?$', tss_filepath) is not None
+        tss = {}
+        tss_file = gzip.open(tss_filepath, 'rt') if tss_filepath.endswith('.gz') else open(tss_filepath)
+        with tss_file:
+            for line in tss_file:
+                if line[FIRST_CHAR] == '#' or line.startswith('track') or not line.strip():
                     continue
+                record = line.rstrip('\n').split('\t')
+                if is_gtf:
+                    if record[2] != 'transcript':
+                        continue
+                    chrom, start, end, strand = record[0], int(record[3]) - 1, int(record[4]), record[6]
+                else:
+                    chrom, start, end = record[0], int(record[1]), int(record[2])
+                    strand = record[5] if len(record) > 5 else '+'
+                is_minus = strand == '-'
+                tss.setdefault(chrom, set()).add((end - 1 if is_minus else start, is_minus))
+
+        tss_arrays = {}
+        for chrom, chrom_tss in tss.items():
+            chrom_tss = sorted(chrom_tss)
+            tss_arrays[chrom] = (np.array([position for position, _ in chrom_tss], dtype=np.int64),
+                                 np.array([is_minus for _, is_minus in chrom_tss], dtype=bool))
+        return tss_arrays
 
-                output_bed.write('\t'.join([chrom, str(new_start), str(new_end)] + record[3:]) + '\n')
+    @staticmethod
+    def tss_profile(cut_sites, tss):
+        """
+        Sums the cut sites at every offset within TSS_WINDOW of each TSS, in the direction
+        of transcription, with the TSS at index TSS_WINDOW.
+        """
+        profile = np.zeros(2 * TSS_WINDOW + 1, dtype=np.int64)
+        for chrom, (positions, is_minus) in tss.items():
+            if chrom not in cut_sites:
+                continue
+            chrom_cut_sites = cut_sites[chrom]
+            first = np.searchsorted(chrom_cut_sites, positions - TSS_WINDOW)
+            last = np.searchsorted(chrom_cut_sites, positions + TSS_WINDOW, side='right')
+            num_near = last - first
+            if num_near.sum() == 0:
+                continue
+
+            # Pair every TSS with each cut site in its window, all at once
+            tss_indices = np.repeat(np.arange(len(positions)), num_near)
+            cut_site_indices = (np.arange(num_near.sum()) -
+                                np.repeat(np.cumsum(num_near) - num_near - first, num_near))
+            offsets = chrom_cut_sites[cut_site_indices] - positions[tss_indices]
+            offsets[is_minus[tss_indices]] *= -1
+            profile += np.bincount(offsets + TSS_WINDOW, minlength=len(profile))
+        return profile
 
-        output_bed.flush()
-        output_bed.close()
+    @staticmethod
+    def write_tss_enrichment(profile, profile_filepath):
+        """
+        Normalizes a TSS profile by the mean of its flanks and writes it out. Returns the
+        TSS enrichment score, the highest value of the smoothed normalized profile.
+        """
+        flank_mean = np.concatenate([profile[:TSS_FLANK_SIZE], profile[-TSS_FLANK_SIZE:]]).mean()
+        normalized = profile / flank_mean if flank_mean > 0 else np.zeros(len(profile))
+        smoothed = np.convolve(normalized, np.ones(TSS_SMOOTHING_WINDOW) / TSS_SMOOTHING_WINDOW, mode='same')
+
+        with open(profile_filepath, 'w') as profile_file:
+            profile_file.write('offset\tcut_sites\tnormalized\tsmoothed\n')
+            for offset, cut_site_count, normalized_count, smoothed_count in zip(
+                    range(-TSS_WINDOW, TSS_WINDOW + 1), profile.tolist(), normalized.tolist(), smoothed.tolist()):
+                profile_file.write('{}\t{}\t{}\t{}\n'.format(offset, cut_site_count,
+                                                              Pipeline.format_metric(normalized_count),
+                                                              Pipeline.format_metric(smoothed_count)))
+        return float(smoothed.max())
 
     def run_pipeline(self, pipeline_args, pipeline_config):
         # Instantiate variables from argparse
@@ -138,6 +1766,17 @@ class Pipeline(BasePipeline):
         step = int(pipeline_args['step'])
         forward_adapter = pipeline_args['forward_adapter']
         reverse_adapter = pipeline_args['reverse_adapter']
+        filter_processes = pipeline_args['filter_processes']
+        peak_processes = pipeline_args['peak_processes']
+        pair_processes = pipeline_args['pair_processes']
+        tss_filepath = pipeline_args['tss']
+        write_fragment_classes = pipeline_args['fragment_classes']
+        aligner = pipeline_args['aligner']
+        external_fastqc = pipeline_args['external_fastqc']
+        trim_cores = pipeline_args['trim_cores']
+        trimmed_output = pipeline_args['trimmed_output']
+        trimmer = pipeline_args['trimmer']
+        preview = pipeline_args['preview']
 
         # Create output, tmp, and logs directories
         tmp_dir = os.path.join(output_dir, 'tmp')
@@ -146,192 +1785,325 @@ class Pipeline(BasePipeline):
         # Keep list of items to delete
         staging_delete = [tmp_dir]
         bwa_bam_outs = []
+
+        # Preview: Run on the read pairs a hash of their names picks, subsampled into tmp
+        preview_read_counts = None
+        if preview is not None and step <= 1:
+            read_pairs, preview_read_counts = subsample_reads(read_pairs, tmp_dir, preview, trim_cores)
+        insert_size_collector = None
         qc_data = {
             'total_raw_reads_counts': [],
+            'total_raw_bases_counts': [],
+            'raw_mates_consistent': [],
             'trimmed_reads_counts': [],
             # TODO Find a better way to store FastQC results
             'num_reads_mapped': [],
+            'aligner': aligner,
+            'alignment_wall_time_seconds': [],
             'percent_duplicate_reads': '0',
-            'num_unique_reads_mapped': [],  # TODO This isn't implemented
-            'num_mtDNA_reads_mapped': [],  # TODO This isn't implemented
-            'num_reads_mapped_after_filtering': '-1',  # TODO This isn't implemented
+            'num_unique_reads_mapped': '-1',
+            'num_mtDNA_reads_mapped': '-1',
+            'num_reads_mapped_after_filtering': '-1',
             'num_peaks_called': '-1',
+            'frip': '-1',
+            'tss_enrichment': '-1',
+            'cut_site_bigwig': '-1',
             # TODO Get number of peaks in annotation sites
         }
 
         # Instantiate software instances
         cutadapt = Software('cutadapt', pipeline_config['cutadapt']['path'])
+        cutadapt_json = step <= 1 and cutadapt_writes_json(pipeline_config['cutadapt']['path'])
         fastqc = Software('FastQC', pipeline_config['fastqc']['path'])
         bwa_aln = Software('BWA aln', pipeline_config['bwa']['path'] + ' aln')
         bwa_sampe = Software('BWA sampe', pipeline_config['bwa']['path'] + ' sampe')
-        samtools_view = Software('samtools view',
-                                 pipeline_config['samtools']['path'] + ' view')
-        samtools_flagstat = Software('samtools flagstat',
-                                     pipeline_config['samtools']['path'] + ' flagstat')
+        bwa_mem = Software('BWA mem', pipeline_config['bwa']['path'] + ' mem')
+        samtools_merge = Software('samtools merge',
+                                  pipeline_config['samtools']['path'] + ' merge')
         samtools_index = Software('samtools index',
                                   pipeline_config['samtools']['path'] + ' index')
-        novosort = Software('novosort', pipeline_config['novosort']['path'])
-        picard_mark_dup = Software('Picard MarkDuplicates',
-                                   pipeline_config['picard']['path'] + ' MarkDuplicates')
-        picard_insert_metrics = Software('Picard CollectInsertSizeMetrics',
-                                         pipeline_config['picard']['path'] + ' CollectInsertSizeMetrics')
-        bedtools_bamtobed = Software('bedtools bamtobed',
-                            pipeline_config['bedtools']['path'] + ' bamtobed')
-        bedtools_sort = Software('bedtools sort', pipeline_config['bedtools']['path'] + ' sort')
-        bedtools_merge = Software('bedtools merge', pipeline_config['bedtools']['path'] + ' merge')
-        bedtools_intersect = Software('bedtools intersect',
-                                      pipeline_config['bedtools']['path'] + ' intersect')
-        homer_maketagdir = Software('HOMER makeTagDirectory',
-                                    pipeline_config['makeTagDirectory']['path'])
-        homer_findpeaks = Software('HOMER findPeaks', pipeline_config['findPeaks']['path'])
-        homer_pos2bed = Software('HOMER pos2bed', pipeline_config['pos2bed']['path'])
-
-        if step <= 1:
-            for i, read_pair in enumerate(read_pairs):
-                read1, read2 = read_pair.split(':')
-
-                # QC: Get raw fastq read counts
-                qc_data['total_raw_reads_counts'].append([
-                    str(int(self.count_gzipped_lines(read1))/4),
-                    str(int(self.count_gzipped_lines(read2))/4)
-                ])
-
-                trimmed_read1_filename = os.path.join(output_dir,
-                                                      lib_prefix + '_{}_read1.trimmed.fastq.gz'.format(i))
-                trimmed_read2_filename = os.path.join(output_dir,
-                                                      lib_prefix + '_{}_read2.trimmed.fastq.gz'.format(i))
-
-                cutadapt.run(
-                    Parameter('--quality-base=33'),
-                    Parameter('--minimum-length=5'),
-                    Parameter('-q', '30'),  # Minimum quality score
-                    Parameter('--output={}'.format(trimmed_read1_filename)),
-                    Parameter('--paired-output={}'.format(trimmed_read2_filename)),
-                    Parameter('-a', forward_adapter if forward_adapter else 'ZZZ'),
-                    Parameter('-A', reverse_adapter if reverse_adapter else 'ZZZ'),
-                    Parameter(read1),
-                    Parameter(read2),
-                    Redirect(stream=Redirect.STDOUT, dest=os.path.join(logs_dir, 'cutadapt.summary.log'))
-                )
-
-                # QC: Get trimmed fastq read counts
-                qc_data['trimmed_reads_counts'].append([
-                    str(int(self.count_gzipped_lines(trimmed_read1_filename))/4),
-                    str(int(self.count_gzipped_lines(trimmed_read2_filename))/4)
-                ])
-
-                staging_delete.extend([trimmed_read1_filename, trimmed_read2_filename])
-                read_pairs[i] = ':'.join([trimmed_read1_filename, trimmed_read2_filename])
 
+        # Split the bwa threads between the read pairs run at once and, when more than
+        # one is, between the mates of each pair, which are then aligned together. The
+        # cutadapt cores are split between the pairs the same way
+        bwa_threads = int(pipeline_config['bwa']['threads'])
+        concurrent_pairs = max(1, min(pair_processes, len(read_pairs), bwa_threads))
+        aln_threads = max(1, bwa_threads // (2 * concurrent_pairs)) if pair_processes > 1 else bwa_threads
+        mem_threads = max(1, bwa_threads // concurrent_pairs)
+        pair_trim_cores = max(1, trim_cores // concurrent_pairs)
+        sort_threads = max(1, int(pipeline_config['samtools'].get('threads', '1')) // concurrent_pairs)
+
+        fastqc_output_dir = os.path.join(output_dir, 'fastqc')
         if step <= 2:
             # Make FastQC directory
-            fastqc_output_dir = os.path.join(output_dir, 'fastqc')
             subprocess.call(['mkdir', '-p', fastqc_output_dir])
-            for i, read_pair in enumerate(read_pairs):
-                for read in read_pair.split(':'):
-                    fastqc.run(
-                        Parameter('--outdir={}'.format(fastqc_output_dir)),
-                        Parameter(read)
+
+        def run_read_pair(i):
+            """
+            Runs steps 1 to 3 on one read pair. Returns the pair's QC counts, its
+            temporary files, and its sorted BAM.
+            """
+            read1, read2 = read_pairs[i].split(':')
+            pair_qc_data = {}
+            pair_staging_delete = []
+            bwa_sorted_bams = []
+            alignment_wall_time = 0.0
+
+            if step <= 1:
+                trimmed_read1_filename = trimmed_fastq_filepath(
+                    os.path.join(output_dir, lib_prefix + '_{}_read1.trimmed'.format(i)), trimmed_output)
+                trimmed_read2_filename = trimmed_fastq_filepath(
+                    os.path.join(output_dir, lib_prefix + '_{}_read2.trimmed'.format(i)), trimmed_output)
+                cutadapt_summary = os.path.join(logs_dir, 'cutadapt.{}.summary.log'.format(i))
+
+                if trimmer == 'builtin':
+                    trim_reads([[read1], [read2]], [trimmed_read1_filename, trimmed_read2_filename],
+                               [forward_adapter, reverse_adapter], 30, 33, 5, pair_trim_cores,
+                               trimmed_compression_level(trimmed_output), cutadapt_summary)
+                else:
+                    cutadapt.run(
+                        Parameter('--quality-base=33'),
+                        Parameter('--minimum-length=5'),
+                        Parameter('-q', '30'),  # Minimum quality score
+                        Parameter('--output={}'.format(trimmed_read1_filename)),
+                        Parameter('--paired-output={}'.format(trimmed_read2_filename)),
+                        Parameter('-a', forward_adapter if forward_adapter else 'ZZZ'),
+                        Parameter('-A', reverse_adapter if reverse_adapter else 'ZZZ'),
+                        Parameter(*cutadapt_report_args(cutadapt_summary, cutadapt_json)),
+                        Parameter(*cutadapt_trimming_args(pipeline_config['cutadapt']['path'], pair_trim_cores,
+                                                          trimmed_output)),
+                        Parameter(read1),
+                        Parameter(read2),
+                        Redirect(stream=Redirect.STDOUT, dest=cutadapt_summary)
                     )
 
+                # QC: Get raw and trimmed fastq read counts from the cutadapt report, or by
+                # reading the fastqs if it can't be read. cutadapt fails on unpaired mates.
+                cutadapt_report = read_cutadapt_report(cutadapt_summary)
+                if cutadapt_report is not None:
+                    pair_qc_data['total_raw_reads_counts'] = [str(cutadapt_report['reads_processed'])] * 2
+                    pair_qc_data['total_raw_bases_counts'] = [str(bases)
+                                                              for bases in cutadapt_report['bases_processed']]
+                    pair_qc_data['raw_mates_consistent'] = str(True)
+                    pair_qc_data['trimmed_reads_counts'] = [str(cutadapt_report['reads_written'])] * 2
+                else:
+                    read1_stats, read2_stats, mates_consistent = fastq_pair_stats(read1, read2)
+                    pair_qc_data['total_raw_reads_counts'] = [str(read1_stats['reads']),
+                                                              str(read2_stats['reads'])]
+                    pair_qc_data['total_raw_bases_counts'] = [str(read1_stats['bases']),
+                                                              str(read2_stats['bases'])]
+                    pair_qc_data['raw_mates_consistent'] = str(mates_consistent)
+                    pair_qc_data['trimmed_reads_counts'] = [
+                        str(int(self.count_gzipped_lines(trimmed_read1_filename))/4),
+                        str(int(self.count_gzipped_lines(trimmed_read2_filename))/4)
+                    ]
+
+                pair_staging_delete.extend([trimmed_read1_filename, trimmed_read2_filename])
+                read1, read2 = trimmed_read1_filename, trimmed_read2_filename
+
+            if step <= 2:
+                for read in [read1, read2]:
+                    if external_fastqc:
+                        fastqc.run(
+                            Parameter('--outdir={}'.format(fastqc_output_dir)),
+                            Parameter(read)
+                        )
+                    else:
+                        store_fastq_stats(read, run_fastq_qc(read, fastqc_output_dir))
+
+                def run_bwa_aln(read):
                     bwa_aln.run(
-                        Parameter('-t', pipeline_config['bwa']['threads']),
+                        Parameter('-t', aln_threads),
                         Parameter(pipeline_config['bwa']['index-dir']),
                         Parameter(read),
                         Redirect(stream=Redirect.STDOUT, dest='{}.sai'.format(read))
                     )
 
-                    staging_delete.append('{}.sai'.format(read))
-
-        if step <= 3:
-            for i, read_pair in enumerate(read_pairs):
-                read1, read2 = read_pair.split(':')
-                bwa_bam_output = os.path.join(output_dir, '{}.{}.bam'.format(lib_prefix, i))
-
-                bwa_sampe.run(
-                    Parameter('-a', '2000'),  # Maximum insert size
-                    Parameter('-n', '1'),
-                    Parameter(pipeline_config['bwa']['index-dir']),
-                    Parameter('{}.sai'.format(read1)),
-                    Parameter('{}.sai'.format(read2)),
-                    Parameter(read1),
-                    Parameter(read2),
-                    Redirect(stream=Redirect.STDERR, dest=os.path.join(logs_dir, 'bwa_sampe.log')),
-                    Pipe(
-                        samtools_view.pipe(
-                            Parameter('-hSb'),
-                            Parameter('-o', bwa_bam_output),
-                            Parameter('-')  # Get input from stdin
+                # bwa mem aligns both mates at once in step 3
+                if aligner == 'aln':
+                    aln_start = time.time()
+                    if pair_processes > 1:
+                        aln_pool = multiprocessing.pool.ThreadPool(2)
+                        aln_pool.map(run_bwa_aln, [read1, read2])
+                        aln_pool.close()
+                        aln_pool.join()
+                    else:
+                        for read in [read1, read2]:
+                            run_bwa_aln(read)
+                    alignment_wall_time += time.time() - aln_start
+
+                    pair_staging_delete.extend(['{}.sai'.format(read1), '{}.sai'.format(read2)])
+
+            if step <= 3:
+                bwa_sam_fifo = os.path.join(tmp_dir, '{}.{}.sam'.format(lib_prefix, i))
+                bwa_bam_prefix = os.path.join(output_dir, '{}.{}'.format(lib_prefix, i))
+
+                # Sort and count alignments as bwa sampe or mem writes them, waiting on the
+                # processes doing so from another thread while the aligner runs on this one
+                if os.path.exists(bwa_sam_fifo):
+                    os.remove(bwa_sam_fifo)
+                os.mkfifo(bwa_sam_fifo)
+                sink_pool = multiprocessing.pool.ThreadPool(1)
+                sink = sink_pool.apply_async(self.sort_alignments, (pipeline_config['samtools']['path'],
+                                                                    bwa_sam_fifo, bwa_bam_prefix, sort_threads))
+                try:
+                    align_start = time.time()
+                    if aligner == 'mem':
+                        bwa_mem.run(
+                            Parameter('-t', mem_threads),
+                            Parameter('-M'),  # Mark split hits secondary, so the unique filter drops them
+                            Parameter(pipeline_config['bwa']['index-dir']),
+                            Parameter(read1),
+                            Parameter(read2),
+                            Redirect(stream=Redirect.STDERR, dest=os.path.join(logs_dir, 'bwa_mem.{}.log'.format(i))),
+                            Redirect(stream=Redirect.STDOUT, dest=bwa_sam_fifo)
+                        )
+                    else:
+                        bwa_sampe.run(
+                            Parameter('-a', '2000'),  # Maximum insert size
+                            Parameter('-n', '1'),
+                            Parameter(pipeline_config['bwa']['index-dir']),
+                            Parameter('{}.sai'.format(read1)),
+                            Parameter('{}.sai'.format(read2)),
+                            Parameter(read1),
+                            Parameter(read2),
+                            Redirect(stream=Redirect.STDERR, dest=os.path.join(logs_dir, 'bwa_sampe.{}.log'.format(i))),
+                            Redirect(stream=Redirect.STDOUT, dest=bwa_sam_fifo)
                         )
-                    )
-                )
-
-                bwa_bam_outs.append(bwa_bam_output)
 
-        if step <= 4:
-            for i, bwa_bam in enumerate(bwa_bam_outs):
-                samtools_flagstat.run(
-                    Parameter(bwa_bam),
-                    Redirect(stream=Redirect.STDOUT, dest=bwa_bam + '.flagstat')
-                )
+                    num_reads_mapped = sink.get()
+                finally:
+                    # If bwa never opened the fifo, samtools waits on it for reads forever, so
+                    # it's opened and closed until the sort is done, once samtools has opened it
+                    while not sink.ready():
+                        try:
+                            os.close(os.open(bwa_sam_fifo, os.O_WRONLY | os.O_NONBLOCK))
+                        except OSError:
+                            pass
+                        sink.wait(FIFO_POLL_INTERVAL)
+                    sink_pool.close()
+                    sink_pool.join()
+                    os.remove(bwa_sam_fifo)
+                bwa_sorted_bams = [bwa_bam_prefix + '.sorted.bam']
+                alignment_wall_time += time.time() - align_start
+
+                # QC: Get number of mapped reads from this pair's alignments
+                pair_qc_data['num_reads_mapped'] = str(num_reads_mapped // 2)
+
+                # QC: Get wall time spent aligning this pair, including sorting its alignments
+                pair_qc_data['alignment_wall_time_seconds'] = '{:.1f}'.format(alignment_wall_time)
+
+            return pair_qc_data, pair_staging_delete, bwa_sorted_bams
 
-                # QC: Get number of mapped reads from this BAM
-                try:
-                    with open(bwa_bam + '.flagstat') as flagstats:
-                        flagstats_contents = flagstats.read()
-                        target_line = re.search(r'(\d+) \+ \d+ mapped', flagstats_contents)
-                        if target_line is not None:
-                            qc_data['num_reads_mapped'].append(str(int(target_line.group(1))/2))
-                        else:
-                            qc_data['num_reads_mapped'].append('0')
-                except:
-                    qc_data['num_reads_mapped'].append('Could not open flagstats {}'.format(
-                        bwa_bam + '.flagstat'
-                    ))
+        if step <= 3:
+            # Independent read pairs progress through steps 1 to 3 at the same time, but
+            # their results are gathered in the order the pairs were given. Each runs in a
+            # process of its own, so no pair's tools inherit another pair's bwa SAM fifo
+            if concurrent_pairs > 1:
+                read_pair_results = map_forked(run_read_pair, list(range(len(read_pairs))), concurrent_pairs)
+            else:
+                read_pair_results = [run_read_pair(i) for i in range(len(read_pairs))]
+
+            for pair_qc_data, pair_staging_delete, bwa_sorted_bams in read_pair_results:
+                for qc_key in ['total_raw_reads_counts', 'total_raw_bases_counts', 'raw_mates_consistent',
+                               'trimmed_reads_counts', 'num_reads_mapped', 'alignment_wall_time_seconds']:
+                    if qc_key in pair_qc_data:
+                        qc_data[qc_key].append(pair_qc_data[qc_key])
+                staging_delete.extend(pair_staging_delete)
+                bwa_bam_outs.extend(bwa_sorted_bams)
 
+        if step <= 4:
             sortmerged_bam = os.path.join(output_dir, '{}.sortmerged.bam'.format(lib_prefix))
-            steric_filter_bam = os.path.join(output_dir, '{}.steric.bam'.format(lib_prefix))
-            duprm_bam = os.path.join(output_dir, '{}.duprm.bam'.format(lib_prefix))
-            unique_bam = os.path.join(output_dir, '{}.unique.bam'.format(lib_prefix))
-            unmappedrm_bam = os.path.join(output_dir, '{}.unmappedrm.bam'.format(lib_prefix))
-            chrmrm_bam = os.path.join(output_dir, '{}.chrmrm.bam'.format(lib_prefix))
-
-            novosort.run(
-                Parameter('--threads', pipeline_config['novosort']['threads']),
-                Parameter('--tmpcompression', '6'),
-                Parameter('--tmpdir', tmp_dir),
-                Parameter(*[bam for bam in bwa_bam_outs]),
-                Redirect(stream=Redirect.STDOUT, dest=sortmerged_bam),
-                Redirect(stream=Redirect.STDERR, dest=os.path.join(logs_dir, 'novosort.log'))
+            processed_bam = os.path.join(output_dir, '{}.processed.bam'.format(lib_prefix))
+
+            # The sorted BAMs of every read pair only need to be merged
+            samtools_merge.run(
+                Parameter('-f', '-c', '-p'),
+                Parameter('-@', pipeline_config['samtools'].get('threads', '1')),
+                Parameter(sortmerged_bam),
+                Parameter(*bwa_bam_outs),
+                Redirect(stream=Redirect.BOTH, dest=os.path.join(logs_dir, 'samtools_merge.log'))
             )
 
             # This creates a dependency on PySam
-            # Removes reads with template length < 38 due to steric hindrence
-            samtools_index.run(Parameter(sortmerged_bam))
-            sortmerged_bam_alignmentfile = pysam.AlignmentFile(sortmerged_bam, 'rb')
-            steric_filter_bam_alignmentfile = pysam.AlignmentFile(steric_filter_bam, 'wb',
-                                                                  template=sortmerged_bam_alignmentfile)
-            for read in sortmerged_bam_alignmentfile.fetch():
-                if abs(int(read.template_length)) >= STERIC_HINDRANCE_CUTOFF:
-                    steric_filter_bam_alignmentfile.write(read)
-
-            sortmerged_bam_alignmentfile.close()
-            steric_filter_bam_alignmentfile.close()
-
-            # Mark and remove duplicates
-            markduplicates_metrics_filepath = os.path.join(logs_dir,
-                                                           'mark_dup.metrics')
-            picard_mark_dup.run(
-                Parameter('INPUT={}'.format(steric_filter_bam)),
-                Parameter('OUTPUT={}'.format(duprm_bam)),
-                Parameter('TMP_DIR={}'.format(tmp_dir)),
-                Parameter('METRICS_FILE={}'.format(markduplicates_metrics_filepath)),
-                Parameter('REMOVE_DUPLICATES=true'),
-                Parameter('VALIDATION_STRINGENCY=LENIENT'),
-                Redirect(stream=Redirect.BOTH, dest=os.path.join(logs_dir, 'mark_dup.log'))
+            # Removes reads with template length < 38 due to steric hindrence, removes
+            # duplicates, then filters down to uniquely mapped reads, removes unmapped reads,
+            # removes chrM, and removes blacklisted genomic regions, all in one pass over the BAM
+            with pysam.AlignmentFile(sortmerged_bam, 'rb') as sortmerged:
+                read_group_libraries = dict((read_group['ID'], read_group.get('LB', UNKNOWN_LIBRARY))
+                                            for read_group in sortmerged.header.to_dict().get('RG', []))
+            duplicate_filter = DuplicateFilter('duplicates', libraries=read_group_libraries)
+            unique_filter = FlagFilter('unique', exclude_flags=UNIQUE_EXCLUDE_FLAGS,
+                                       min_mapq=UNIQUE_MIN_MAPQ)
+            chromosome_filter = ReferenceFilter('chromosome', references=KEPT_CHROMOSOMES)
+            read_filters = [
+                TemplateLengthFilter('steric', min_length=STERIC_HINDRANCE_CUTOFF),
+                duplicate_filter,
+                unique_filter,
+                FlagFilter('unmapped', exclude_flags=UNMAPPED_EXCLUDE_FLAGS),
+                chromosome_filter,
+                BlacklistFilter('blacklist',
+                                index=self.load_blacklist_index(pipeline_config['bedtools']['blacklist-bed']),
+                                min_overlap_fraction=BLACKLIST_MIN_OVERLAP_FRACTION)
+            ]
+
+            # QC: Collect the insert size histogram from reads that pass every filter
+            insert_size_collector = InsertSizeCollector('insert_size')
+            collectors = [insert_size_collector]
+
+            # Split the reads that pass every filter by fragment class in the same pass
+            fragment_class_writer = None
+            if write_fragment_classes:
+                with pysam.AlignmentFile(sortmerged_bam, 'rb') as sortmerged:
+                    fragment_class_writer = FragmentClassWriter('fragment_classes',
+                                                                output_prefix=processed_bam[:-len('.bam')],
+                                                                header=sortmerged.header.to_dict())
+                collectors.append(fragment_class_writer)
+
+            if filter_processes > 1:
+                num_reads_in, num_reads_out = self.filter_alignments_parallel(
+                    input_bam_filepath=sortmerged_bam,
+                    output_bam_filepath=processed_bam,
+                    read_filters=read_filters + collectors,
+                    processes=filter_processes,
+                    tmp_dir=tmp_dir
+                )
+            else:
+                num_reads_in, num_reads_out = self.filter_alignments(
+                    input_bam_filepath=sortmerged_bam,
+                    output_bam_filepath=processed_bam,
+                    read_filters=read_filters + collectors
+                )
+
+            # QC: Get number of reads in each fragment class
+            if fragment_class_writer is not None:
+                with open(os.path.join(logs_dir, 'fragment_classes.log'), 'w') as classes_log:
+                    classes_log.write('fragment_class\tmin_length\tmax_length\treads\n')
+                    for (class_name, min_length, max_length), written in zip(FRAGMENT_CLASSES,
+                                                                            fragment_class_writer.written):
+                        classes_log.write('{}\t{}\t{}\t{}\n'.format(class_name, min_length, max_length,
+                                                                   written))
+
+            # QC: Get number of reads dropped by each filter
+            with open(os.path.join(logs_dir, 'alignment_filters.log'), 'w') as filters_log:
+                filters_log.write('filter\treads_dropped\treads_remaining\n')
+                num_remaining = num_reads_in
+                for read_filter in read_filters:
+                    num_remaining -= read_filter.dropped
+                    filters_log.write('{}\t{}\t{}\n'.format(read_filter.name, read_filter.dropped,
+                                                           num_remaining))
+                    if read_filter is unique_filter:
+                        qc_data['num_unique_reads_mapped'] = str(num_remaining)
+            qc_data['num_mtDNA_reads_mapped'] = str(
+                chromosome_filter.dropped_per_reference.get(MITOCHONDRIAL_CHROMOSOME, 0)
             )
+            qc_data['num_reads_mapped_after_filtering'] = str(num_reads_out)
 
             # QC: Get percent duplicates
+            markduplicates_metrics_filepath = os.path.join(logs_dir,
+                                                           'mark_dup.metrics')
+            self.write_duplication_metrics(duplicate_filter, markduplicates_metrics_filepath,
+                                           input_bam_filepath=sortmerged_bam)
             try:
                 with open(markduplicates_metrics_filepath) as markdup_metrics:
                     for line in markdup_metrics:
@@ -344,74 +2116,33 @@ class Pipeline(BasePipeline):
             except:
                 qc_data['percent_duplicate_reads'] = 'Could not open MarkDuplicates metrics'
 
-            # Filter down to uniquely mapped reads
-            samtools_view.run(
-                Parameter('-b'),
-                Parameter('-F', '256'),
-                Parameter('-q', '10'),
-                Parameter('-o', unique_bam),
-                Parameter(duprm_bam)
-            )
-
-            # Remove unmapped reads
-            samtools_view.run(
-                Parameter('-b'),
-                Parameter('-F', '12'),
-                Parameter('-o', unmappedrm_bam),
-                Parameter(unique_bam)
-            )
-
-            # Create BAM index, then remove chrM
-            samtools_index.run(
-                Parameter(unmappedrm_bam)
-            )
-
-            # Remove chrM
-            all_chr = [Parameter('chr{}'.format(chromosome)) for chromosome in map(str, range(1, 23)) + ['X', 'Y']]
-            samtools_view.run(
-                Parameter('-b'),
-                Parameter('-o', chrmrm_bam),
-                Parameter(unmappedrm_bam),
-                *all_chr
-            )
-
             # Stage delete for temporary files
+            staging_delete.extend(bwa_bam_outs)
             staging_delete.extend([
                 sortmerged_bam,
-                sortmerged_bam + '.bai',  # BAM index file
-                steric_filter_bam,
-                unique_bam,
-                duprm_bam,
-                unmappedrm_bam,
-                unmappedrm_bam + '.bai',  # BAM index file
-                chrmrm_bam
+                sortmerged_bam + '.bai'  # BAM index file, if filtered in parallel
             ])
 
+        # Chromosome sizes, loaded once for shifting the reads, the signal track, and peaks
+        if step <= 6:
+            genome_sizes = self.load_genome_sizes(pipeline_config['bedtools']['genome-sizes'])
+
         if step <= 5:
             # Generate filename for final processed BAM and BED
             processed_bam = os.path.join(output_dir, '{}.processed.bam'.format(lib_prefix))
-            unshifted_bed = os.path.join(output_dir, '{}.unshifted.bed'.format(lib_prefix))
             processed_bed = os.path.join(output_dir, '{}.processed.bed'.format(lib_prefix))
 
-            # staging_delete.append(unshifted_bed)
-
-            # Generate filename for chrM removed BAM
-            chrmrm_bam = os.path.join(output_dir, '{}.chrmrm.bam'.format(lib_prefix))
-
-            # Remove blacklisted genomic regions
-            bedtools_intersect.run(
-                Parameter('-v'),
-                Parameter('-abam', chrmrm_bam),
-                Parameter('-b', pipeline_config['bedtools']['blacklist-bed']),
-                Parameter('-f', '0.5'),
-                Redirect(stream=Redirect.STDOUT, dest=processed_bam)
-            )
-
-            # QC: Generate insert size metrics PDF
-            picard_insert_metrics.run(
-                Parameter('INPUT={}'.format(processed_bam)),
-                Parameter('OUTPUT={}'.format(os.path.join(logs_dir, lib_prefix + '.insertsize.metrics'))),
-                Parameter('HISTOGRAM_FILE={}'.format(os.path.join(logs_dir, lib_prefix + '.insertsize.pdf')))
+            # QC: Generate insert size metrics PDF, reading the processed BAM only if
+            # step 4 didn't already collect the histogram while filtering
+            if insert_size_collector is None:
+                insert_size_collector = InsertSizeCollector('insert_size')
+                for _ in insert_size_collector.filter(pysam.AlignmentFile(processed_bam, 'rb')):
+                    pass
+            self.write_insert_size_metrics(
+                insert_size_collector=insert_size_collector,
+                metrics_filepath=os.path.join(logs_dir, lib_prefix + '.insertsize.metrics'),
+                histogram_filepath=os.path.join(logs_dir, lib_prefix + '.insertsize.pdf'),
+                input_bam_filepath=processed_bam
             )
 
             # Generate index for processed BAM
@@ -419,79 +2150,75 @@ class Pipeline(BasePipeline):
                 Parameter(processed_bam)
             )
 
-            # Convert BAM to BED
-            bedtools_bamtobed.run(
-                Parameter('-i', processed_bam),
-                Redirect(stream=Redirect.STDOUT, dest=unshifted_bed)
-            )
-
-            staging_delete.append(unshifted_bed)
-
-            # Shifting + strand by 4 and - strand by -5, according to
+            # Convert BAM to BED, shifting + strand by 4 and - strand by -5, according to
             # the ATACseq paper
 
-            # This used to be bedtools shift, but they are fired
-            self.shift_reads(
-                input_bed_filepath=unshifted_bed,
+            # This used to be bedtools bamtobed followed by bedtools shift, but they are fired
+            fragment_class_beds = None
+            if write_fragment_classes:
+                for class_name, _, _ in FRAGMENT_CLASSES:
+                    samtools_index.run(
+                        Parameter(os.path.join(output_dir, '{}.processed.{}.bam'.format(lib_prefix,
+                                                                                        class_name)))
+                    )
+                fragment_class_beds = [os.path.join(output_dir, '{}.processed.{}.bed'.format(lib_prefix,
+                                                                                            class_name))
+                                       for class_name, _, _ in FRAGMENT_CLASSES]
+            self.bam_to_shifted_bed(
+                input_bam_filepath=processed_bam,
                 output_bed_filepath=processed_bed,
                 log_filepath=os.path.join(logs_dir, 'shift_reads.logs'),
-                genome_sizes_filepath=pipeline_config['bedtools']['genome-sizes'],
+                genome_sizes=genome_sizes,
                 minus_strand_shift=MINUS_STRAND_SHIFT,
-                plus_strand_shift=PLUS_STRAND_SHIFT
+                plus_strand_shift=PLUS_STRAND_SHIFT,
+                fragment_class_bed_filepaths=fragment_class_beds
             )
 
         if step <= 6:
             processed_bed = os.path.join(output_dir, '{}.processed.bed'.format(lib_prefix))
-            homer_tagdir = os.path.join(output_dir, '{}_tagdir'.format(lib_prefix))
-            unsorted_peaks = os.path.join(output_dir, '{}.unsorted.peaks.bed'.format(lib_prefix))
-            sorted_peaks = os.path.join(output_dir, '{}.sorted.peaks.bed'.format(lib_prefix))
-            merged_peaks = os.path.join(output_dir, '{}.peaks.bed'.format(lib_prefix))
-
-            # Populate HOMER tag directory
-            homer_maketagdir.run(
-                Parameter(homer_tagdir),
-                Parameter('-format', 'bed'),
-                Parameter(processed_bed),
-                Redirect(stream=Redirect.BOTH, dest=os.path.join(logs_dir, 'maketagdir.log'))
-            )
-
-            # Run HOMER peak calling program
-            homer_findpeaks.run(
-                Parameter(homer_tagdir),
-                Parameter('-fragLength', '0'),
-                Parameter('-fdr', '0.01'),
-                Parameter('-localSize', '50000'),
-                Parameter('-o', 'auto'),
-                Parameter('-style', 'dnase'),
-                Parameter('-size', '150'),
-                Parameter('-minDist', '50'),
-                Redirect(stream=Redirect.BOTH, dest=os.path.join(logs_dir, 'findpeaks.log'))
+            peaks_bed = os.path.join(output_dir, '{}.peaks.bed'.format(lib_prefix))
+            cut_sites = self.load_cut_sites(processed_bed)
+
+            # Signal track of cut sites per million, if pyBigWig is installed
+            cut_site_bigwig = os.path.join(output_dir, '{}.cutsites.cpm.bw'.format(lib_prefix))
+            if self.write_cut_site_bigwig(cut_sites=cut_sites, genome_sizes=genome_sizes,
+                                          bigwig_filepath=cut_site_bigwig):
+                qc_data['cut_site_bigwig'] = cut_site_bigwig
+            else:
+                sys.stderr.write('Warning: pyBigWig is not installed, so {} was not written\n'.format(
+                    cut_site_bigwig
+                ))
+                qc_data['cut_site_bigwig'] = 'Not written, pyBigWig is not installed'
+
+            # Call peaks on the cut sites of the processed reads, with the parameters
+            # previously given to HOMER findPeaks, then sort and merge them
+            self.call_peaks(
+                cut_sites=cut_sites,
+                genome_sizes=genome_sizes,
+                output_bed_filepath=peaks_bed,
+                log_filepath=os.path.join(logs_dir, 'call_peaks.log'),
+                processes=peak_processes
             )
 
-            # Convert HOMER peaks file to bed format
-            homer_pos2bed.run(
-                Parameter(os.path.join(homer_tagdir, 'peaks.txt')),
-                Redirect(stream=Redirect.STDOUT, dest=unsorted_peaks),
-                Redirect(stream=Redirect.STDERR, dest=os.path.join(logs_dir, 'pos2bed.log'))
-            )
-
-            # Sort called peaks bed file
-            bedtools_sort.run(
-                Parameter('-i', unsorted_peaks),
-                Redirect(stream=Redirect.STDOUT, dest=sorted_peaks)
-            )
-
-            # Merge peaks to create final peaks file
-            bedtools_merge.run(
-                Parameter('-i', sorted_peaks),
-                Redirect(stream=Redirect.STDOUT, dest=merged_peaks)
-            )
-
-            # Stage delete for temporary files
-            staging_delete.extend([
-                unsorted_peaks,
-                sorted_peaks
-            ])
+            # QC: Get number of peaks and fraction of processed reads in peaks
+            peak_index = self.load_peak_index(peaks_bed)
+            num_reads, num_reads_in_peaks = self.count_reads_in_peaks(processed_bed, peak_index)
+            qc_data['num_peaks_called'] = str(sum([len(starts) for starts, _ in peak_index.values()]))
+            qc_data['frip'] = str(num_reads_in_peaks / float(num_reads)) if num_reads else '0'
+
+            # QC: Get TSS enrichment from the cut sites already in memory
+            if tss_filepath:
+                tss_profile = self.tss_profile(cut_sites, self.load_tss(tss_filepath))
+                qc_data['tss_enrichment'] = str(self.write_tss_enrichment(
+                    tss_profile, os.path.join(logs_dir, '{}.tss_profile.txt'.format(lib_prefix))
+                ))
+
+        # QC: Extrapolate QC from a preview to the full run
+        if preview_read_counts is not None:
+            qc_data = extrapolate_preview_qc(qc_data, preview, PREVIEW_COUNT_QC, PREVIEW_DUPLICATION_QC, {
+                'total_raw_reads_counts': [[str(mate[0]) for mate in pair] for pair in preview_read_counts],
+                'total_raw_bases_counts': [[str(mate[1]) for mate in pair] for pair in preview_read_counts]
+            }, preview_read_counts)
 
         # QC: Output QC data to file
         with open(os.path.join(logs_dir, 'qc_metrics.txt'), 'w') as qc_data_file:
@@ -0,0 +1,57 @@
+"""
+Times atacseq's step 4 alignment filter chain on a synthetic coordinate-sorted BAM of
+read pairs, the one tests/test_filter_alignments.py filters, serially and in parallel
+over several process counts, and checks every run writes the same reads, counts, and
+fragment class BAMs. Exits non-zero if any run differs.
+
+    python benchmarks/filter_alignments.py --pairs 2000000 --processes 4 8 16
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tests'))
+import test_filter_alignments
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times atacseq alignment filtering, serially and in parallel.')
+    parser.add_argument('--pairs', default=500000, type=int, help='Number of read pairs in the BAM.')
+    parser.add_argument('--processes', default=[2, 4, 8], type=int, nargs='+',
+                        help='Process counts to filter in parallel with.')
+    parser.add_argument('--no-steric', action='store_true',
+                        help='Leave out the steric filter, so pairs across references are deferred.')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        input_bam_filepath = os.path.join(tmp_dir, 'input.bam')
+        test_filter_alignments.write_bam(input_bam_filepath, args.pairs, args.seed)
+        print('{} read pairs, {} cores'.format(args.pairs, multiprocessing.cpu_count()))
+
+        expected = None
+        for processes in [None] + args.processes:
+            run_dir = tempfile.mkdtemp(dir=tmp_dir)
+            start = time.time()
+            result = test_filter_alignments.filter_result(run_dir, input_bam_filepath, 'output',
+                                                          not args.no_steric, processes)
+            seconds = time.time() - start
+            if expected is None:
+                expected = result
+            print('{:>9} {:8.1f}s {:10.0f} reads/s  {}'.format(
+                'serial' if processes is None else '{} procs'.format(processes), seconds,
+                result['counts'][0] / seconds, 'same output' if result == expected else 'DIFFERENT OUTPUT'))
+            if result != expected:
+                sys.exit(1)
+            shutil.rmtree(run_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Times the built-in trimmer against cutadapt on synthetic read pairs in two lanes, the
+ones tests/test_trimmer.py trims, trimmed as atacseq trims them, with cutadapt reading
+the lanes through a LaneStream as the pipelines do, over several core counts, and
+checks every run writes the same reads as cutadapt on one core. Exits non-zero if any
+run differs.
+
+    python benchmarks/trim_reads.py --pairs 1000000 --cores 1 4 8 --trimmed-output fast
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tests'))
+import test_trimmer
+from test_trimmer import fastq_tools
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the built-in trimmer against cutadapt.')
+    parser.add_argument('--pairs', default=200000, type=int, help='Number of read pairs trimmed.')
+    parser.add_argument('--cores', default=[1, 2, 4], type=int, nargs='+',
+                        help='Core counts each trimmer runs on.')
+    parser.add_argument('--trimmed-output', default='plain', choices=fastq_tools.TRIMMED_OUTPUT_MODES,
+                        help='How trimmed reads are written.')
+    parser.add_argument('--cutadapt', default='cutadapt', help='Path to cutadapt.')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        mate_lane_filepaths = test_trimmer.write_lanes(py.path.local(tmp_dir), args.pairs, 2, args.seed)
+        print('{} read pairs, {} cores, cutadapt {}'.format(
+            args.pairs, multiprocessing.cpu_count(),
+            '.'.join([str(part) for part in fastq_tools.cutadapt_version(args.cutadapt) or ['not found']])))
+
+        expected = None
+        for trimmer in ['cutadapt', 'builtin']:
+            for cores in args.cores:
+                run_dir = tempfile.mkdtemp(dir=tmp_dir)
+                output_filepaths = [
+                    fastq_tools.trimmed_fastq_filepath(os.path.join(run_dir, 'trimmed_{}'.format(mate)),
+                                                       args.trimmed_output)
+                    for mate in [1, 2]
+                ]
+                summary_filepath = os.path.join(run_dir, 'summary')
+                start = time.time()
+                if trimmer == 'builtin':
+                    fastq_tools.trim_reads(mate_lane_filepaths, output_filepaths, test_trimmer.ADAPTERS, 30, 33, 5,
+                                           cores, fastq_tools.trimmed_compression_level(args.trimmed_output),
+                                           summary_filepath)
+                else:
+                    lane_streams = [
+                        fastq_tools.LaneStream(lane_filepaths, os.path.join(run_dir, 'read{}.fastq'.format(mate)))
+                        for mate, lane_filepaths in zip([1, 2], mate_lane_filepaths)
+                    ]
+                    with lane_streams[0] as read1, lane_streams[1] as read2, open(summary_filepath, 'w') as summary:
+                        subprocess.check_call(
+                            args.cutadapt.split() + ['--quality-base=33', '--minimum-length=5', '-q', '30',
+                                                     '--output={}'.format(output_filepaths[0]),
+                                                     '--paired-output={}'.format(output_filepaths[1]),
+                                                     '-a', test_trimmer.ADAPTERS[0], '-A', test_trimmer.ADAPTERS[1]] +
+                            fastq_tools.cutadapt_trimming_args(args.cutadapt, cores, args.trimmed_output) +
+                            [read1, read2],
+                            stdout=summary
+                        )
+                seconds = time.time() - start
+                result = [test_trimmer.read_fastq(filepath) for filepath in output_filepaths]
+                if expected is None:
+                    expected = result
+                print('{:>9} {:>2} cores {:8.1f}s {:10.0f} pairs/s  {}'.format(
+                    trimmer, cores, seconds, args.pairs / seconds,
+                    'same output' if result == expected else 'DIFFERENT OUTPUT'))
+                if result != expected:
+                    sys.exit(1)
+                shutil.rmtree(run_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
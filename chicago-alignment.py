@@ -1,4 +1,5 @@
 import os
+import sys
 import subprocess
 import datetime
 import re
@@ -6,6 +7,12 @@ import uuid
 import json
 
 from chunkypipes.components import Software, Parameter, Redirect, BasePipeline
+# Shared FASTQ helpers, installed next to the pipelines
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fastq_tools import (TRIMMED_OUTPUT_MODES, TRIMMERS, cached_count_gzipped_lines, cutadapt_report_args,
+                         cutadapt_trimming_args, cutadapt_writes_json, extrapolate_preview_qc, extrapolated_counts,
+                         preview_fraction, read_cutadapt_report, run_fastq_qc, store_fastq_stats, subsample_reads,
+                         trim_reads, trimmed_compression_level, trimmed_fastq_filepath)
 
 FIRST_READS_PAIR = 0
 FIRST_CHAR = 0
@@ -15,6 +22,13 @@ MAPPED_READS_COUNT = 0
 JAVA_DEFAULT_HEAP_SIZE = '6'
 
 
+# QC counts scaled up to the full run from a preview, and duplication rates extrapolated to it
+PREVIEW_COUNT_QC = ['total_trimmed_reads', 'percent_num_reads_mapped_genome',
+                    'percent_num_reads_mapped_transcriptome', 'num_reads_multimapped',
+                    'percent_num_reads_rrna']
+PREVIEW_DUPLICATION_QC = ['percent_duplicate_reads']
+
+
 class Pipeline(BasePipeline):
     def description(self):
         return """RNAseq pipeline used at the University of Chicago."""
@@ -82,12 +96,27 @@ class Pipeline(BasePipeline):
                             help='Adapter sequnce for the reverse strand.')
         parser.add_argument('--is-stranded', action='store_true',
                             help='Provide this argument if library is stranded.')
+        parser.add_argument('--external-fastqc', action='store_true',
+                            help=('Run FastQC on each FASTQ instead of the built-in FASTQ QC, which writes '
+                                  'fastqc_data.txt and summary.txt in its formats while counting reads.'))
+        parser.add_argument('--trim-cores', default=1, type=int,
+                            help='Number of cores cutadapt trims on, if its version supports it.')
+        parser.add_argument('--trimmed-output', default='gzip', choices=TRIMMED_OUTPUT_MODES,
+                            help=('How trimmed reads are written: gzipped at the default level (gzip, '
+                                  'the default), gzipped at level 1 (fast), or uncompressed (plain), '
+                                  'which is fastest and largest.'))
+        parser.add_argument('--trimmer', default='cutadapt', choices=TRIMMERS,
+                            help=('Trim reads with cutadapt, or with the built-in trimmer, which trims '
+                                  'them the same way in batches on --trim-cores processes, whatever '
+                                  'the cutadapt version. It needs numpy.'))
+        parser.add_argument('--preview', default=None, type=preview_fraction, metavar='FRACTION',
+                            help=('Run on this fraction of read pairs, picked by a hash of their '
+                                  'names so mates stay together across files and lanes, and '
+                                  'extrapolate QC to all of them.'))
         return parser
 
     def count_gzipped_lines(self, filepath):
-        zcat = subprocess.Popen(['zcat', filepath], stdout=subprocess.PIPE)
-        num_lines = subprocess.check_output(['wc', '-l'], stdin=zcat.stdout)
-        return num_lines.strip()
+        return cached_count_gzipped_lines(filepath)
 
     def run_pipeline(self, pipeline_args, pipeline_config):
         # Instantiate options
@@ -99,6 +128,11 @@ class Pipeline(BasePipeline):
         forward_adapter = pipeline_args['forward_adapter']
         reverse_adapter = pipeline_args['reverse_adapter']
         run_is_stranded = pipeline_args['is_stranded']
+        external_fastqc = pipeline_args['external_fastqc']
+        trim_cores = pipeline_args['trim_cores']
+        trimmed_output = pipeline_args['trimmed_output']
+        trimmer = pipeline_args['trimmer']
+        preview = pipeline_args['preview']
 
         # Determine if run is paired-end from input
         run_is_paired_end = len(reads[FIRST_READS_PAIR].split(':')) > 1
@@ -110,6 +144,11 @@ class Pipeline(BasePipeline):
         # Keep list of items to delete
         staging_delete = [os.path.join(output_dir, 'tmp')]
 
+        # Preview: Run on the read pairs a hash of their names picks, subsampled into tmp
+        preview_read_counts = None
+        if preview is not None and step <= 1:
+            reads, preview_read_counts = subsample_reads(reads, tmp_dir, preview, trim_cores)
+
         qc_metrics = {
             'total_raw_reads': [],
             'total_trimmed_reads': [],
@@ -151,6 +190,7 @@ class Pipeline(BasePipeline):
 
         # Establish Software instances
         cutadapt = Software('Cutadapt', pipeline_config['cutadapt']['path'])
+        cutadapt_json = step <= 1 and cutadapt_writes_json(pipeline_config['cutadapt']['path'])
         fastqc = Software('FastQC', pipeline_config['fastqc']['path'])
         star = Software('STAR Two-Pass', pipeline_config['STAR']['path'])
         novosort = Software('Novosort', pipeline_config['novosort']['path'])
@@ -194,69 +234,96 @@ class Pipeline(BasePipeline):
                     # Get paired-end reads, construct new filenames
                     read1, read2 = read.split(':')
 
-                    # QC: Get raw fastq read counts
-                    qc_metrics['total_raw_reads'].append([
-                        str(int(self.count_gzipped_lines(read1))/4),
-                        str(int(self.count_gzipped_lines(read2))/4)
-                    ])
-
-                    trimmed_read1_filename = os.path.join(output_dir,
-                                                          lib_prefix + '_{}_read1.trimmed.fastq.gz'.format(i))
-                    trimmed_read2_filename = os.path.join(output_dir,
-                                                          lib_prefix + '_{}_read2.trimmed.fastq.gz'.format(i))
+                    trimmed_read1_filename = trimmed_fastq_filepath(
+                        os.path.join(output_dir, lib_prefix + '_{}_read1.trimmed'.format(i)), trimmed_output)
+                    trimmed_read2_filename = trimmed_fastq_filepath(
+                        os.path.join(output_dir, lib_prefix + '_{}_read2.trimmed'.format(i)), trimmed_output)
+                    cutadapt_summary = os.path.join(logs_dir, 'cutadapt.summary')
                     staging_delete.extend([
                         trimmed_read1_filename,
                         trimmed_read2_filename
                     ])
 
-                    # Run cutadapt
-                    cutadapt.run(
-                        Parameter('--quality-base={}'.format(pipeline_config['cutadapt']['quality-base'])),
-                        Parameter('--minimum-length=5'),
-                        Parameter('--output={}'.format(trimmed_read1_filename)),
-                        Parameter('--paired-output={}'.format(trimmed_read2_filename)),
-                        Parameter('-a', forward_adapter),
-                        Parameter('-A', reverse_adapter),
-                        Parameter('-q', '30'),
-                        Parameter(read1),
-                        Parameter(read2),
-                        Redirect(stream=Redirect.STDOUT, dest=os.path.join(logs_dir, 'cutadapt.summary'))
-                    )
-
-                    # QC: Get trimmed fastq read counts
-                    qc_metrics['total_trimmed_reads'].append([
-                        str(int(self.count_gzipped_lines(trimmed_read1_filename))/4),
-                        str(int(self.count_gzipped_lines(trimmed_read2_filename))/4)
-                    ])
+                    # Run cutadapt, or the built-in trimmer
+                    if trimmer == 'builtin':
+                        trim_reads([[read1], [read2]], [trimmed_read1_filename, trimmed_read2_filename],
+                                   [forward_adapter, reverse_adapter], 30,
+                                   int(pipeline_config['cutadapt']['quality-base']), 5, trim_cores,
+                                   trimmed_compression_level(trimmed_output), cutadapt_summary)
+                    else:
+                        cutadapt.run(
+                            Parameter('--quality-base={}'.format(pipeline_config['cutadapt']['quality-base'])),
+                            Parameter('--minimum-length=5'),
+                            Parameter('--output={}'.format(trimmed_read1_filename)),
+                            Parameter('--paired-output={}'.format(trimmed_read2_filename)),
+                            Parameter('-a', forward_adapter),
+                            Parameter('-A', reverse_adapter),
+                            Parameter('-q', '30'),
+                            Parameter(*cutadapt_report_args(cutadapt_summary, cutadapt_json)),
+                            Parameter(*cutadapt_trimming_args(pipeline_config['cutadapt']['path'], trim_cores,
+                                                              trimmed_output)),
+                            Parameter(read1),
+                            Parameter(read2),
+                            Redirect(stream=Redirect.STDOUT, dest=cutadapt_summary)
+                        )
+
+                    # QC: Get raw and trimmed fastq read counts from the cutadapt report, or
+                    # by reading the fastqs if it can't be read
+                    cutadapt_report = read_cutadapt_report(cutadapt_summary)
+                    if cutadapt_report is not None:
+                        qc_metrics['total_raw_reads'].append([str(cutadapt_report['reads_processed'])] * 2)
+                        qc_metrics['total_trimmed_reads'].append([str(cutadapt_report['reads_written'])] * 2)
+                    else:
+                        qc_metrics['total_raw_reads'].append([
+                            str(int(self.count_gzipped_lines(read1))/4),
+                            str(int(self.count_gzipped_lines(read2))/4)
+                        ])
+                        qc_metrics['total_trimmed_reads'].append([
+                            str(int(self.count_gzipped_lines(trimmed_read1_filename))/4),
+                            str(int(self.count_gzipped_lines(trimmed_read2_filename))/4)
+                        ])
 
                     # Update reads list
                     reads[i] = ':'.join([trimmed_read1_filename, trimmed_read2_filename])
                 else:
-                    # QC: Get raw fastq read counts
-                    qc_metrics['total_raw_reads'].append([
-                        str(int(self.count_gzipped_lines(read))/4)
-                    ])
-
                     # Construct new filename
-                    trimmed_read_filename = os.path.join(output_dir,
-                                                         lib_prefix + '_{}.trimmed.fastq.gz'.format(i))
+                    trimmed_read_filename = trimmed_fastq_filepath(
+                        os.path.join(output_dir, lib_prefix + '_{}.trimmed'.format(i)), trimmed_output)
+                    cutadapt_summary = os.path.join(logs_dir, 'cutadapt.chicago.summary')
                     staging_delete.append(trimmed_read_filename)
 
-                    # Run cutadapt
-                    cutadapt.run(
-                        Parameter('--quality-base={}'.format(pipeline_config['cutadapt']['quality-base'])),
-                        Parameter('--minimum-length=5'),
-                        Parameter('--output={}'.format(trimmed_read_filename)),
-                        Parameter('-a', forward_adapter),
-                        Parameter('-q', '30'),
-                        Parameter(read),
-                        Redirect(stream=Redirect.STDOUT, dest=os.path.join(logs_dir, 'cutadapt.chicago.summary'))
-                    )
-
-                    # QC: Get trimmed fastq read counts
-                    qc_metrics['total_trimmed_reads'].append([
-                        str(int(self.count_gzipped_lines(trimmed_read_filename))/4)
-                    ])
+                    # Run cutadapt, or the built-in trimmer
+                    if trimmer == 'builtin':
+                        trim_reads([[read]], [trimmed_read_filename], [forward_adapter], 30,
+                                   int(pipeline_config['cutadapt']['quality-base']), 5, trim_cores,
+                                   trimmed_compression_level(trimmed_output), cutadapt_summary)
+                    else:
+                        cutadapt.run(
+                            Parameter('--quality-base={}'.format(pipeline_config['cutadapt']['quality-base'])),
+                            Parameter('--minimum-length=5'),
+                            Parameter('--output={}'.format(trimmed_read_filename)),
+                            Parameter('-a', forward_adapter),
+                            Parameter('-q', '30'),
+                            Parameter(*cutadapt_report_args(cutadapt_summary, cutadapt_json)),
+                            Parameter(*cutadapt_trimming_args(pipeline_config['cutadapt']['path'], trim_cores,
+                                                              trimmed_output)),
+                            Parameter(read),
+                            Redirect(stream=Redirect.STDOUT, dest=cutadapt_summary)
+                        )
+
+                    # QC: Get raw and trimmed fastq read counts from the cutadapt report, or
+                    # by reading the fastqs if it can't be read
+                    cutadapt_report = read_cutadapt_report(cutadapt_summary)
+                    if cutadapt_report is not None:
+                        qc_metrics['total_raw_reads'].append([str(cutadapt_report['reads_processed'])])
+                        qc_metrics['total_trimmed_reads'].append([str(cutadapt_report['reads_written'])])
+                    else:
+                        qc_metrics['total_raw_reads'].append([
+                            str(int(self.count_gzipped_lines(read))/4)
+                        ])
+                        qc_metrics['total_trimmed_reads'].append([
+                            str(int(self.count_gzipped_lines(trimmed_read_filename))/4)
+                        ])
 
                     # Update reads list
                     reads[i] = trimmed_read_filename
@@ -276,10 +343,14 @@ class Pipeline(BasePipeline):
                 all_fastqs.extend(reads)
 
             for fastq in all_fastqs:
-                fastqc.run(
-                    Parameter('--outdir={}'.format(fastqc_output_dir)),
-                    Parameter(fastq)
-                )
+                read_stats = None if external_fastqc else run_fastq_qc(fastq, fastqc_output_dir)
+                if read_stats is None:
+                    fastqc.run(
+                        Parameter('--outdir={}'.format(fastqc_output_dir)),
+                        Parameter(fastq)
+                    )
+                else:
+                    store_fastq_stats(fastq, read_stats)
 
         # Step 3: Alignment | STAR 2-pass, Alignment Stats | samtools flagstat
         if step <= 3:
@@ -289,7 +360,11 @@ class Pipeline(BasePipeline):
                 Parameter('--twopassMode', 'Basic'),
                 Parameter('--runThreadN', pipeline_config['STAR']['threads']),
                 Parameter('--genomeDir', pipeline_config['STAR']['genome-dir']),
-                Parameter('--readFilesCommand', 'zcat'),
+                # Trimmed reads written uncompressed are read as is
+                (
+                    Parameter('--readFilesCommand', 'zcat') if reads[FIRST_READS_PAIR].endswith('.gz')
+                    else Parameter()
+                ),
                 Parameter('--quantMode', 'TranscriptomeSAM', 'GeneCounts'),
                 Parameter('--outSAMtype', 'BAM', 'Unsorted'),
                 Parameter('--outFilterType', 'BySJout'),
@@ -526,6 +601,14 @@ class Pipeline(BasePipeline):
                 qc_metrics['percent_duplicate_reads'] = ['Could not open MarkDuplicates metrics', e.message]
 
         # Write out QC metrics to file
+        # QC: Extrapolate QC from a preview to the full run
+        if preview_read_counts is not None:
+            qc_metrics = extrapolate_preview_qc(qc_metrics, preview, PREVIEW_COUNT_QC, PREVIEW_DUPLICATION_QC, {
+                'total_raw_reads': [[str(mate[0]) for mate in read] for read in preview_read_counts]
+            }, preview_read_counts)
+            for key in ['MappedReads_Primary', 'MappedReads_Multimapped']:
+                synapse_metadata[key] = extrapolated_counts(synapse_metadata[key], preview)
+
         with open(os.path.join(logs_dir, 'qc_metrics.txt'), 'w') as qc_data_file:
             qc_data_file.write(json.dumps(qc_metrics, indent=4) + '\n')
 
@@ -0,0 +1,1746 @@
+"""
+FASTQ helpers shared by the pipelines: read statistics cached across runs, cutadapt
+arguments and reports, a built-in trimmer in place of cutadapt, preview subsampling,
+streaming of lanes and trimmed reads, and a built-in FASTQ QC in place of FastQC. The
+built-in trimmer and QC need numpy.
+Install it next to the pipelines that import it, e.g. in ~/.chunky/pipelines.
+"""
+import os
+import re
+import json
+import math
+import time
+import zlib
+import errno
+import fcntl
+import struct
+import hashlib
+import collections
+import subprocess
+import threading
+import multiprocessing
+import multiprocessing.pool
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Line counts of gzipped files are cached across runs in the ChunkyPipes home, keyed by
+# path, size, mtime, and a fingerprint of the first and last bytes of the file. The least
+# recently used entries are evicted to keep the cache file under LINE_COUNT_CACHE_MAX_SIZE
+# bytes. Hits are noted in memory and saved with the next entry stored
+LINE_COUNT_CACHE = os.path.join(os.environ.get('CHUNKY_HOME', os.path.expanduser('~')),
+                                '.chunky', 'line_counts.json')
+LINE_COUNT_CACHE_MAX_SIZE = 4 * 1024 * 1024
+LINE_COUNT_CACHE_HITS = {}
+LINE_COUNT_FINGERPRINT_SIZE = 64 * 1024
+
+# BGZF files larger than this are counted in parallel, split into ranges of blocks
+FASTQ_STATS_PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+FASTQ_STATS_PROCESSES = multiprocessing.cpu_count()
+# Bytes of decompressed FASTQ summarized at once
+FASTQ_STATS_BUFFER_SIZE = 4 * 1024 * 1024
+BGZF_HEADER_SIZE = 18
+BGZF_FOOTER_SIZE = 8
+
+
+def file_fingerprint(filepath, file_size):
+    """MD5 of the first and last LINE_COUNT_FINGERPRINT_SIZE bytes of a file."""
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as fingerprinted_file:
+        md5.update(fingerprinted_file.read(LINE_COUNT_FINGERPRINT_SIZE))
+        if file_size > LINE_COUNT_FINGERPRINT_SIZE:
+            fingerprinted_file.seek(max(LINE_COUNT_FINGERPRINT_SIZE, file_size - LINE_COUNT_FINGERPRINT_SIZE))
+            md5.update(fingerprinted_file.read())
+    return md5.hexdigest()
+
+
+def load_line_count_cache():
+    """Loads the entries of LINE_COUNT_CACHE, which the caller has locked."""
+    try:
+        with open(LINE_COUNT_CACHE) as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def read_line_count_cache():
+    """
+    Loads LINE_COUNT_CACHE under a shared lock, so lookups don't wait on each other.
+    Returns its entries, empty if the cache can't be used.
+    """
+    try:
+        with open(LINE_COUNT_CACHE + '.lock', 'r') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            return load_line_count_cache()
+    except (IOError, OSError):
+        return {}
+
+
+def update_line_count_cache(update):
+    """
+    Loads LINE_COUNT_CACHE under an exclusive lock, so concurrent runs don't lose each
+    other's counts, applies update to its entries, and saves it along with the hits
+    noted since the last save. Returns the result of update, or None if the cache can't
+    be used.
+    """
+    try:
+        cache_dir = os.path.dirname(LINE_COUNT_CACHE)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(LINE_COUNT_CACHE + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = load_line_count_cache()
+            for path, used in LINE_COUNT_CACHE_HITS.items():
+                if path in entries:
+                    entries[path]['used'] = max(entries[path]['used'], used)
+            LINE_COUNT_CACHE_HITS.clear()
+
+            result = update(entries)
+
+            # Evict the least recently used entries, sized as each adds to the saved JSON
+            entry_sizes = dict((path, len(json.dumps({path: entry}))) for path, entry in entries.items())
+            cache_size = sum(entry_sizes.values())
+            for path in sorted(entries, key=lambda path: entries[path]['used']):
+                if cache_size <= LINE_COUNT_CACHE_MAX_SIZE:
+                    break
+                cache_size -= entry_sizes[path]
+                del entries[path]
+
+            tmp_cache_filepath = '{}.{}.tmp'.format(LINE_COUNT_CACHE, os.getpid())
+            with open(tmp_cache_filepath, 'w') as cache_file:
+                json.dump(entries, cache_file)
+            os.rename(tmp_cache_filepath, LINE_COUNT_CACHE)
+            return result
+    except (IOError, OSError):
+        return None
+
+
+def fastq_chunk_summary(data):
+    """
+    Summarizes a chunk of decompressed FASTQ that may start and end mid-line: its number
+    of newlines, the lengths of its partial first and last lines, and the summed lengths
+    of the whole lines between them by their index modulo 4.
+    """
+    lines = data.split(b'\n')
+    if len(lines) == 1:
+        return 0, len(data), 0, [0, 0, 0, 0]
+    middle = lines[1:-1]
+    return (len(lines) - 1, len(lines[0]), len(lines[-1]),
+            [sum(map(len, middle[phase::4])) for phase in range(4)])
+
+
+def merge_fastq_summaries(first, second):
+    """Summary of two adjacent chunks of FASTQ from the summaries of each."""
+    if second is None:
+        return first
+    if first is None:
+        return second
+    first_newlines, first_head, first_tail, first_sums = first
+    second_newlines, second_head, second_tail, second_sums = second
+    if second_newlines == 0:
+        if first_newlines == 0:
+            return 0, first_head + second_head, 0, first_sums
+        return first_newlines, first_head, first_tail + second_head, first_sums
+    if first_newlines == 0:
+        return second_newlines, first_head + second_head, second_tail, second_sums
+
+    # The line split between the chunks, then the second chunk's lines, follow the first's
+    sums = list(first_sums)
+    sums[(first_newlines - 1) % 4] += first_tail + second_head
+    for phase in range(4):
+        sums[(first_newlines + phase) % 4] += second_sums[phase]
+    return first_newlines + second_newlines, first_head, second_tail, sums
+
+
+def bgzf_block_size(header):
+    """Size of a BGZF block from its header, or None if the header isn't BGZF."""
+    if len(header) < BGZF_HEADER_SIZE or header[:4] != b'\x1f\x8b\x08\x04':
+        return None
+    extra_length = struct.unpack('<H', header[10:12])[0]
+    if extra_length != 6 or header[12:16] != b'BC\x02\x00':
+        return None
+    return struct.unpack('<H', header[16:18])[0] + 1
+
+
+def bgzf_block_ranges(filepath, num_ranges):
+    """
+    Splits a BGZF file into num_ranges byte ranges of whole blocks, of about the same
+    compressed size, by walking the block headers. Returns None if it isn't BGZF.
+    """
+    file_size = os.path.getsize(filepath)
+    boundaries = [0]
+    with open(filepath, 'rb') as bgzf_file:
+        offset = 0
+        while offset < file_size:
+            bgzf_file.seek(offset)
+            block_size = bgzf_block_size(bgzf_file.read(BGZF_HEADER_SIZE))
+            if block_size is None:
+                return None
+            offset += block_size
+            if offset >= file_size * len(boundaries) // num_ranges:
+                boundaries.append(offset)
+    if boundaries[-1] != file_size:
+        boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def summarize_bgzf_range(block_range):
+    """Worker for fastq_stats. Decompresses and summarizes one range of BGZF blocks."""
+    filepath, start, end = block_range
+    summary, pending, pending_size = None, [], 0
+    with open(filepath, 'rb') as bgzf_file:
+        bgzf_file.seek(start)
+        offset = start
+        while offset < end:
+            header = bgzf_file.read(BGZF_HEADER_SIZE)
+            block_size = bgzf_block_size(header)
+            if block_size is None:
+                raise ValueError('{} is not BGZF at offset {}'.format(filepath, offset))
+            compressed = bgzf_file.read(block_size - BGZF_HEADER_SIZE)
+            data = zlib.decompress(compressed[:-BGZF_FOOTER_SIZE], -zlib.MAX_WBITS)
+            offset += block_size
+
+            pending.append(data)
+            pending_size += len(data)
+            if pending_size >= FASTQ_STATS_BUFFER_SIZE:
+                summary = merge_fastq_summaries(summary, fastq_chunk_summary(b''.join(pending)))
+                pending, pending_size = [], 0
+    if pending:
+        summary = merge_fastq_summaries(summary, fastq_chunk_summary(b''.join(pending)))
+    return summary
+
+
+def summarize_gzip_stream(filepath):
+    """
+    Decompresses a gzip file, or passes a plain one through, with pigz, if installed, or
+    zcat in another process, and summarizes its output in large buffers while it does.
+    """
+    try:
+        decompress = subprocess.Popen(['pigz', '-dcf', filepath], stdout=subprocess.PIPE,
+                                      bufsize=FASTQ_STATS_BUFFER_SIZE)
+    except OSError:
+        decompress = subprocess.Popen(['zcat', '-f', filepath], stdout=subprocess.PIPE,
+                                      bufsize=FASTQ_STATS_BUFFER_SIZE)
+    summary = None
+    for data in iter(lambda: decompress.stdout.read(FASTQ_STATS_BUFFER_SIZE), b''):
+        summary = merge_fastq_summaries(summary, fastq_chunk_summary(data))
+    decompress.stdout.close()
+    if decompress.wait() != 0:
+        raise subprocess.CalledProcessError(decompress.returncode, 'decompress {}'.format(filepath))
+    return summary
+
+
+def fastq_stats_key(filepath):
+    """The size, mtime, and fingerprint a cached entry must match to be used for filepath."""
+    file_stat = os.stat(filepath)
+    return {
+        'size': file_stat.st_size,
+        'mtime': file_stat.st_mtime,
+        'fingerprint': file_fingerprint(filepath, file_stat.st_size)
+    }
+
+
+def store_fastq_stats(filepath, stats, key=None):
+    """
+    Saves the lines, reads, and bases of a FASTQ to LINE_COUNT_CACHE, keyed as found
+    before counting, or as found now if counted elsewhere, such as by run_fastq_qc.
+    """
+    filepath = os.path.abspath(filepath)
+    key = key if key is not None else fastq_stats_key(filepath)
+
+    def store(entries):
+        entries[filepath] = dict(key, used=time.time(), **stats)
+
+    update_line_count_cache(store)
+
+
+def fastq_stats(filepath):
+    """
+    Counts the lines, reads, and bases of a gzipped FASTQ, unless the stats of the same
+    file, unchanged in size, mtime, and fingerprint, are in LINE_COUNT_CACHE. BGZF files
+    are decompressed in process, in parallel ranges of blocks if large. Other gzip files,
+    including multi-member ones, whose member boundaries aren't known up front, are
+    decompressed as one stream. Lines are counted as wc -l counts them.
+    """
+    filepath = os.path.abspath(filepath)
+    file_stat = os.stat(filepath)
+    key = fastq_stats_key(filepath)
+
+    entry = read_line_count_cache().get(filepath)
+    if entry is not None and 'bases' in entry and all([entry.get(field) == value for field, value in key.items()]):
+        LINE_COUNT_CACHE_HITS[filepath] = time.time()
+        return dict((field, entry[field]) for field in ['lines', 'reads', 'bases'])
+
+    num_ranges = FASTQ_STATS_PROCESSES if file_stat.st_size >= FASTQ_STATS_PARALLEL_MIN_SIZE else 1
+    block_ranges = bgzf_block_ranges(filepath, num_ranges)
+    if block_ranges is None:
+        summary = summarize_gzip_stream(filepath)
+    elif len(block_ranges) > 1:
+        pool = multiprocessing.Pool(len(block_ranges))
+        try:
+            summaries = pool.map(summarize_bgzf_range,
+                                 [(filepath, start, end) for start, end in block_ranges], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        summary = None
+        for range_summary in summaries:
+            summary = merge_fastq_summaries(summary, range_summary)
+    else:
+        summary = summarize_bgzf_range((filepath, 0, file_stat.st_size))
+
+    # Lines 1, 5, 9... of the file hold the sequences, and the first line is line 0 of
+    # the summary; a last line with no newline still holds a sequence if it's one
+    num_lines, _, last_line_length, sums = summary if summary is not None else (0, 0, 0, [0, 0, 0, 0])
+    num_bases = sums[0] + (last_line_length if num_lines % 4 == 1 else 0)
+    stats = {
+        'lines': num_lines,
+        'reads': (num_lines + (1 if last_line_length else 0)) // 4,
+        'bases': num_bases
+    }
+    store_fastq_stats(filepath, stats, key)
+    return stats
+
+
+def fastq_pair_stats(read1_filepath, read2_filepath):
+    """
+    Stats of the two mates of a paired FASTQ, and whether both mates hold the same
+    number of reads, as they must to be paired.
+    """
+    read1_stats, read2_stats = fastq_stats(read1_filepath), fastq_stats(read2_filepath)
+    return read1_stats, read2_stats, read1_stats['reads'] == read2_stats['reads']
+
+
+def cached_count_gzipped_lines(filepath):
+    """Counts the lines of a gzipped file as zcat | wc -l would, as a string."""
+    return str(fastq_stats(filepath)['lines'])
+
+
+# Trimmed reads are written gzipped at cutadapt's default level, gzipped at level 1, or
+# uncompressed, trading disk space for the time spent compressing and decompressing them
+TRIMMED_OUTPUT_MODES = ['gzip', 'fast', 'plain']
+TRIMMED_FAST_COMPRESSION_LEVEL = 1
+# cutadapt trims paired-end reads on several cores from this version on, and takes a
+# compression level for its output from this one
+CUTADAPT_CORES_MIN_VERSION = (2, 0)
+CUTADAPT_COMPRESSION_LEVEL_MIN_VERSION = (3, 0)
+CUTADAPT_VERSIONS = {}
+
+
+def cutadapt_version(cutadapt_path):
+    """The major and minor version of the cutadapt at cutadapt_path, or None if it can't be run."""
+    if cutadapt_path not in CUTADAPT_VERSIONS:
+        try:
+            version = subprocess.check_output(cutadapt_path.split() + ['--version']).decode().strip()
+            match = re.match(r'(\d+)\.(\d+)', version)
+        except (OSError, subprocess.CalledProcessError):
+            match = None
+        CUTADAPT_VERSIONS[cutadapt_path] = tuple([int(part) for part in match.groups()]) if match else None
+    return CUTADAPT_VERSIONS[cutadapt_path]
+
+
+def cutadapt_trimming_args(cutadapt_path, cores, trimmed_output):
+    """
+    Arguments running cutadapt on cores cores, which also compress its output in
+    parallel, and at level 1 if trimmed_output is fast, as far as its version allows.
+    """
+    version = cutadapt_version(cutadapt_path) or (0, 0)
+    args = []
+    if cores > 1 and version >= CUTADAPT_CORES_MIN_VERSION:
+        args.extend(['--cores', str(cores)])
+    if trimmed_output == 'fast' and version >= CUTADAPT_COMPRESSION_LEVEL_MIN_VERSION:
+        args.append('--compression-level={}'.format(TRIMMED_FAST_COMPRESSION_LEVEL))
+    return args
+
+
+def trimmed_fastq_filepath(filepath_prefix, trimmed_output):
+    """Path of a trimmed FASTQ, with the extension cutadapt picks its compression by."""
+    return filepath_prefix + ('.fastq.gz' if trimmed_output in ['gzip', 'fast'] else '.fastq')
+
+
+# cutadapt writes a JSON report, read in place of its text summary, from this version on
+CUTADAPT_JSON_MIN_VERSION = (3, 5)
+CUTADAPT_JSON_SUFFIX = '.json'
+
+
+def cutadapt_writes_json(cutadapt_path):
+    """Whether the cutadapt at cutadapt_path is recent enough to write a JSON report."""
+    version = cutadapt_version(cutadapt_path)
+    return version is not None and version >= CUTADAPT_JSON_MIN_VERSION
+
+
+def cutadapt_report_args(summary_filepath, writes_json):
+    """
+    Arguments asking cutadapt for a JSON report next to its summary, if it can write
+    one. A report left by an earlier run is removed, so it's never read in its place.
+    """
+    json_report_filepath = summary_filepath + CUTADAPT_JSON_SUFFIX
+    if os.path.isfile(json_report_filepath):
+        os.remove(json_report_filepath)
+    return ['--json={}'.format(json_report_filepath)] if writes_json else []
+
+
+def read_cutadapt_report(summary_filepath):
+    """
+    Reads the number of reads, or read pairs, cutadapt processed and wrote, and the
+    bases it processed in each mate, from its JSON report if it wrote one, else from
+    the summary it printed. Returns None if neither has them, e.g. if cutadapt failed
+    or is too old to print them.
+    """
+    try:
+        with open(summary_filepath + CUTADAPT_JSON_SUFFIX) as json_report:
+            report = json.load(json_report)
+        bases = report['basepair_counts']
+        return {
+            'reads_processed': report['read_counts']['input'],
+            'reads_written': report['read_counts']['output'],
+            'bases_processed': ([bases[field] for field in ['input_read1', 'input_read2']
+                                 if bases.get(field) is not None] or [bases['input']])
+        }
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    try:
+        with open(summary_filepath) as summary_file:
+            summary = summary_file.read()
+    except IOError:
+        return None
+    processed = re.search(r'^Total (?:read pairs|reads) processed:\s+([\d,]+)', summary, re.M)
+    written = re.search(r'^(?:Pairs|Reads) written \(passing filters\):\s+([\d,]+)', summary, re.M)
+    bases = re.search(r'^Total basepairs processed:\s+([\d,]+) bp'
+                      r'(?:\n\s+Read 1:\s+([\d,]+) bp\n\s+Read 2:\s+([\d,]+) bp)?', summary, re.M)
+    if processed is None or written is None or bases is None:
+        return None
+
+    def to_int(count):
+        return int(count.replace(',', ''))
+
+    return {
+        'reads_processed': to_int(processed.group(1)),
+        'reads_written': to_int(written.group(1)),
+        'bases_processed': ([to_int(bases.group(2)), to_int(bases.group(3))] if bases.group(2)
+                            else [to_int(bases.group(1))])
+    }
+
+
+# The built-in trimmer trims reads as cutadapt -q CUTOFF --minimum-length LENGTH -a ADAPTER
+# [-A ADAPTER] does, with cutadapt's default error rate and minimum overlap for 3' adapters,
+# on batches of this many reads or read pairs at a time in worker processes. At most this
+# many batches per worker are held in memory at once. It needs numpy
+TRIMMERS = ['cutadapt', 'builtin']
+TRIMMER_BATCH_SIZE = 65536
+TRIMMER_MAX_BATCHES_PER_PROCESS = 2
+TRIMMER_MAX_ERROR_RATE = 0.1
+TRIMMER_MIN_OVERLAP = 3
+# Reads are aligned to an adapter in groups of this many
+TRIMMER_ALIGNMENT_GROUP_SIZE = 16384
+# Adapters are aligned as bit vectors of 64 bases, and matched base for base, without the
+# wildcards cutadapt reads in them
+TRIMMER_MAX_ADAPTER_LENGTH = 64
+TRIMMER_WILDCARD_BASES = 'NRYSWKMBDHV'
+# Reads are only aligned to the whole of an adapter if they hold one of its pieces of up
+# to this many bases, as 2 bit codes, which any alignment within the error rate must match
+TRIMMER_PIECE_LENGTH = 8
+# Trimmed reads gzipped at cutadapt's default level are written at gzip's default level
+TRIMMED_GZIP_COMPRESSION_LEVEL = 6
+# FASTQs are decompressed and compressed in other processes, through buffers of this size
+FASTQ_RECORD_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def trimmed_compression_level(trimmed_output):
+    """The level the built-in trimmer gzips trimmed reads at, or None if they aren't gzipped."""
+    return {'gzip': TRIMMED_GZIP_COMPRESSION_LEVEL, 'fast': TRIMMED_FAST_COMPRESSION_LEVEL}.get(trimmed_output)
+
+
+def trimmer_adapter(adapter):
+    """
+    An adapter as the built-in trimmer aligns it, upper case as cutadapt reads it, or None
+    if there's none. Raises ValueError if it's longer or holds wildcards.
+    """
+    if not adapter:
+        return None
+    adapter = adapter.upper()
+    if len(adapter) > TRIMMER_MAX_ADAPTER_LENGTH or set(adapter) & set(TRIMMER_WILDCARD_BASES):
+        raise ValueError('The built-in trimmer takes adapters of up to {} bases without wildcards, '
+                         'not {}'.format(TRIMMER_MAX_ADAPTER_LENGTH, adapter))
+    return adapter.encode()
+
+
+def fastq_record_batches(filepaths, batch_size):
+    """
+    Decompresses FASTQs, gzipped or not, one after another with pigz or zcat in another
+    process and yields batch_size records at a time as the lines of each, ending in newlines.
+    """
+    try:
+        decompress = subprocess.Popen(['pigz', '-dcf'] + filepaths, stdout=subprocess.PIPE,
+                                      bufsize=FASTQ_RECORD_BUFFER_SIZE, close_fds=True)
+    except OSError:
+        decompress = subprocess.Popen(['zcat', '-f'] + filepaths, stdout=subprocess.PIPE,
+                                      bufsize=FASTQ_RECORD_BUFFER_SIZE, close_fds=True)
+    pending = []
+    for lines in iter(lambda: decompress.stdout.readlines(FASTQ_RECORD_BUFFER_SIZE), []):
+        pending.extend(lines)
+        while len(pending) >= 4 * batch_size:
+            batch, pending = pending[:4 * batch_size], pending[4 * batch_size:]
+            yield batch
+    decompress.stdout.close()
+    if decompress.wait() != 0:
+        raise subprocess.CalledProcessError(decompress.returncode, 'decompress {}'.format(' '.join(filepaths)))
+    if pending and not pending[-1].endswith(b'\n'):
+        pending[-1] += b'\n'
+    pending = pending[:len(pending) - len(pending) % 4]
+    if pending:
+        yield pending
+
+
+def fastq_buffer_batches(filepaths, batch_size):
+    """
+    Decompresses FASTQs, gzipped or not, one after another with pigz or zcat in another
+    process and yields batch_size records at a time as the bytes of all of them, ending
+    in a newline.
+    """
+    try:
+        decompress = subprocess.Popen(['pigz', '-dcf'] + filepaths, stdout=subprocess.PIPE,
+                                      bufsize=FASTQ_RECORD_BUFFER_SIZE, close_fds=True)
+    except OSError:
+        decompress = subprocess.Popen(['zcat', '-f'] + filepaths, stdout=subprocess.PIPE,
+                                      bufsize=FASTQ_RECORD_BUFFER_SIZE, close_fds=True)
+    pending, num_lines = [], 0
+    for chunk in iter(lambda: decompress.stdout.read(FASTQ_RECORD_BUFFER_SIZE), b''):
+        pending.append(chunk)
+        num_lines += chunk.count(b'\n')
+        if num_lines >= 4 * batch_size:
+            data = b''.join(pending)
+            line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+            batch_ends = line_ends[4 * batch_size - 1::4 * batch_size] + 1
+            for batch_start, batch_end in zip([0] + batch_ends[:-1].tolist(), batch_ends.tolist()):
+                yield data[batch_start:batch_end]
+            pending, num_lines = [data[batch_ends[-1]:]], len(line_ends) % (4 * batch_size)
+    decompress.stdout.close()
+    if decompress.wait() != 0:
+        raise subprocess.CalledProcessError(decompress.returncode, 'decompress {}'.format(' '.join(filepaths)))
+    data = b''.join(pending)
+    if data and not data.endswith(b'\n'):
+        data += b'\n'
+        num_lines += 1
+    if num_lines >= 4:
+        yield data[:np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))[num_lines // 4 * 4 - 1] + 1]
+
+
+def fastq_buffer_lines(data):
+    """
+    Where each line of FASTQ records in an array of their bytes starts, and where it ends,
+    before its newline and any carriage return.
+    """
+    line_ends = np.flatnonzero(data == ord('\n'))
+    line_starts = np.zeros(len(line_ends), dtype=line_ends.dtype)
+    line_starts[1:] = line_ends[:-1] + 1
+    line_ends[(line_ends > line_starts) & (data[np.maximum(line_ends - 1, 0)] == ord('\r'))] -= 1
+    return line_starts, line_ends
+
+
+def fastq_buffer_array(data, ends, lengths, width):
+    """
+    Packs lines of an array of FASTQ bytes, each of lengths bytes ending before ends, into
+    a lines by positions array, right aligned, and padded with zeros before them.
+    """
+    # Each byte of the lines, in order, is copied from its offset from where its line ends
+    # to the same offset from where its row ends
+    line_ends = np.cumsum(lengths)
+    offsets = np.arange(line_ends[-1] if len(lengths) else 0) - np.repeat(line_ends, lengths)
+    array = np.zeros(len(lengths) * width, dtype=np.uint8)
+    array[np.repeat(np.arange(1, len(lengths) + 1) * width, lengths) + offsets] = \
+        data[np.repeat(ends, lengths) + offsets]
+    return array.reshape(len(lengths), width)
+
+
+def open_fastq_output(filepath, compression_level, processes):
+    """
+    Opens a FASTQ for writing, through pigz, if installed, or gzip in another process at
+    compression_level, or as is if it's None. Returns the file to write, and the
+    compressor or None. The file isn't left open in tools started alongside, such as an
+    aligner reading it through a named pipe, which would then never see it end.
+    """
+    output_file = open(filepath, 'wb')
+    fcntl.fcntl(output_file.fileno(), fcntl.F_SETFD,
+                fcntl.fcntl(output_file.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    if compression_level is None:
+        return output_file, None
+    try:
+        compress = subprocess.Popen(['pigz', '-c', '-{}'.format(compression_level), '-p', str(processes)],
+                                    stdin=subprocess.PIPE, stdout=output_file, bufsize=FASTQ_RECORD_BUFFER_SIZE,
+                                    close_fds=True)
+    except OSError:
+        compress = subprocess.Popen(['gzip', '-c', '-{}'.format(compression_level)],
+                                    stdin=subprocess.PIPE, stdout=output_file, bufsize=FASTQ_RECORD_BUFFER_SIZE,
+                                    close_fds=True)
+    output_file.close()
+    return compress.stdin, compress
+
+
+def quality_trimmed_lengths(data, starts, lengths, cutoff, base):
+    """
+    Lengths of reads once their 3' ends are quality trimmed with the BWA algorithm, as
+    cutadapt -q does: from the 3' end, cutoff minus each quality is summed until the sum
+    turns negative, and the read is cut where the sum was highest. The qualities of each
+    read start at starts in data, an array of FASTQ bytes. Only reads ending in a quality
+    under or at the cutoff can be cut, so only those are summed.
+    """
+    trimmed_lengths = lengths.copy()
+    ends = np.flatnonzero(lengths > 0)
+    ends = ends[data[starts[ends] + lengths[ends] - 1].astype(np.int64) - base <= cutoff]
+    if len(ends) == 0:
+        return trimmed_lengths
+
+    # Summed a position at a time from the 3' end of each read, for all reads at once.
+    # The padding after the 5' end adds nothing
+    qualities = fastq_buffer_array(data, starts[ends] + lengths[ends], lengths[ends], int(lengths[ends].max()))
+    qualities = np.ascontiguousarray(qualities[:, ::-1].T)
+    added = np.where(qualities > 0, cutoff + base - qualities.astype(np.int32), 0)
+    sums, highest, highest_position = np.zeros((3, len(ends)), dtype=np.int32)
+    summing = np.ones(len(ends), dtype=bool)
+    for position in range(len(added)):
+        sums += added[position]
+        summing &= sums >= 0
+        higher = summing & (sums > highest)
+        np.copyto(highest, sums, where=higher)
+        highest_position[higher] = position
+    cut = highest > 0
+    trimmed_lengths[ends[cut]] = lengths[ends[cut]] - 1 - highest_position[cut]
+    return trimmed_lengths
+
+
+def locate_adapter(reads, lengths, adapter, max_error_rate, min_overlap):
+    """
+    Where a 3' adapter starts in each read as cutadapt's aligner places it, or the read
+    length if it isn't found. reads is a reads by positions array of bases, each read
+    right aligned, so they all end in the last column. The aligner takes the whole
+    adapter ending in the first column it's found in with up to max_error_rate errors per
+    adapter base or, failing that, the longest adapter prefix of at least min_overlap
+    bases ending at the 3' end within that rate. Edit distances of adapter prefixes to
+    each column of the reads are computed for all reads at once, as bit vectors of their
+    differences down and across (Myers' algorithm), and the start of the alignment traced
+    back through them the way the aligner steps: diagonally if the bases match, else to
+    the cheapest of diagonal, insertion and deletion, in that order.
+    """
+    num_reads, width = reads.shape
+    adapter_length = len(adapter)
+    adapter_bases = np.frombuffer(adapter, dtype=np.uint8)
+    matches = np.zeros(256, dtype=np.uint64)
+    for row, base in enumerate(adapter_bases):
+        matches[base] |= np.uint64(1 << row)
+    one, last_row = np.uint64(1), np.uint64(adapter_length - 1)
+
+    # Differences down, bit i - 1 for rows i - 1 to i, and across, from the column before,
+    # by column and read. The padding before reads matches nothing, so changes nothing
+    read_columns = np.ascontiguousarray(reads.T)
+    shape = (width + 1, num_reads)
+    down_up, down_down = np.empty(shape, dtype=np.uint64), np.empty(shape, dtype=np.uint64)
+    across_up, across_down = np.empty(shape, dtype=np.uint64), np.empty(shape, dtype=np.uint64)
+    down_up[0], down_down[0], across_up[0], across_down[0] = np.uint64((1 << adapter_length) - 1), 0, 0, 0
+    # Along with the distance of the whole adapter to each column, from its last row
+    distances = np.empty(shape, dtype=np.int8)
+    distances[0] = adapter_length
+    match, vertical, horizontal, scratch = [np.empty(num_reads, dtype=np.uint64) for _ in range(4)]
+    for column in range(1, width + 1):
+        up, down = down_up[column - 1], down_down[column - 1]
+        np.take(matches, read_columns[column - 1], out=match)
+        np.bitwise_or(match, down, out=vertical)
+        np.bitwise_and(match, up, out=horizontal)
+        horizontal += up
+        horizontal ^= up
+        horizontal |= match
+        np.bitwise_or(horizontal, up, out=scratch)
+        np.invert(scratch, out=scratch)
+        np.bitwise_or(down, scratch, out=across_up[column])
+        np.bitwise_and(up, horizontal, out=across_down[column])
+        np.right_shift(across_up[column], last_row, out=scratch)
+        np.add(distances[column - 1], scratch.astype(np.int8) & 1, out=distances[column])
+        np.right_shift(across_down[column], last_row, out=scratch)
+        np.subtract(distances[column], scratch.astype(np.int8) & 1, out=distances[column])
+        np.left_shift(across_up[column], one, out=horizontal)
+        np.left_shift(across_down[column], one, out=down_up[column])
+        np.bitwise_or(vertical, horizontal, out=scratch)
+        np.invert(scratch, out=scratch)
+        down_up[column] |= scratch
+        np.bitwise_and(horizontal, vertical, out=down_down[column])
+
+    # The first column the whole adapter ends in within the error rate
+    accepted = distances <= int(adapter_length * max_error_rate)
+    aligned = accepted.any(axis=0)
+    row = np.where(aligned, adapter_length, 0)
+    column = np.where(aligned, accepted.argmax(axis=0), width)
+    distance = distances[column, np.arange(num_reads)].astype(np.int64)
+
+    # Failing that, the longest adapter prefix ending at the read end within the error rate
+    prefix_distance = np.zeros(num_reads, dtype=np.int64)
+    for prefix_length in range(1, adapter_length):
+        bit = np.uint64(prefix_length - 1)
+        prefix_distance += ((down_up[width] >> bit) & one).astype(np.int64)
+        prefix_distance -= ((down_down[width] >> bit) & one).astype(np.int64)
+        if prefix_length >= min_overlap:
+            accepted = ~aligned & (prefix_distance <= int(prefix_length * max_error_rate))
+            row[accepted] = prefix_length
+            distance[accepted] = prefix_distance[accepted]
+
+    # Trace alignments back to the first row, or the column before the read. Runs of
+    # matching bases are stepped through at once
+    read_starts = width - lengths
+    found = row > 0
+    tracing = np.flatnonzero(found)
+    steps = np.arange(adapter_length)
+    while len(tracing):
+        before = column[tracing, np.newaxis] - 1 - steps
+        in_adapter = row[tracing, np.newaxis] - 1 - steps
+        matching = np.logical_and.accumulate(
+            (before >= read_starts[tracing, np.newaxis]) & (in_adapter >= 0) &
+            (reads[tracing[:, np.newaxis], np.maximum(before, 0)] == adapter_bases[np.maximum(in_adapter, 0)]),
+            axis=1
+        ).sum(axis=1)
+        row[tracing] -= matching
+        column[tracing] -= matching
+        tracing = tracing[(row[tracing] > 0) & (column[tracing] > read_starts[tracing])]
+
+        here, bit = column[tracing], (row[tracing] - 1).astype(np.uint64)
+        down_here = ((down_up[here, tracing] >> bit) & one).astype(np.int64) - \
+            ((down_down[here, tracing] >> bit) & one).astype(np.int64)
+        across_here = ((across_up[here, tracing] >> bit) & one).astype(np.int64) - \
+            ((across_down[here, tracing] >> bit) & one).astype(np.int64)
+        down_before = ((down_up[here - 1, tracing] >> bit) & one).astype(np.int64) - \
+            ((down_down[here - 1, tracing] >> bit) & one).astype(np.int64)
+        insertion = distance[tracing] - down_here
+        deletion = distance[tracing] - across_here
+        diagonal = deletion - down_before
+        take_diagonal = (diagonal <= insertion) & (diagonal <= deletion)
+        take_insertion = ~take_diagonal & (insertion <= deletion)
+        row[tracing] -= take_diagonal | take_insertion
+        column[tracing] -= ~take_insertion
+        distance[tracing] = np.where(take_diagonal, diagonal, np.where(take_insertion, insertion, deletion))
+    return np.where(found, column - read_starts, lengths)
+
+
+def adapter_pieces_found(reads, adapter, max_error_rate):
+    """
+    Whether each read, a row of bases, holds the start of one of the pieces an adapter is
+    split into, one more than the errors allowed in it, so one of which any alignment of
+    the whole adapter within max_error_rate matches exactly. Bases other than ACGT are
+    read as A, so a read only ever holds more pieces than it would.
+    """
+    num_errors = int(len(adapter) * max_error_rate)
+    starts = [piece * len(adapter) // (num_errors + 1) for piece in range(num_errors + 2)]
+    piece_length = min(TRIMMER_PIECE_LENGTH, min([end - start for start, end in zip(starts, starts[1:])]))
+    pieces = [adapter[start:start + piece_length] for start in starts[:-1]]
+    if reads.shape[1] < piece_length:
+        return np.zeros(len(reads), dtype=bool)
+    if any([set(piece.decode()) - set('ACGT') for piece in pieces]):
+        return np.ones(len(reads), dtype=bool)
+
+    codes = np.zeros(256, dtype=np.uint16)
+    codes[np.frombuffer(b'CGT', dtype=np.uint8)] = [1, 2, 3]
+    piece_codes = np.zeros(4 ** piece_length, dtype=bool)
+    for piece in pieces:
+        piece_codes[int(''.join([str(codes[base]) for base in bytearray(piece)]), 4)] = True
+    read_codes = codes[reads]
+    num_starts = reads.shape[1] - piece_length + 1
+    piece_starts = read_codes[:, :num_starts].copy()
+    for base in range(1, piece_length):
+        piece_starts <<= 2
+        piece_starts |= read_codes[:, base:base + num_starts]
+    return piece_codes[piece_starts].any(axis=1)
+
+
+def adapter_trimmed_lengths(data, starts, lengths, adapter):
+    """
+    Lengths of reads once a 3' adapter is removed from them along with what follows it,
+    aligning groups of reads, starting at starts in data, an array of FASTQ bytes, and cut
+    to lengths, at a time. Reads without a piece of the adapter can only end in a prefix
+    of it, so only as many bases at their end as such an alignment spans are aligned.
+    """
+    trimmed_lengths = np.empty_like(lengths)
+    min_overlap = min(TRIMMER_MIN_OVERLAP, len(adapter))
+    for group in range(0, len(lengths), TRIMMER_ALIGNMENT_GROUP_SIZE):
+        group_lengths = lengths[group:group + TRIMMER_ALIGNMENT_GROUP_SIZE]
+        width = int(group_lengths.max()) if len(group_lengths) else 0
+        reads = fastq_buffer_array(data, starts[group:group + TRIMMER_ALIGNMENT_GROUP_SIZE] + group_lengths,
+                                   group_lengths, width)
+        found = adapter_pieces_found(reads, adapter, TRIMMER_MAX_ERROR_RATE)
+        group_trimmed_lengths = trimmed_lengths[group:group + TRIMMER_ALIGNMENT_GROUP_SIZE]
+        group_trimmed_lengths[found] = locate_adapter(reads[found], group_lengths[found], adapter,
+                                                      TRIMMER_MAX_ERROR_RATE, min_overlap)
+        end_width = min(width, len(adapter) + int(len(adapter) * TRIMMER_MAX_ERROR_RATE))
+        end_lengths = np.minimum(group_lengths[~found], end_width)
+        group_trimmed_lengths[~found] = group_lengths[~found] - end_lengths + locate_adapter(
+            reads[~found, width - end_width:], end_lengths, adapter, TRIMMER_MAX_ERROR_RATE, min_overlap)
+    return trimmed_lengths
+
+
+def trim_batch(batch):
+    """
+    Worker for trim_reads. Trims a batch of the records of each mate, quality trimming,
+    then removing adapters, then dropping reads or pairs where any mate got too short.
+    Returns the trimmed FASTQ of each mate, along with the counts trim_reads reports.
+    """
+    mate_buffers, adapters, quality_cutoff, quality_base, minimum_length = batch
+    mates = []
+    for buffer, adapter in zip(mate_buffers, adapters):
+        data = np.frombuffer(buffer, dtype=np.uint8)
+        line_starts, line_ends = fastq_buffer_lines(data)
+        lengths = line_ends[3::4] - line_starts[3::4]
+        quality_lengths = quality_trimmed_lengths(data, line_starts[3::4], lengths, quality_cutoff, quality_base)
+        trimmed_lengths = quality_lengths
+        if adapter:
+            trimmed_lengths = adapter_trimmed_lengths(data, line_starts[1::4], quality_lengths, adapter)
+        mates.append((data, line_starts, lengths, quality_lengths, trimmed_lengths))
+
+    kept = np.ones(len(mates[0][2]), dtype=bool)
+    for _, _, _, _, trimmed_lengths in mates:
+        kept &= trimmed_lengths >= minimum_length
+    outputs, counts = [], []
+    for data, line_starts, lengths, quality_lengths, trimmed_lengths in mates:
+        # The bytes written are marked by -1 where each run of bytes cut starts and 1 where
+        # it ends: what's cut from the sequence and quality lines of reads kept, up to their
+        # newlines, and whole records dropped. No two runs start or end on the same byte
+        trimmed_ends = np.repeat(line_starts[1::4] + trimmed_lengths, 2)
+        trimmed_ends[1::2] = line_starts[3::4] + trimmed_lengths
+        newlines = np.repeat(line_starts[2::4] - 1, 2)
+        newlines[1::2] = np.append(line_starts[4::4], len(data)) - 1
+        cut_starts = np.concatenate([trimmed_ends[np.repeat(kept, 2)], line_starts[0::4][~kept]])
+        cut_ends = np.concatenate([newlines[np.repeat(kept, 2)], np.append(line_starts[4::4], len(data))[~kept]])
+        runs = np.zeros(len(data) + 1, dtype=np.int8)
+        runs[cut_starts] -= 1
+        runs[cut_ends] += 1
+        outputs.append(data[np.cumsum(runs[:-1], dtype=np.int8) == 0].tobytes())
+        counts.append({
+            'bases': int(lengths.sum()),
+            'quality_trimmed': int((lengths - quality_lengths).sum()),
+            'with_adapter': int((trimmed_lengths < quality_lengths).sum()),
+            'written': int(trimmed_lengths[kept].sum())
+        })
+    return outputs, len(kept), int(kept.sum()), counts
+
+
+def trimmer_batches(mate_lane_filepaths, trimming_args, slots, stopped):
+    """
+    Yields a batch of records of each mate in turn along with trimming_args, taking one of
+    slots, a semaphore released once a batch is written, for each, until stopped is set.
+    """
+    mate_batches = [fastq_buffer_batches(lane_filepaths, TRIMMER_BATCH_SIZE)
+                    for lane_filepaths in mate_lane_filepaths]
+    while True:
+        batches = [next(batches, None) for batches in mate_batches]
+        if all([batch is None for batch in batches]):
+            return
+        if any([batch is None for batch in batches]) or len(set([batch.count(b'\n') for batch in batches])) > 1:
+            raise ValueError('{} hold different numbers of reads'.format(
+                ' and '.join([','.join(lane_filepaths) for lane_filepaths in mate_lane_filepaths])))
+        slots.acquire()
+        if stopped.is_set():
+            return
+        yield (batches,) + trimming_args
+
+
+def write_trimming_report(summary_filepath, num_reads, num_written, counts):
+    """
+    Writes what trim_reads did as cutadapt reports it, in a summary worded as cutadapt's
+    and a JSON report next to it with the same fields as cutadapt's, for
+    read_cutadapt_report to read.
+    """
+    paired = len(counts) > 1
+
+    def total(field):
+        return sum([mate_counts[field] for mate_counts in counts])
+
+    def mates(field):
+        return counts[0][field], counts[1][field] if paired else None
+
+    with open(summary_filepath + CUTADAPT_JSON_SUFFIX, 'w') as json_report:
+        json.dump({
+            'tag': 'Cutadapt report',
+            'read_counts': {
+                'input': num_reads,
+                'filtered': {'too_short': num_reads - num_written},
+                'output': num_written,
+                'read1_with_adapter': mates('with_adapter')[0],
+                'read2_with_adapter': mates('with_adapter')[1]
+            },
+            'basepair_counts': {
+                'input': total('bases'),
+                'input_read1': mates('bases')[0],
+                'input_read2': mates('bases')[1],
+                'quality_trimmed': total('quality_trimmed'),
+                'quality_trimmed_read1': mates('quality_trimmed')[0],
+                'quality_trimmed_read2': mates('quality_trimmed')[1],
+                'output': total('written'),
+                'output_read1': mates('written')[0],
+                'output_read2': mates('written')[1]
+            }
+        }, json_report, indent=2)
+
+    def line(label, count, of=None, unit=''):
+        percent = ' ({:.1%})'.format(count / float(of)) if of else ''
+        return '{:<40}{:>15,}{}{}\n'.format(label, count, unit, percent)
+
+    reads = 'read pairs' if paired else 'reads'
+    with open(summary_filepath, 'w') as summary:
+        summary.write('This is the built-in trimmer, trimming as cutadapt does.\n\n=== Summary ===\n\n')
+        summary.write(line('Total {} processed:'.format(reads), num_reads))
+        for mate, mate_counts in enumerate(counts):
+            summary.write(line('  Read {} with adapter:'.format(mate + 1) if paired else 'Reads with adapters:',
+                               mate_counts['with_adapter'], num_reads))
+        summary.write(line('{} that were too short:'.format('Pairs' if paired else 'Reads'),
+                           num_reads - num_written, num_reads))
+        summary.write(line('{} written (passing filters):'.format('Pairs' if paired else 'Reads'),
+                           num_written, num_reads))
+        summary.write('\n')
+        for label, field in [('Total basepairs processed:', 'bases'), ('Quality-trimmed:', 'quality_trimmed'),
+                             ('Total written (filtered):', 'written')]:
+            summary.write(line(label, total(field), None if field == 'bases' else total('bases'), ' bp'))
+            if paired:
+                for mate, mate_counts in enumerate(counts):
+                    summary.write(line('  Read {}:'.format(mate + 1), mate_counts[field], None, ' bp'))
+
+
+def trim_reads(mate_lane_filepaths, output_filepaths, adapters, quality_cutoff, quality_base, minimum_length,
+               processes, compression_level, summary_filepath):
+    """
+    Trims reads, or read pairs, from the lanes of each mate, read one after another, with
+    the built-in trimmer on batches in a pool of processes, writes them to
+    output_filepaths compressed at compression_level, or not if it's None, and reports
+    what it did at summary_filepath, the way cutadapt -q quality_cutoff
+    --minimum-length=minimum_length -a ADAPTER [-A ADAPTER] would on the lanes combined.
+    Returns the number of reads, or read pairs, read and written.
+    """
+    if np is None:
+        raise ImportError('The built-in trimmer needs numpy')
+    trimming_args = ([trimmer_adapter(adapter) for adapter in adapters], quality_cutoff, quality_base,
+                     minimum_length)
+    slots, stopped = threading.Semaphore(TRIMMER_MAX_BATCHES_PER_PROCESS * processes), threading.Event()
+    outputs = [open_fastq_output(filepath, compression_level, processes) for filepath in output_filepaths]
+    num_reads, num_written, counts = 0, 0, None
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        batches = trimmer_batches(mate_lane_filepaths, trimming_args, slots, stopped)
+        if pool is not None:
+            trimmed_batches = pool.imap(trim_batch, batches)
+        else:
+            trimmed_batches = (trim_batch(batch) for batch in batches)
+        for trimmed, batch_reads, batch_written, batch_counts in trimmed_batches:
+            for (output_file, _), trimmed_fastq in zip(outputs, trimmed):
+                output_file.write(trimmed_fastq)
+            slots.release()
+            num_reads += batch_reads
+            num_written += batch_written
+            counts = batch_counts if counts is None else [
+                dict([(field, mate_counts[field] + mate_batch_counts[field]) for field in mate_counts])
+                for mate_counts, mate_batch_counts in zip(counts, batch_counts)
+            ]
+    except BaseException:
+        # Batches waiting on a slot are stopped, so the pool isn't left waiting on them
+        stopped.set()
+        slots.release()
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for output_file, compress in outputs:
+            output_file.close()
+            if compress is not None and compress.wait() != 0:
+                raise subprocess.CalledProcessError(compress.returncode, 'compress')
+
+    if counts is None:
+        counts = [dict([(field, 0) for field in ['bases', 'quality_trimmed', 'with_adapter', 'written']])
+                  for _ in mate_lane_filepaths]
+    write_trimming_report(summary_filepath, num_reads, num_written, counts)
+    return num_reads, num_written
+
+
+# A preview runs the pipeline on the read pairs whose names, less any /1 or /2 mate suffix,
+# hash under this fraction of the hash range, so mates are kept together across FASTQs and
+# lanes. Its FASTQs are gzipped at level 1, if the originals are gzipped, and its QC counts
+# extrapolated to the full run, but for the raw counts, measured as the FASTQs are subsampled
+PREVIEW_HASH_RANGE = 2 ** 32
+PREVIEW_COMPRESSION_LEVEL = 1
+PREVIEW_MATE_SUFFIXES = (b'/1', b'/2')
+# FASTQs are subsampled this many records at a time
+PREVIEW_BATCH_SIZE = 65536
+
+
+def preview_fraction(value):
+    """The fraction of read pairs a preview runs on, for --preview, over 0 and up to 1."""
+    fraction = float(value)
+    if not 0 < fraction <= 1:
+        raise ValueError('A preview fraction must be over 0 and up to 1, not {}'.format(value))
+    return fraction
+
+
+def preview_keeps(header, fraction):
+    """Whether a preview at fraction keeps the read with this FASTQ header line, and its mate."""
+    name = header.split(None, 1)[0]
+    if name[-2:] in PREVIEW_MATE_SUFFIXES:
+        name = name[:-2]
+    return zlib.crc32(name) & 0xffffffff < fraction * PREVIEW_HASH_RANGE
+
+
+def preview_record_batches(filepath):
+    """Yields PREVIEW_BATCH_SIZE records of a FASTQ, gzipped or not, at a time as the lines of each."""
+    return fastq_record_batches([filepath], PREVIEW_BATCH_SIZE)
+
+
+def open_preview_output(filepath):
+    """
+    Opens a subsampled FASTQ for writing, gzipped in another process if its path ends in
+    .gz. Returns the file to write, and the compressor or None.
+    """
+    return open_fastq_output(filepath, PREVIEW_COMPRESSION_LEVEL if filepath.endswith('.gz') else None, 1)
+
+
+def subsample_fastq(subsample):
+    """
+    Worker for subsample_reads. Writes the reads of a FASTQ a preview keeps to another,
+    gzipped if its path ends in .gz. Returns the number of reads and bases read, and the
+    number of reads kept.
+    """
+    input_filepath, output_filepath, fraction = subsample
+    output_file, compress = open_preview_output(output_filepath)
+    num_reads, num_bases, num_kept = 0, 0, 0
+    try:
+        for lines in preview_record_batches(input_filepath):
+            kept = [record for record in range(0, len(lines), 4) if preview_keeps(lines[record], fraction)]
+            output_file.write(b''.join([b''.join(lines[record:record + 4]) for record in kept]))
+            num_reads += len(lines) // 4
+            num_bases += sum([len(line) for line in lines[1::4]]) - len(lines) // 4
+            num_kept += len(kept)
+    finally:
+        output_file.close()
+        if compress is not None and compress.wait() != 0:
+            raise subprocess.CalledProcessError(compress.returncode, 'compress {}'.format(output_filepath))
+    return num_reads, num_bases, num_kept
+
+
+def subsample_reads(reads, output_dir, fraction, processes):
+    """
+    Subsamples reads for a preview at fraction into output_dir, each FASTQ in a pool of
+    processes. reads are FASTQs, or mates joined by colons, as the pipelines take them.
+    Returns them with the subsampled FASTQs in their place, and for each, the number of
+    reads and bases read and reads kept from every mate, measured on the full FASTQs.
+    """
+    previewed_reads, subsamples, num_mates = [], [], []
+    for i, read in enumerate(reads):
+        num_mates.append(len(read.split(':')))
+        previewed_mates = []
+        for mate in read.split(':'):
+            previewed_mate = os.path.join(output_dir, 'preview.{}.{}'.format(i, os.path.basename(mate)))
+            subsamples.append((mate, previewed_mate, fraction))
+            previewed_mates.append(previewed_mate)
+        previewed_reads.append(':'.join(previewed_mates))
+
+    if processes > 1 and len(subsamples) > 1:
+        pool = multiprocessing.Pool(min(processes, len(subsamples)))
+        try:
+            counts = pool.map(subsample_fastq, subsamples, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        counts = [subsample_fastq(subsample) for subsample in subsamples]
+
+    read_counts = []
+    for mates in num_mates:
+        read_counts.append(counts[:mates])
+        counts = counts[mates:]
+    return previewed_reads, read_counts
+
+
+def extrapolated_counts(value, fraction):
+    """
+    A QC value from a preview at fraction, with the counts in it, whole numbers as strings,
+    scaled up to the full run. Anything else, such as a rate, is an estimate as it is.
+    """
+    if isinstance(value, list):
+        return [extrapolated_counts(item, fraction) for item in value]
+    if isinstance(value, dict):
+        return dict([(key, extrapolated_counts(item, fraction)) for key, item in value.items()])
+    if isinstance(value, str) and re.match(r'^\d+$', value):
+        return str(int(round(int(value) / fraction)))
+    return value
+
+
+def extrapolated_duplication(duplication, fraction):
+    """
+    The fraction of duplicate reads expected in the full run, from the fraction in a
+    preview at fraction, as a string like it. As for Picard's library size estimate,
+    molecules are assumed to be read uniformly at random: the library size, relative to the
+    reads previewed, is solved for by bisection from the reads left distinct, then the
+    reads left distinct in 1 / fraction times as many reads follow from it.
+    """
+    try:
+        distinct = 1.0 - float(duplication)
+    except (TypeError, ValueError):
+        return duplication
+    if distinct >= 1.0 or distinct <= 0.0:
+        return duplication
+
+    def distinct_fraction(library_size):
+        return -library_size * math.expm1(-1.0 / library_size)
+
+    low, high = 1e-9, 1e9
+    for _ in range(100):
+        middle = math.sqrt(low * high)
+        if distinct_fraction(middle) < distinct:
+            low = middle
+        else:
+            high = middle
+    return '{:.6f}'.format(1.0 - distinct_fraction(low * fraction))
+
+
+def extrapolate_preview_qc(qc, fraction, count_keys, duplication_keys, raw_qc, read_counts):
+    """
+    QC from a preview at fraction, extrapolated to the full run: counts under count_keys
+    scaled up, duplication under duplication_keys as expected in as many reads, and
+    everything else, such as mapping and rRNA rates, estimated from the preview as it is.
+    raw_qc holds the QC measured on the full FASTQs while subsampling them, such as their
+    read counts, reported as they are. What was previewed, from read_counts as
+    subsample_reads returns them, and the QC as measured on it, are kept under preview.
+    """
+    extrapolated = dict(qc)
+    extrapolated.update(raw_qc)
+    for key in count_keys:
+        if key in qc:
+            extrapolated[key] = extrapolated_counts(qc[key], fraction)
+    for key in duplication_keys:
+        if key in qc:
+            extrapolated[key] = extrapolated_duplication(qc[key], fraction)
+    # Mates hold the same reads, so only the first mate of each is counted
+    extrapolated['preview'] = {
+        'fraction': str(fraction),
+        'reads_read': str(sum([mates[0][0] for mates in read_counts])),
+        'reads_previewed': str(sum([mates[0][2] for mates in read_counts])),
+        'measured': dict([(key, qc[key]) for key in list(count_keys) + list(duplication_keys) + list(raw_qc)
+                          if key in qc])
+    }
+    return extrapolated
+
+
+def feed_lanes(lane_filepaths, fifo_filepath):
+    """
+    Worker for LaneStream. Once a reader opens the named pipe, decompresses the lanes
+    into it in order, and returns the exit status of the decompressor.
+    """
+    with open(fifo_filepath, 'wb') as fifo:
+        try:
+            decompress = subprocess.Popen(['pigz', '-dcf'] + lane_filepaths, stdout=fifo, close_fds=True)
+        except OSError:
+            decompress = subprocess.Popen(['zcat', '-f'] + lane_filepaths, stdout=fifo, close_fds=True)
+    return decompress.wait()
+
+
+# Once the tool reading a LaneStream exits, a pipe it never opened is checked for at
+# this interval, in seconds
+LANE_STREAM_POLL_INTERVAL = 0.1
+
+
+class LaneStream(object):
+    """
+    Presents the FASTQ lanes of one mate, gzipped or not, as one FASTQ that a tool reads
+    once from start to end, in place of the lanes concatenated on disk. A single lane is
+    read as is. Several are decompressed in order, by pigz if installed or zcat, into a
+    named pipe. The pipe carries plain FASTQ because cutadapt seeks to detect the format
+    of a gzipped input, which a pipe can't do. Used as a context manager around the
+    command that reads the path it returns.
+    """
+    def __init__(self, lane_filepaths, fifo_filepath):
+        self.lane_filepaths = list(lane_filepaths)
+        self.fifo_filepath = fifo_filepath
+        self.feeder_pool = None
+        self.feeder = None
+
+    def __enter__(self):
+        if len(self.lane_filepaths) == 1:
+            return self.lane_filepaths[0]
+        if os.path.exists(self.fifo_filepath):
+            os.remove(self.fifo_filepath)
+        os.mkfifo(self.fifo_filepath)
+        self.feeder_pool = multiprocessing.pool.ThreadPool(1)
+        self.feeder = self.feeder_pool.apply_async(feed_lanes, (self.lane_filepaths, self.fifo_filepath))
+        return self.fifo_filepath
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.feeder is None:
+            return False
+
+        # If the tool exited without opening the pipe, the feeder waits for a reader forever,
+        # so the pipe is opened and closed until it's done, as it may not have opened it yet
+        while not self.feeder.ready():
+            os.close(os.open(self.fifo_filepath, os.O_RDONLY | os.O_NONBLOCK))
+            time.sleep(LANE_STREAM_POLL_INTERVAL)
+        try:
+            returncode = self.feeder.get()
+        finally:
+            self.feeder_pool.close()
+            self.feeder_pool.join()
+            self.feeder_pool, self.feeder = None, None
+            os.remove(self.fifo_filepath)
+        if returncode != 0 and exc_type is None:
+            raise subprocess.CalledProcessError(returncode,
+                                                'decompress {}'.format(' '.join(self.lane_filepaths)))
+        return False
+
+
+# Trimmed reads streamed to the aligner are relayed through memory in chunks of this many
+# bytes, up to this many chunks per mate ahead of the aligner. Once cutadapt or the
+# aligner exits, pipes it never opened are checked for at this interval, in seconds
+TRIMMED_STREAM_MODE = 'fifo'
+TRIMMED_STREAM_CHUNK_SIZE = 1024 * 1024
+TRIMMED_STREAM_MAX_CHUNKS = 64
+TRIMMED_STREAM_POLL_INTERVAL = 0.1
+
+
+def read_trimmed_fifo(source_filepath, chunks, stopped):
+    """
+    Worker for TrimmedStream. Reads what cutadapt writes into a named pipe onto chunks,
+    a bounded queue, ended by None, until the aligner stops reading.
+    """
+    try:
+        with open(source_filepath, 'rb') as source:
+            for chunk in iter(lambda: source.read(TRIMMED_STREAM_CHUNK_SIZE), b''):
+                if stopped.is_set():
+                    break
+                chunks.put(chunk)
+    finally:
+        chunks.put(None)
+
+
+def write_trimmed_fifo(sink_filepath, chunks, stopped):
+    """
+    Worker for TrimmedStream. Writes chunks into the named pipe the aligner reads. Once
+    the aligner stops reading, the chunks left are discarded and the readers stopped.
+    """
+    write_error = None
+    with open(sink_filepath, 'wb', 0) as sink:
+        for chunk in iter(chunks.get, None):
+            if stopped.is_set():
+                continue
+            try:
+                sink.write(chunk)
+            except IOError as error:
+                stopped.set()
+                if error.errno != errno.EPIPE:
+                    write_error = error
+    if write_error is not None:
+        raise write_error
+
+
+class TrimmedStream(object):
+    """
+    Streams the reads cutadapt trims to an aligner that reads them once, in place of
+    trimmed files written to disk and read back. cutadapt writes each mate into a named
+    pipe in tmp_dir, relayed through memory into a named pipe at its trimmed path. The
+    relay lets the aligner read the mates in a different rhythm than cutadapt writes
+    them, such as read by read against cutadapt's chunks, without the two waiting on
+    each other forever.
+    """
+    def __init__(self, trimmed_filepaths, tmp_dir):
+        self.sink_filepaths = list(trimmed_filepaths)
+        self.source_filepaths = [os.path.join(tmp_dir, os.path.basename(trimmed_filepath))
+                                 for trimmed_filepath in trimmed_filepaths]
+        for fifo_filepath in self.source_filepaths + self.sink_filepaths:
+            if os.path.exists(fifo_filepath):
+                os.remove(fifo_filepath)
+            os.mkfifo(fifo_filepath)
+
+        self.stopped = threading.Event()
+        self.pool = multiprocessing.pool.ThreadPool(1 + 2 * len(self.sink_filepaths))
+        self.relays = []
+        for source_filepath, sink_filepath in zip(self.source_filepaths, self.sink_filepaths):
+            chunks = Queue.Queue(TRIMMED_STREAM_MAX_CHUNKS)
+            self.relays.append(self.pool.apply_async(read_trimmed_fifo, (source_filepath, chunks, self.stopped)))
+            self.relays.append(self.pool.apply_async(write_trimmed_fifo, (sink_filepath, chunks, self.stopped)))
+        self.trimming = None
+
+    def start(self, trim):
+        """Runs trim, which runs cutadapt writing to source_filepaths, in the background."""
+        self.trimming = self.pool.apply_async(self.run_trimming, (trim,))
+
+    def run_trimming(self, trim):
+        """
+        Runs trim, then opens and closes the pipes cutadapt didn't open, such as when it
+        fails to start, until their readers are done, so the aligner reads the end of them.
+        """
+        try:
+            return trim()
+        finally:
+            readers = self.relays[0::2]
+            while not all([reader.ready() for reader in readers]):
+                for source_filepath, reader in zip(self.source_filepaths, readers):
+                    if not reader.ready():
+                        try:
+                            os.close(os.open(source_filepath, os.O_WRONLY | os.O_NONBLOCK))
+                        except OSError:
+                            pass
+                time.sleep(TRIMMED_STREAM_POLL_INTERVAL)
+
+    def wait(self):
+        """
+        Once the aligner has exited, waits for trimming and relaying to finish, and
+        removes the pipes. Returns what trim returned.
+        """
+        # Pipes the aligner never opened would be waited on forever, so they're opened and
+        # closed until the relays writing them are done
+        writers = self.relays[1::2]
+        while not all([result.ready() for result in self.relays + [self.trimming]]):
+            for sink_filepath, writer in zip(self.sink_filepaths, writers):
+                if not writer.ready():
+                    os.close(os.open(sink_filepath, os.O_RDONLY | os.O_NONBLOCK))
+            time.sleep(TRIMMED_STREAM_POLL_INTERVAL)
+        try:
+            for relay in self.relays:
+                relay.get()
+            return self.trimming.get()
+        finally:
+            self.pool.close()
+            self.pool.join()
+            for fifo_filepath in self.source_filepaths + self.sink_filepaths:
+                os.remove(fifo_filepath)
+
+
+# Built-in FASTQ QC, written in the fastqc_data.txt and summary.txt formats of FastQC
+FASTQ_QC_FASTQC_VERSION = '0.11.9'
+FASTQ_QC_BATCH_SIZE = 100000
+FASTQ_QC_BUFFER_SIZE = 4 * 1024 * 1024
+FASTQ_QC_BASES = 'GATCN'
+FASTQ_QC_MAX_QUALITY_CHAR = 128
+# As in FastQC, duplication is estimated from the first 100000 distinct sequences, each
+# truncated to 50 bases if longer than 75, and k-mers are counted in 2% of reads
+FASTQ_QC_DUPLICATION_LIMIT = 100000
+FASTQ_QC_DUPLICATION_MAX_LENGTH = 75
+FASTQ_QC_DUPLICATION_TRUNCATE_LENGTH = 50
+FASTQ_QC_DUPLICATION_LEVELS = [(1, '1'), (2, '2'), (3, '3'), (4, '4'), (5, '5'), (6, '6'), (7, '7'),
+                               (8, '8'), (9, '9'), (10, '>10'), (50, '>50'), (100, '>100'),
+                               (500, '>500'), (1000, '>1k'), (5000, '>5k'), (10000, '>10k')]
+FASTQ_QC_OVERREPRESENTED_WARN = 0.1
+FASTQ_QC_OVERREPRESENTED_FAIL = 1.0
+FASTQ_QC_KMER_SIZE = 7
+FASTQ_QC_KMER_SAMPLE_RATE = 50
+FASTQ_QC_KMER_MIN_OBS_EXP = 5
+FASTQ_QC_KMER_WARN_PVALUE = 0.01
+FASTQ_QC_KMER_FAIL_PVALUE = 1e-5
+FASTQ_QC_KMER_MAX_REPORTED = 20
+
+
+def fastq_batches(filepath):
+    """
+    Decompresses a FASTQ, gzipped or not, with pigz or zcat in another process and yields
+    the sequence and quality lines of FASTQ_QC_BATCH_SIZE records at a time, along with
+    the number of lines read so far, counted as wc -l counts them.
+    """
+    try:
+        decompress = subprocess.Popen(['pigz', '-dcf', filepath], stdout=subprocess.PIPE,
+                                      bufsize=FASTQ_QC_BUFFER_SIZE)
+    except OSError:
+        decompress = subprocess.Popen(['zcat', '-f', filepath], stdout=subprocess.PIPE,
+                                      bufsize=FASTQ_QC_BUFFER_SIZE)
+    num_lines = 0
+    pending = []
+    for lines in iter(lambda: decompress.stdout.readlines(FASTQ_QC_BUFFER_SIZE), []):
+        num_lines += len(lines) - (0 if lines[-1].endswith(b'\n') else 1)
+        pending.extend(lines)
+        while len(pending) >= 4 * FASTQ_QC_BATCH_SIZE:
+            batch, pending = pending[:4 * FASTQ_QC_BATCH_SIZE], pending[4 * FASTQ_QC_BATCH_SIZE:]
+            yield ([line.rstrip(b'\r\n') for line in batch[1::4]],
+                   [line.rstrip(b'\r\n') for line in batch[3::4]], num_lines)
+    decompress.stdout.close()
+    if decompress.wait() != 0:
+        raise subprocess.CalledProcessError(decompress.returncode, 'decompress {}'.format(filepath))
+    pending = pending[:len(pending) - len(pending) % 4]
+    yield ([line.rstrip(b'\r\n') for line in pending[1::4]],
+           [line.rstrip(b'\r\n') for line in pending[3::4]], num_lines)
+
+
+def fastq_batch_array(lines):
+    """Packs lines into a reads by positions array of characters, padded with zeros."""
+    lengths = np.array([len(line) for line in lines], dtype=np.int64)
+    width = int(lengths.max()) if len(lines) else 0
+    if width == 0:
+        return np.zeros((len(lines), 0), dtype=np.uint8), lengths
+    if (lengths == width).all():
+        packed = b''.join(lines)
+    else:
+        packed = b''.join([line.ljust(width, b'\0') for line in lines])
+    return np.frombuffer(packed, dtype=np.uint8).reshape(len(lines), width), lengths
+
+
+def binomial_upper_tail(k, n, p):
+    """P(X > k) for X ~ Binomial(n, p), summed in log space from k + 1, for k above n * p."""
+    if k >= n:
+        return 0.0
+    log_p, log_q = math.log(p), math.log(1 - p)
+    log_n = math.lgamma(n + 1)
+    tail = 0.0
+    for i in range(int(k) + 1, int(n) + 1):
+        term = math.exp(log_n - math.lgamma(i + 1) - math.lgamma(n - i + 1) + i * log_p + (n - i) * log_q)
+        tail += term
+        if term < tail * 1e-12:
+            break
+    return min(tail, 1.0)
+
+
+class FastqQC(object):
+    """
+    Collects the statistics of the FastQC modules from batches of reads in array form:
+    per position quality and base content, per sequence quality and GC content, N
+    content, length distribution, duplication levels, overrepresented sequences, and
+    overrepresented k-mers.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.num_reads = 0
+        self.num_bases = 0
+        self.base_counts = np.zeros((0, len(FASTQ_QC_BASES)), dtype=np.int64)
+        self.quality_counts = np.zeros((0, FASTQ_QC_MAX_QUALITY_CHAR), dtype=np.int64)
+        self.sequence_qualities = np.zeros(FASTQ_QC_MAX_QUALITY_CHAR, dtype=np.int64)
+        self.gc_counts = np.zeros(101, dtype=np.int64)
+        self.length_counts = np.zeros(1, dtype=np.int64)
+        self.min_quality_char = FASTQ_QC_MAX_QUALITY_CHAR
+        self.sequences = {}
+        self.count_at_limit = 0
+        self.duplication_frozen = False
+        self.kmer_counts = np.zeros((4 ** FASTQ_QC_KMER_SIZE, 0), dtype=np.int64)
+
+        # Codes of G, A, T, C, and N, and of A, C, G, T as 2 bits for k-mers
+        self.base_codes = [ord(base) for base in FASTQ_QC_BASES]
+        self.kmer_codes = np.full(256, 4, dtype=np.int64)
+        for code, base in enumerate('ACGT'):
+            self.kmer_codes[ord(base)] = code
+
+    @staticmethod
+    def grown(counts, num_rows):
+        """counts with zero rows appended until it has num_rows rows."""
+        if counts.shape[0] >= num_rows:
+            return counts
+        padding = np.zeros((num_rows - counts.shape[0],) + counts.shape[1:], dtype=counts.dtype)
+        return np.concatenate([counts, padding])
+
+    def add_batch(self, sequences, qualities):
+        if not sequences:
+            return
+        bases, lengths = fastq_batch_array(sequences)
+        quality_chars, _ = fastq_batch_array(qualities)
+        if quality_chars.shape != bases.shape:
+            raise ValueError('{} has reads whose sequence and quality lengths differ'.format(self.filename))
+        width = bases.shape[1]
+        first_read = self.num_reads
+        self.num_reads += len(sequences)
+
+        # Per position base and quality counts; padding is zero, so it's never counted
+        self.base_counts = self.grown(self.base_counts, width)
+        for column, code in enumerate(self.base_codes):
+            self.base_counts[:width, column] += (bases == code).sum(axis=0)
+        in_read = np.arange(width) < lengths[:, None]
+        positions = np.nonzero(in_read)[1]
+        read_quality_chars = quality_chars[in_read]
+        if len(read_quality_chars):
+            self.min_quality_char = min(self.min_quality_char, int(read_quality_chars.min()))
+        self.quality_counts = self.grown(self.quality_counts, width)
+        self.quality_counts[:width] += np.bincount(
+            positions * FASTQ_QC_MAX_QUALITY_CHAR + read_quality_chars,
+            minlength=width * FASTQ_QC_MAX_QUALITY_CHAR
+        ).reshape(width, FASTQ_QC_MAX_QUALITY_CHAR)
+
+        # Per sequence mean quality, GC content, and length
+        has_bases = lengths > 0
+        self.sequence_qualities += np.bincount(
+            quality_chars.sum(axis=1, dtype=np.int64)[has_bases] // lengths[has_bases],
+            minlength=FASTQ_QC_MAX_QUALITY_CHAR
+        )[:FASTQ_QC_MAX_QUALITY_CHAR]
+        gc = ((bases == ord('G')) | (bases == ord('C'))).sum(axis=1)
+        called = lengths - (bases == ord('N')).sum(axis=1)
+        self.gc_counts += np.bincount(np.round(100.0 * gc[called > 0] / called[called > 0]).astype(np.int64),
+                                      minlength=101)
+        self.length_counts = self.grown(self.length_counts, width + 1)
+        self.length_counts[:width + 1] += np.bincount(lengths, minlength=width + 1)
+
+        # Distinct sequences, for duplication levels and overrepresented sequences
+        sequence_counts = self.sequences
+        for read_index, sequence in enumerate(sequences):
+            if len(sequence) > FASTQ_QC_DUPLICATION_MAX_LENGTH:
+                sequence = sequence[:FASTQ_QC_DUPLICATION_TRUNCATE_LENGTH]
+            if self.duplication_frozen:
+                if sequence in sequence_counts:
+                    sequence_counts[sequence] += 1
+                continue
+            sequence_counts[sequence] = sequence_counts.get(sequence, 0) + 1
+            self.count_at_limit = first_read + read_index + 1
+            self.duplication_frozen = len(sequence_counts) >= FASTQ_QC_DUPLICATION_LIMIT
+
+        # k-mer counts per position in every FASTQ_QC_KMER_SAMPLE_RATE-th read
+        sampled = bases[(-first_read) % FASTQ_QC_KMER_SAMPLE_RATE::FASTQ_QC_KMER_SAMPLE_RATE]
+        num_positions = width - FASTQ_QC_KMER_SIZE + 1
+        if len(sampled) and num_positions > 0:
+            codes = self.kmer_codes[sampled]
+            kmers = np.zeros((len(sampled), num_positions), dtype=np.int64)
+            called_kmers = np.ones((len(sampled), num_positions), dtype=bool)
+            for offset in range(FASTQ_QC_KMER_SIZE):
+                window = codes[:, offset:offset + num_positions]
+                kmers = kmers * 4 + np.minimum(window, 3)
+                called_kmers &= window < 4
+            kmer_positions = np.nonzero(called_kmers)[1]
+            if self.kmer_counts.shape[1] < num_positions:
+                self.kmer_counts = np.concatenate([
+                    self.kmer_counts,
+                    np.zeros((4 ** FASTQ_QC_KMER_SIZE, num_positions - self.kmer_counts.shape[1]), dtype=np.int64)
+                ], axis=1)
+            self.kmer_counts[:, :num_positions] += np.bincount(
+                kmers[called_kmers] * num_positions + kmer_positions,
+                minlength=4 ** FASTQ_QC_KMER_SIZE * num_positions
+            ).reshape(4 ** FASTQ_QC_KMER_SIZE, num_positions)
+        self.num_bases += int(lengths.sum())
+
+    @staticmethod
+    def percentile(counts, percent):
+        """Lowest value whose cumulative count reaches percent of the total, as FastQC finds it."""
+        return int(np.argmax(np.cumsum(counts) >= counts.sum() * percent // 100))
+
+    @staticmethod
+    def status(value, warn, fail, higher_is_worse=True):
+        if not higher_is_worse:
+            value, warn, fail = -value, -warn, -fail
+        if value > fail:
+            return 'fail'
+        return 'warn' if value > warn else 'pass'
+
+    def duplication_levels(self):
+        """
+        Percentages of distinct and of all sequences at each duplication level, corrected
+        for sequences first seen after FASTQ_QC_DUPLICATION_LIMIT distinct sequences were
+        tracked, as FastQC corrects them. Returns the percentage of sequences left if
+        deduplicated, and a row per level.
+        """
+        collated = collections.Counter(self.sequences.values())
+        deduplicated = [0.0] * len(FASTQ_QC_DUPLICATION_LEVELS)
+        total = [0.0] * len(FASTQ_QC_DUPLICATION_LEVELS)
+        num_reads, count_at_limit = self.num_reads, self.count_at_limit
+        for level, num_sequences in collated.items():
+            corrected = float(num_sequences)
+            if count_at_limit < num_reads and num_reads - num_sequences >= count_at_limit:
+                # Chance that a sequence seen level times in all reads was missed in the
+                # first count_at_limit, the product over them of (N - i - level) / (N - i)
+                p_not_seen = 0.0
+                if num_reads - level >= count_at_limit:
+                    p_not_seen = math.exp(math.lgamma(num_reads - level + 1) -
+                                          math.lgamma(num_reads - level - count_at_limit + 1) -
+                                          math.lgamma(num_reads + 1) + math.lgamma(num_reads - count_at_limit + 1))
+                if p_not_seen < 1.0 - num_sequences / (num_sequences + 0.01):
+                    p_not_seen = 0.0
+                corrected = num_sequences / (1.0 - p_not_seen)
+            bucket = max([i for i, (min_level, _) in enumerate(FASTQ_QC_DUPLICATION_LEVELS) if level >= min_level])
+            deduplicated[bucket] += corrected
+            total[bucket] += corrected * level
+
+        deduplicated_total, raw_total = sum(deduplicated), sum(total)
+        if raw_total == 0:
+            return 100.0, [(label, 0.0, 0.0) for _, label in FASTQ_QC_DUPLICATION_LEVELS]
+        return 100.0 * deduplicated_total / raw_total, [
+            (label, 100.0 * deduplicated[i] / deduplicated_total, 100.0 * total[i] / raw_total)
+            for i, (_, label) in enumerate(FASTQ_QC_DUPLICATION_LEVELS)
+        ]
+
+    def overrepresented_kmers(self):
+        """
+        k-mers enriched at least FASTQ_QC_KMER_MIN_OBS_EXP-fold at some position over
+        their share of all k-mers, with the binomial p-value of that enrichment, most
+        significant first.
+        """
+        kmer_counts = self.kmer_counts
+        position_totals = kmer_counts.sum(axis=0)
+        all_kmers = position_totals.sum()
+        kmer_totals = kmer_counts.sum(axis=1)
+        if all_kmers == 0:
+            return []
+        expected = np.outer(kmer_totals / float(all_kmers), position_totals)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            obs_exp = np.where(expected > 0, kmer_counts / expected, 0.0)
+        max_positions = obs_exp.argmax(axis=1)
+        max_obs_exp = obs_exp[np.arange(len(obs_exp)), max_positions]
+
+        kmers = []
+        for kmer in np.flatnonzero(max_obs_exp >= FASTQ_QC_KMER_MIN_OBS_EXP).tolist():
+            position = int(max_positions[kmer])
+            pvalue = binomial_upper_tail(int(kmer_counts[kmer, position]), int(position_totals[position]),
+                                         kmer_totals[kmer] / float(all_kmers))
+            if pvalue < FASTQ_QC_KMER_WARN_PVALUE:
+                sequence = ''.join(['ACGT'[(kmer >> 2 * (FASTQ_QC_KMER_SIZE - 1 - i)) & 3]
+                                    for i in range(FASTQ_QC_KMER_SIZE)])
+                kmers.append((pvalue, -float(max_obs_exp[kmer]), sequence,
+                              int(kmer_totals[kmer]) * FASTQ_QC_KMER_SAMPLE_RATE, position + 1))
+        kmers.sort()
+        return kmers[:FASTQ_QC_KMER_MAX_REPORTED]
+
+    def modules(self):
+        """The name, status, and data lines of every FastQC module, in FastQC's order."""
+        offset = 33 if self.min_quality_char < 64 else 64
+        lengths = np.flatnonzero(self.length_counts)
+        positions = range(len(self.base_counts))
+        modules = []
+
+        # Basic Statistics
+        called_totals = self.base_counts[:, :4].sum(axis=0)
+        gc_percent = (int(100 * (called_totals[0] + called_totals[3]) // called_totals.sum())
+                      if called_totals.sum() else 0)
+        modules.append(('Basic Statistics', 'pass', ['#Measure\tValue'] + [
+            '{}\t{}'.format(measure, value) for measure, value in [
+                ('Filename', self.filename),
+                ('File type', 'Conventional base calls'),
+                ('Encoding', 'Sanger / Illumina 1.9' if offset == 33 else 'Illumina 1.5'),
+                ('Total Sequences', self.num_reads),
+                ('Sequences flagged as poor quality', 0),
+                ('Sequence length', (str(lengths.min()) if lengths.min() == lengths.max()
+                                     else '{}-{}'.format(lengths.min(), lengths.max())) if len(lengths) else 0),
+                ('%GC', gc_percent)
+            ]
+        ]))
+
+        # Per base sequence quality
+        rows, status = [], 'pass'
+        for position in positions:
+            counts = self.quality_counts[position, offset:]
+            if not counts.sum():
+                continue
+            qualities = np.arange(len(counts))
+            median, lower_quartile = self.percentile(counts, 50), self.percentile(counts, 25)
+            quantiles = [median, lower_quartile, self.percentile(counts, 75), self.percentile(counts, 10),
+                         self.percentile(counts, 90)]
+            rows.append('\t'.join([str(position + 1), str((counts * qualities).sum() / float(counts.sum()))] +
+                                  [str(float(value)) for value in quantiles]))
+            if lower_quartile < 5 or median < 20:
+                status = 'fail'
+            elif status == 'pass' and (lower_quartile < 10 or median < 25):
+                status = 'warn'
+        modules.append(('Per base sequence quality', status,
+                        ['#Base\tMean\tMedian\tLower Quartile\tUpper Quartile\t10th Percentile\t90th Percentile'] +
+                        rows))
+
+        # Per sequence quality scores
+        sequence_qualities = self.sequence_qualities[offset:]
+        observed = np.flatnonzero(sequence_qualities)
+        rows = ['{}\t{}'.format(quality, float(sequence_qualities[quality]))
+                for quality in range(observed.min(), observed.max() + 1)] if len(observed) else []
+        modules.append(('Per sequence quality scores',
+                        self.status(int(sequence_qualities.argmax()), 27, 20, higher_is_worse=False)
+                        if len(observed) else 'pass',
+                        ['#Quality\tCount'] + rows))
+
+        # Per base sequence content
+        called = self.base_counts[:, :4].astype(float)
+        called_sums = called.sum(axis=1)[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            content = np.where(called_sums > 0, 100.0 * called / called_sums, 0.0)
+        imbalance = (max(np.abs(content[:, 1] - content[:, 2]).max(), np.abs(content[:, 0] - content[:, 3]).max())
+                     if len(content) else 0.0)
+        rows = ['\t'.join([str(position + 1)] + [str(value) for value in content[position]])
+                for position in positions]
+        modules.append(('Per base sequence content', self.status(imbalance, 10, 20), ['#Base\tG\tA\tT\tC'] + rows))
+
+        # Per sequence GC content, compared to a normal distribution of the same mean and spread
+        gc_values = np.arange(len(self.gc_counts))
+        gc_reads = self.gc_counts.sum()
+        deviation = 0.0
+        if gc_reads:
+            gc_mean = (gc_values * self.gc_counts).sum() / float(gc_reads)
+            gc_stdev = math.sqrt(((gc_values - gc_mean) ** 2 * self.gc_counts).sum() / float(gc_reads))
+            if gc_stdev > 0:
+                theoretical = (gc_reads * np.exp(-0.5 * ((gc_values - gc_mean) / gc_stdev) ** 2) /
+                               (gc_stdev * math.sqrt(2 * math.pi)))
+                deviation = 100.0 * np.abs(self.gc_counts - theoretical).sum() / gc_reads
+        modules.append(('Per sequence GC content', self.status(deviation, 15, 30),
+                        ['#GC Content\tCount'] + ['{}\t{}'.format(gc, float(count))
+                                                  for gc, count in enumerate(self.gc_counts)]))
+
+        # Per base N content
+        with np.errstate(divide='ignore', invalid='ignore'):
+            position_totals = self.base_counts.sum(axis=1)
+            n_content = np.where(position_totals > 0, 100.0 * self.base_counts[:, 4] / position_totals, 0.0)
+        modules.append(('Per base N content', self.status(n_content.max() if len(n_content) else 0.0, 5, 20),
+                        ['#Base\tN-Count'] + ['{}\t{}'.format(position + 1, n_content[position])
+                                              for position in positions]))
+
+        # Sequence Length Distribution
+        modules.append(('Sequence Length Distribution',
+                        'fail' if self.length_counts[0] else ('warn' if len(lengths) > 1 else 'pass'),
+                        ['#Length\tCount'] + ['{}\t{}'.format(length, float(self.length_counts[length]))
+                                              for length in lengths]))
+
+        # Sequence Duplication Levels
+        deduplicated_percent, levels = self.duplication_levels()
+        modules.append(('Sequence Duplication Levels',
+                        self.status(deduplicated_percent, 70, 50, higher_is_worse=False),
+                        ['#Total Deduplicated Percentage\t{}'.format(deduplicated_percent),
+                         '#Duplication Level\tPercentage of deduplicated\tPercentage of total'] +
+                        ['{}\t{}\t{}'.format(*level) for level in levels]))
+
+        # Overrepresented sequences
+        overrepresented = sorted([(-count, sequence) for sequence, count in self.sequences.items()
+                                  if 100.0 * count / self.num_reads > FASTQ_QC_OVERREPRESENTED_WARN])
+        top_percent = 100.0 * -overrepresented[0][0] / self.num_reads if overrepresented else 0.0
+        modules.append(('Overrepresented sequences',
+                        self.status(top_percent, FASTQ_QC_OVERREPRESENTED_WARN, FASTQ_QC_OVERREPRESENTED_FAIL),
+                        ['#Sequence\tCount\tPercentage\tPossible Source'] + [
+                            '{}\t{}\t{}\tNo Hit'.format(sequence.decode(), -count, 100.0 * -count / self.num_reads)
+                            for count, sequence in overrepresented
+                        ] if overrepresented else []))
+
+        # Kmer Content
+        kmers = self.overrepresented_kmers()
+        modules.append(('Kmer Content',
+                        ('fail' if kmers[0][0] < FASTQ_QC_KMER_FAIL_PVALUE else 'warn') if kmers else 'pass',
+                        ['#Sequence\tCount\tPValue\tObs/Exp Max\tMax Obs/Exp Position'] + [
+                            '{}\t{}\t{}\t{}\t{}'.format(sequence, count, pvalue, -obs_exp, position)
+                            for pvalue, obs_exp, sequence, count, position in kmers
+                        ] if kmers else []))
+        return modules
+
+    def write(self, output_dir):
+        """
+        Writes fastqc_data.txt and summary.txt to {name}_fastqc in output_dir, named as
+        FastQC names its output for the same FASTQ. Returns that directory.
+        """
+        report_dir = os.path.join(output_dir, re.sub(r'(\.fastq|\.fq|\.txt)?(\.gz|\.bz2)?$', '',
+                                                     self.filename) + '_fastqc')
+        if not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+        modules = self.modules()
+        with open(os.path.join(report_dir, 'fastqc_data.txt'), 'w') as data_file:
+            data_file.write('##FastQC\t{}\n'.format(FASTQ_QC_FASTQC_VERSION))
+            for name, status, lines in modules:
+                data_file.write('>>{}\t{}\n'.format(name, status))
+                for line in lines:
+                    data_file.write(line + '\n')
+                data_file.write('>>END_MODULE\n')
+        with open(os.path.join(report_dir, 'summary.txt'), 'w') as summary_file:
+            for name, status, _ in modules:
+                summary_file.write('{}\t{}\t{}\n'.format(status.upper(), name, self.filename))
+        return report_dir
+
+
+def run_fastq_qc(fastq_filepath, output_dir):
+    """
+    Runs the built-in FastqQC over a FASTQ in one decompression pass, writing its
+    FastQC-compatible report to output_dir. Returns the lines, reads, and bases counted
+    on the way, or None if numpy, which it needs, isn't installed.
+    """
+    if np is None:
+        return None
+    fastq_qc = FastqQC(os.path.basename(fastq_filepath))
+    num_lines = 0
+    for sequences, qualities, num_lines in fastq_batches(fastq_filepath):
+        fastq_qc.add_batch(sequences, qualities)
+    fastq_qc.write(output_dir)
+    return {'lines': num_lines, 'reads': fastq_qc.num_reads, 'bases': fastq_qc.num_bases}
@@ -0,0 +1,143 @@
+"""
+Tests of the bwa algorithm atacseq aligns read pairs with, run through steps 2 and 3
+with a bwa that logs its arguments: aln and sampe for each pair, or mem alone with
+both mates, its alignments streamed to the sorter, concurrent pairs or not, and the
+sorter stopped if bwa fails to start.
+"""
+import os
+import stat
+import argparse
+import subprocess
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+# Writes one alignment per call from sampe and mem, to the FIFO atacseq gives it
+FAKE_BWA = """#!/bin/sh
+echo "$@" >> {log}
+case "$1" in
+    mem|sampe)
+        printf '@SQ\\tSN:chr1\\tLN:1000\\n'
+        printf 'pair0\\t99\\tchr1\\t100\\t60\\t10M\\t=\\t200\\t110\\tACGTACGTAC\\tIIIIIIIIII\\n'
+        ;;
+esac
+"""
+
+
+class AlignmentDone(Exception):
+    pass
+
+
+class Software(object):
+    """
+    Runs a command's Parameters and Redirects as chunkypipes Software does, until
+    samtools merge, which ends the test run after step 3.
+    """
+    def __init__(self, software_name, software_path):
+        self.software_name = software_name
+        self.software_path = software_path
+
+    fails = None
+
+    def run(self, *args):
+        if self.software_name == 'samtools merge':
+            raise AlignmentDone()
+        if self.software_name == Software.fails:
+            raise OSError('{} failed to start'.format(self.software_name))
+        cmd = self.software_path.split()
+        streams = {}
+        for arg in args:
+            if isinstance(arg, atacseq.Parameter):
+                cmd.extend(arg.parameters)
+            else:
+                stream = 'stderr' if arg.stream in atacseq.Redirect._STDERR_MODES else 'stdout'
+                streams[stream] = open(arg.dest, arg.mode)
+        try:
+            subprocess.call(cmd, **streams)
+        finally:
+            for stream_file in streams.values():
+                stream_file.close()
+
+
+def sort_alignments(samtools_path, input_sam_filepath, output_bam_prefix, sort_threads):
+    """Copies what the aligner writes to output_bam_prefix.sam in place of samtools sort."""
+    with open(input_sam_filepath) as input_sam, open(output_bam_prefix + '.sam', 'w') as output_sam:
+        lines = input_sam.readlines()
+        output_sam.write(''.join(lines))
+    return 2 * len([line for line in lines if not line.startswith('@')])
+
+
+def run_alignment(tmpdir, monkeypatch, aligner, num_pairs, pair_processes, expected_error=AlignmentDone):
+    bwa_log = str(tmpdir.join('bwa.args'))
+    bwa_path = str(tmpdir.join('bwa'))
+    with open(bwa_path, 'w') as bwa:
+        bwa.write(FAKE_BWA.format(log=bwa_log))
+    os.chmod(bwa_path, os.stat(bwa_path).st_mode | stat.S_IXUSR)
+    monkeypatch.setattr(atacseq, 'Software', Software)
+    monkeypatch.setattr(atacseq.Pipeline, 'sort_alignments', staticmethod(sort_alignments))
+
+    reads = []
+    for i in range(num_pairs):
+        for mate in [1, 2]:
+            with open(str(tmpdir.join('reads{}_{}.fastq'.format(i, mate))), 'w') as fastq:
+                fastq.write('@pair0/{}\nACGTACGTAC\n+\nIIIIIIIIII\n'.format(mate))
+        reads.extend(['--reads', '{0}/reads{1}_1.fastq:{0}/reads{1}_2.fastq'.format(str(tmpdir), i)])
+    pipeline = atacseq.Pipeline()
+    pipeline_args = vars(pipeline.add_pipeline_args(argparse.ArgumentParser()).parse_args(reads + [
+        '--output', str(tmpdir.join('out')), '--lib', 'lib', '--step', '2', '--external-fastqc',
+        '--aligner', aligner, '--pair-processes', str(pair_processes)
+    ]))
+    pipeline_config = {'cutadapt': {'path': 'cutadapt'}, 'fastqc': {'path': 'true'},
+                       'bwa': {'path': bwa_path, 'threads': '4', 'index-dir': '/index/genome.fa'},
+                       'samtools': {'path': 'samtools', 'threads': '1'}, 'bedtools': {}}
+    with pytest.raises(expected_error):
+        pipeline.run_pipeline(pipeline_args, pipeline_config)
+
+    if not os.path.exists(bwa_log):
+        return []
+    with open(bwa_log) as bwa_args:
+        return [line.split() for line in bwa_args]
+
+
+@pytest.mark.parametrize('num_pairs, pair_processes', [(1, 1), (2, 2)])
+def test_mem_aligns_both_mates_at_once(tmpdir, monkeypatch, num_pairs, pair_processes):
+    bwa_calls = run_alignment(tmpdir, monkeypatch, 'mem', num_pairs, pair_processes)
+    threads = str(4 // pair_processes)
+    assert sorted(bwa_calls) == sorted([
+        ['mem', '-t', threads, '-M', '/index/genome.fa', '{}/reads{}_1.fastq'.format(str(tmpdir), i),
+         '{}/reads{}_2.fastq'.format(str(tmpdir), i)] for i in range(num_pairs)
+    ])
+    for i in range(num_pairs):
+        with open(str(tmpdir.join('out', 'lib.{}.sam'.format(i)))) as sam:
+            assert sam.read().count('pair0\t99') == 1
+        assert os.path.exists(str(tmpdir.join('out', 'logs', 'bwa_mem.{}.log'.format(i))))
+    assert not [filename for filename in os.listdir(str(tmpdir)) if filename.endswith('.sai')]
+
+
+def test_aln_aligns_each_mate_then_pairs(tmpdir, monkeypatch):
+    bwa_calls = run_alignment(tmpdir, monkeypatch, 'aln', 1, 1)
+    read1, read2 = str(tmpdir.join('reads0_1.fastq')), str(tmpdir.join('reads0_2.fastq'))
+    assert bwa_calls == [['aln', '-t', '4', '/index/genome.fa', read1],
+                         ['aln', '-t', '4', '/index/genome.fa', read2],
+                         ['sampe', '-a', '2000', '-n', '1', '/index/genome.fa', read1 + '.sai', read2 + '.sai',
+                          read1, read2]]
+    with open(str(tmpdir.join('out', 'lib.0.sam'))) as sam:
+        assert sam.read().count('pair0\t99') == 1
+
+
+def test_aligner_failing_to_start_stops_the_sort(tmpdir, monkeypatch):
+    monkeypatch.setattr(Software, 'fails', 'BWA mem')
+    assert run_alignment(tmpdir, monkeypatch, 'mem', 1, 1, expected_error=OSError) == []
+    assert not os.path.exists(str(tmpdir.join('out', 'tmp', 'lib.0.sam')))
@@ -0,0 +1,98 @@
+"""
+Tests of the consensus peaks atacseq-consensus merges across libraries: the regions and
+supporting libraries against a merge of all the peaks at once, as bedtools merge would,
+at each min_samples, and the check that every peaks BED is sorted.
+"""
+import os
+import random
+import pytest
+
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq_consensus = load_source('atacseq_consensus', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  os.pardir, 'atacseq-consensus.py'))
+Pipeline = atacseq_consensus.Pipeline
+
+
+def write_peaks(filepath, peaks):
+    with open(filepath, 'w') as peaks_bed:
+        peaks_bed.write('track name=peaks\n')
+        for chrom, start, end in peaks:
+            peaks_bed.write('{}\t{}\t{}\n'.format(chrom, start, end))
+
+
+def merge_all(samples_peaks):
+    """Every region of overlapping or book-ended peaks, with the set of libraries in it."""
+    peaks = sorted([(chrom, start, end, sample_index) for sample_index, sample_peaks in enumerate(samples_peaks)
+                    for chrom, start, end in sample_peaks])
+    regions = []
+    for chrom, start, end, sample_index in peaks:
+        if regions and regions[-1][0] == chrom and start <= regions[-1][2]:
+            regions[-1][2] = max(regions[-1][2], end)
+            regions[-1][3].add(sample_index)
+        else:
+            regions.append([chrom, start, end, set([sample_index])])
+    return regions
+
+
+@pytest.fixture
+def samples_peaks(tmpdir):
+    rng = random.Random(0)
+    samples_peaks, peaks_filepaths = [], []
+    for sample_index in range(4):
+        peaks = []
+        for chrom in ['chr1', 'chr10', 'chr2']:
+            # Merged peaks within a library, as atacseq writes them
+            end = 0
+            for _ in range(rng.randrange(20, 60)):
+                start = end + rng.randrange(1, 2000)
+                end = start + rng.randrange(50, 800)
+                peaks.append((chrom, start, end))
+        samples_peaks.append(peaks)
+        peaks_filepaths.append(str(tmpdir.join('sample{}.peaks.bed'.format(sample_index))))
+        write_peaks(peaks_filepaths[-1], peaks)
+    return samples_peaks, peaks_filepaths
+
+
+@pytest.mark.parametrize('min_samples', [1, 2, 3, 4])
+def test_consensus_matches_merge(tmpdir, samples_peaks, min_samples):
+    samples_peaks, peaks_filepaths = samples_peaks
+    consensus_bed = str(tmpdir.join('consensus.bed'))
+    counts = Pipeline.merge_peaks(peaks_filepaths, consensus_bed, min_samples)
+
+    regions = merge_all(samples_peaks)
+    expected = [(chrom, start, end, len(samples)) for chrom, start, end, samples in regions
+                if len(samples) >= min_samples]
+    with open(consensus_bed) as consensus:
+        consensus_peaks = [line.rstrip('\n').split('\t') for line in consensus]
+    assert [(chrom, int(start), int(end), int(num_samples))
+            for chrom, start, end, num_samples in consensus_peaks] == expected
+    assert counts == {'peaks': sum([len(peaks) for peaks in samples_peaks]), 'regions': len(regions),
+                      'consensus': len(expected)}
+    if min_samples > 1:
+        assert len(expected) < len(regions)
+
+
+def test_book_ended_peaks_merge(tmpdir):
+    peaks_filepaths = [str(tmpdir.join('a.bed')), str(tmpdir.join('b.bed'))]
+    write_peaks(peaks_filepaths[0], [('chr1', 100, 200), ('chr1', 500, 600)])
+    write_peaks(peaks_filepaths[1], [('chr1', 200, 300), ('chr1', 601, 700)])
+    consensus_bed = str(tmpdir.join('consensus.bed'))
+    Pipeline.merge_peaks(peaks_filepaths, consensus_bed, 2)
+    with open(consensus_bed) as consensus:
+        assert consensus.read() == 'chr1\t100\t300\t2\n'
+
+
+def test_unsorted_peaks_raise(tmpdir):
+    peaks_filepaths = [str(tmpdir.join('a.bed')), str(tmpdir.join('b.bed'))]
+    write_peaks(peaks_filepaths[0], [('chr1', 100, 200)])
+    write_peaks(peaks_filepaths[1], [('chr1', 500, 600), ('chr1', 200, 300)])
+    with pytest.raises(ValueError):
+        Pipeline.merge_peaks(peaks_filepaths, str(tmpdir.join('consensus.bed')), 1)
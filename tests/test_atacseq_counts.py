@@ -0,0 +1,48 @@
+"""
+Tests of the sample columns atacseq-counts keeps across runs: a column is reused only
+while both the peaks and the sample file it was counted from are unchanged.
+"""
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq_counts = load_source('atacseq_counts', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            os.pardir, 'atacseq-counts.py'))
+Pipeline = atacseq_counts.Pipeline
+
+
+def write_bed(filepath, records):
+    with open(filepath, 'w') as bed_file:
+        for chrom, start, end in records:
+            bed_file.write('{}\t{}\t{}\n'.format(chrom, start, end))
+
+
+def test_column_recounted_when_sample_changes(tmpdir):
+    peaks_filepath = str(tmpdir.join('peaks.bed'))
+    write_bed(peaks_filepath, [('chr1', 100, 200), ('chr1', 500, 600)])
+    sample_filepath = str(tmpdir.join('sample.bed'))
+    write_bed(sample_filepath, [('chr1', 150, 160), ('chr1', 550, 560)])
+    peaks_checksum = Pipeline.file_checksum(peaks_filepath)
+    samples = [('sample', sample_filepath)]
+    columns_dir = str(tmpdir)
+
+    read_counts = Pipeline.count_samples(samples, peaks_filepath, columns_dir, peaks_checksum, 1)
+    assert read_counts == {'sample': (2, 2)}
+    assert Pipeline.count_samples(samples, peaks_filepath, columns_dir, peaks_checksum, 1) == {}
+
+    write_bed(sample_filepath, [('chr1', 150, 160), ('chr1', 170, 180), ('chr1', 900, 910)])
+    read_counts = Pipeline.count_samples(samples, peaks_filepath, columns_dir, peaks_checksum, 1)
+    assert read_counts == {'sample': (3, 2)}
+    with np.load(os.path.join(columns_dir, 'sample.npz')) as column:
+        assert column['rows'].tolist() == [0]
+        assert column['counts'].tolist() == [2]
@@ -0,0 +1,142 @@
+"""
+Tests of atacseq's blacklist removal against bedtools intersect -v -f 0.5, on reads
+overlapping blacklisted regions by a little, by half, and wholly, including regions
+nested in long ones: the same reads are kept. It's checked against a read by region
+scan of what bedtools does, and against bedtools itself when it is installed. Also
+tests the index cache kept next to the blacklist.
+"""
+import os
+import random
+import subprocess
+import pytest
+
+pytest.importorskip('numpy')
+pysam = pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+REFERENCES = [('chr1', 200000), ('chr2', 100000), ('chr3', 50000)]
+
+
+def find_bedtools():
+    for path_dir in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path_dir, 'bedtools'), os.X_OK):
+            return os.path.join(path_dir, 'bedtools')
+    return None
+
+
+def write_blacklist(bed_filepath, seed):
+    """Short and long regions on chr1 and chr2, some nested or overlapping; none on chr3."""
+    rng = random.Random(seed)
+    regions = []
+    for chrom, size in REFERENCES[:2]:
+        for _ in range(60):
+            start = rng.randrange(size - 5000)
+            regions.append((chrom, start, start + rng.choice([20, 100, 500, 3000])))
+    with open(bed_filepath, 'w') as bed:
+        bed.write('track name=blacklist\n')
+        for chrom, start, end in sorted(regions):
+            bed.write('{}\t{}\t{}\n'.format(chrom, start, end))
+    return regions
+
+
+def write_bam(bam_filepath, regions, num_reads, seed):
+    """Reads placed at random and around the edges of blacklisted regions."""
+    rng = random.Random(seed)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': size} for chrom, size in REFERENCES]}
+    reads = []
+    for i in range(num_reads):
+        if rng.random() < 0.5:
+            chrom, region_start, region_end = rng.choice(regions)
+            start = max(rng.choice([region_start, region_end]) - rng.randrange(60), 0)
+            reference_id = [name for name, _ in REFERENCES].index(chrom)
+        else:
+            reference_id = rng.randrange(len(REFERENCES))
+            start = rng.randrange(REFERENCES[reference_id][1] - 100)
+        read = pysam.AlignedSegment()
+        read.query_name = 'read{}'.format(i)
+        read.query_sequence = 'A' * 50
+        read.reference_id, read.reference_start = reference_id, start
+        read.cigarstring = rng.choice(['50M', '20M30D30M', '10S40M'])
+        read.mapping_quality = 60
+        reads.append(read)
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    with pysam.AlignmentFile(bam_filepath, 'wb', header=header) as bam:
+        for read in reads:
+            bam.write(read)
+
+
+def kept_by_scan(bam_filepath, regions, min_overlap_fraction):
+    """Names of the reads bedtools intersect -v -f keeps, found by checking every region."""
+    kept = []
+    with pysam.AlignmentFile(bam_filepath, 'rb') as bam:
+        for read in bam.fetch(until_eof=True):
+            length = read.reference_end - read.reference_start
+            if not any([chrom == read.reference_name and
+                        min(read.reference_end, end) - max(read.reference_start, start) > 0 and
+                        float(min(read.reference_end, end) - max(read.reference_start, start)) / length >=
+                        min_overlap_fraction
+                        for chrom, start, end in regions]):
+                kept.append(read.query_name)
+    return kept
+
+
+def kept_by_filter(bam_filepath, index):
+    blacklist_filter = atacseq.BlacklistFilter('blacklist', index, atacseq.BLACKLIST_MIN_OVERLAP_FRACTION)
+    with pysam.AlignmentFile(bam_filepath, 'rb') as bam:
+        kept = [read.query_name for read in blacklist_filter.filter(bam.fetch(until_eof=True))]
+    return kept, blacklist_filter.dropped
+
+
+@pytest.fixture
+def blacklist(tmpdir):
+    bed_filepath = str(tmpdir.join('blacklist.bed'))
+    regions = write_blacklist(bed_filepath, seed=0)
+    bam_filepath = str(tmpdir.join('reads.bam'))
+    write_bam(bam_filepath, regions, 3000, seed=0)
+    return bed_filepath, regions, bam_filepath
+
+
+def test_matches_region_scan(blacklist):
+    bed_filepath, regions, bam_filepath = blacklist
+    kept, dropped = kept_by_filter(bam_filepath, atacseq.Pipeline.load_blacklist_index(bed_filepath))
+    expected = kept_by_scan(bam_filepath, regions, atacseq.BLACKLIST_MIN_OVERLAP_FRACTION)
+    assert kept == expected
+    assert 0 < dropped == 3000 - len(expected)
+
+
+@pytest.mark.skipif(find_bedtools() is None, reason='bedtools is not installed')
+def test_matches_bedtools(blacklist, tmpdir):
+    bed_filepath, _, bam_filepath = blacklist
+    intersect_bam_filepath = str(tmpdir.join('intersect.bam'))
+    with open(intersect_bam_filepath, 'wb') as intersect_bam:
+        subprocess.check_call([find_bedtools(), 'intersect', '-v', '-abam', bam_filepath, '-b', bed_filepath,
+                               '-f', str(atacseq.BLACKLIST_MIN_OVERLAP_FRACTION)], stdout=intersect_bam)
+    with pysam.AlignmentFile(intersect_bam_filepath, 'rb') as intersect_bam:
+        expected = [read.query_name for read in intersect_bam.fetch(until_eof=True)]
+    assert kept_by_filter(bam_filepath, atacseq.Pipeline.load_blacklist_index(bed_filepath))[0] == expected
+
+
+def test_index_cache_follows_blacklist(blacklist):
+    bed_filepath, regions, bam_filepath = blacklist
+    index = atacseq.Pipeline.load_blacklist_index(bed_filepath)
+    cache_filepath = bed_filepath + atacseq.BLACKLIST_INDEX_SUFFIX
+    assert os.path.isfile(cache_filepath)
+    assert atacseq.Pipeline.load_blacklist_index(bed_filepath) == index
+
+    # A newer blacklist is indexed again
+    with open(bed_filepath, 'a') as bed:
+        bed.write('chr3\t0\t50000\n')
+    os.utime(bed_filepath, (os.path.getmtime(cache_filepath) + 10,) * 2)
+    kept, _ = kept_by_filter(bam_filepath, atacseq.Pipeline.load_blacklist_index(bed_filepath))
+    assert kept == kept_by_scan(bam_filepath, regions + [('chr3', 0, 50000)], atacseq.BLACKLIST_MIN_OVERLAP_FRACTION)
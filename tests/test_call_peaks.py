@@ -0,0 +1,70 @@
+"""
+Tests of atacseq's peak calling on small synthetic sets of cut sites: greedy selection
+of the strongest windows by minimum distance, the cap on tags counted per position, and
+the merged peaks written for clusters over a uniform background.
+"""
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+
+def call_chromosome(cut_sites):
+    _, num_tags, centers, tag_counts, _ = atacseq.call_peaks_chromosome(
+        ('chr1', np.array(sorted(cut_sites), dtype=np.int64))
+    )
+    return num_tags, centers.tolist(), tag_counts.tolist()
+
+
+def test_strongest_window_wins_its_cluster():
+    cut_sites = list(range(1000, 1010)) + list(range(1100, 1105)) + [2000, 2001, 5000]
+    assert call_chromosome(cut_sites) == (18, [1000, 1100, 2000], [10, 5, 2])
+
+
+def test_peaks_picked_greedily(monkeypatch):
+    # Windows of a single base, each 40 bases apart: the strongest excludes its
+    # neighbour, which no longer excludes the weakest, a local maximum of none
+    monkeypatch.setattr(atacseq, 'PEAK_SIZE', 2)
+    monkeypatch.setattr(atacseq, 'PEAK_MAX_TAGS_PER_BP', 100)
+    cut_sites = [1000] * 3 + [1040] * 4 + [1080] * 5
+    assert call_chromosome(cut_sites) == (12, [1000, 1080], [3, 5])
+
+
+def test_tags_per_bp_capped(monkeypatch):
+    cut_sites = [1000] * 10 + [3000, 3001, 3002]
+    assert call_chromosome(cut_sites) == (4, [3000], [3])
+    monkeypatch.setattr(atacseq, 'PEAK_MAX_TAGS_PER_BP', 100)
+    assert call_chromosome(cut_sites) == (13, [1000, 3000], [10, 3])
+
+
+def test_call_peaks(tmpdir):
+    rng = np.random.RandomState(0)
+    clusters = [200000, 600000]
+    cut_sites = np.concatenate([rng.randint(0, 1000000, 2000)] +
+                               [cluster + np.arange(-15, 15) for cluster in clusters])
+    peaks_bed = str(tmpdir.join('peaks.bed'))
+    log_filepath = str(tmpdir.join('call_peaks.log'))
+    num_peaks = atacseq.Pipeline.call_peaks({'chr1': np.sort(cut_sites), 'chrUn': np.array([5, 6])},
+                                            {'chr1': 1000000}, peaks_bed, log_filepath, processes=1)
+
+    with open(peaks_bed) as bed:
+        peaks = [line.rstrip('\n').split('\t') for line in bed]
+    assert num_peaks == len(peaks) == len(clusters)
+    for (chrom, start, end), cluster in zip(peaks, clusters):
+        assert chrom == 'chr1' and int(start) <= cluster - 15 and cluster + 15 <= int(end)
+    with open(log_filepath) as log_file:
+        log = dict(line.rstrip('\n').split('\t') for line in log_file)
+    assert log['total_tags'] == str(len(np.unique(cut_sites)))
+    assert log['merged_peaks'] == str(len(clusters))
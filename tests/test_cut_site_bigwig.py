@@ -0,0 +1,81 @@
+"""
+Tests of atacseq's cut-site bigWig on a small shifted BED: the cut site read from each
+strand, and the per-base signal, in cut sites per million, against a direct count.
+"""
+import os
+import sys
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+GENOME_SIZES = {'chr1': 5000, 'chr2': 3000, 'chr3': 1000}
+
+
+@pytest.fixture
+def shifted_bed(tmpdir):
+    rng = np.random.RandomState(0)
+    records = []
+    for chrom, num_records in [('chr1', 400), ('chr2', 50)]:
+        for start in rng.randint(0, 200, num_records).tolist():
+            strand = '-' if rng.rand() < 0.5 else '+'
+            records.append((chrom, start * 3, start * 3 + 38, strand))
+    bed_filepath = str(tmpdir.join('shifted.bed'))
+    with open(bed_filepath, 'w') as bed:
+        for chrom, start, end, strand in records:
+            bed.write('{}\t{}\t{}\tread\t60\t{}\n'.format(chrom, start, end, strand))
+    return bed_filepath, records
+
+
+def test_cut_sites_by_strand(shifted_bed):
+    bed_filepath, records = shifted_bed
+    cut_sites = atacseq.Pipeline.load_cut_sites(bed_filepath)
+    assert sorted(cut_sites) == ['chr1', 'chr2']
+    for chrom in cut_sites:
+        assert cut_sites[chrom].tolist() == sorted([end - 1 if strand == '-' else start
+                                                    for record_chrom, start, end, strand in records
+                                                    if record_chrom == chrom])
+
+
+def test_bigwig_matches_cut_site_counts(shifted_bed, tmpdir):
+    pyBigWig = pytest.importorskip('pyBigWig')
+    bed_filepath, records = shifted_bed
+    cut_sites = atacseq.Pipeline.load_cut_sites(bed_filepath)
+    bigwig_filepath = str(tmpdir.join('cut_sites.bw'))
+    assert atacseq.Pipeline.write_cut_site_bigwig(cut_sites, GENOME_SIZES, bigwig_filepath)
+
+    bigwig = pyBigWig.open(bigwig_filepath)
+    try:
+        assert bigwig.chroms() == GENOME_SIZES
+        for chrom, chrom_size in GENOME_SIZES.items():
+            expected = np.zeros(chrom_size)
+            if chrom in cut_sites:
+                np.add.at(expected, cut_sites[chrom], 1e6 / len(records))
+            values = np.nan_to_num(np.array(bigwig.values(chrom, 0, chrom_size)))
+            assert values == pytest.approx(expected, rel=1e-6)
+
+            # Adjacent bases of the same count share an interval
+            intervals = bigwig.intervals(chrom) or ()
+            for (_, end, value), (start, _, next_value) in zip(intervals, intervals[1:]):
+                assert end < start or value != pytest.approx(next_value, rel=1e-6)
+    finally:
+        bigwig.close()
+
+
+def test_bigwig_skipped_without_pybigwig(shifted_bed, tmpdir, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'pyBigWig', None)
+    bigwig_filepath = str(tmpdir.join('cut_sites.bw'))
+    cut_sites = atacseq.Pipeline.load_cut_sites(shifted_bed[0])
+    assert not atacseq.Pipeline.write_cut_site_bigwig(cut_sites, GENOME_SIZES, bigwig_filepath)
+    assert not os.path.exists(bigwig_filepath)
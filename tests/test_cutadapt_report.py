@@ -0,0 +1,101 @@
+"""
+Tests of read_cutadapt_report on the JSON and text reports of real cutadapt runs, in
+data/cutadapt, of paired and single-end reads, and, if cutadapt is installed, on the
+reports it writes for reads trimmed as atacseq trims them, against the reads themselves.
+"""
+import os
+import sys
+import gzip
+import random
+import shutil
+import subprocess
+import pytest
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import fastq_tools
+
+CUTADAPT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cutadapt')
+ADAPTERS = ['AGATCGGAAGAGCACACGTCTGAACTCCAGTCA', 'AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT']
+
+# Counts of the reports in data/cutadapt, from cutadapt 5.2 trimming 1000 read pairs
+EXPECTED_REPORTS = {
+    'paired': {'reads_processed': 1000, 'reads_written': 972, 'bases_processed': [48860, 48860]},
+    'single': {'reads_processed': 1000, 'reads_written': 972, 'bases_processed': [48860]}
+}
+
+
+@pytest.fixture(params=sorted(EXPECTED_REPORTS))
+def report(request, tmpdir):
+    for suffix in ['', fastq_tools.CUTADAPT_JSON_SUFFIX]:
+        shutil.copy(os.path.join(CUTADAPT_DATA_DIR, '{}.summary.log{}'.format(request.param, suffix)), str(tmpdir))
+    return str(tmpdir.join('{}.summary.log'.format(request.param))), EXPECTED_REPORTS[request.param]
+
+
+def test_json_report(report):
+    summary_filepath, expected = report
+    # The text report, emptied, can't be what's read
+    with open(summary_filepath, 'w'):
+        pass
+    assert fastq_tools.read_cutadapt_report(summary_filepath) == expected
+
+
+def test_text_report(report):
+    summary_filepath, expected = report
+    os.remove(summary_filepath + fastq_tools.CUTADAPT_JSON_SUFFIX)
+    assert fastq_tools.read_cutadapt_report(summary_filepath) == expected
+
+
+def test_missing_or_failed_report(tmpdir):
+    summary_filepath = str(tmpdir.join('cutadapt.summary.log'))
+    assert fastq_tools.read_cutadapt_report(summary_filepath) is None
+    with open(summary_filepath, 'w') as summary_file:
+        summary_file.write('cutadapt: error: Reads are improperly paired.\n')
+    assert fastq_tools.read_cutadapt_report(summary_filepath) is None
+
+
+def write_read_pairs(read1_filepath, read2_filepath, num_pairs, seed):
+    """Read pairs of 50 bases, many of them reading into the adapters, some with low quality tails."""
+    rng = random.Random(seed)
+    with gzip.open(read1_filepath, 'wt') as read1, gzip.open(read2_filepath, 'wt') as read2:
+        for i in range(num_pairs):
+            insert = ''.join([rng.choice('ACGT') for _ in range(rng.randrange(2, 120))])
+            for mate, (fastq, adapter) in enumerate(zip([read1, read2], ADAPTERS)):
+                sequence = (insert + adapter)[:50]
+                quality = ''.join([chr(33 + (rng.randrange(2, 20) if j > 40 and rng.random() < 0.3 else 38))
+                                   for j in range(len(sequence))])
+                fastq.write('@read{}/{}\n{}\n+\n{}\n'.format(i, mate + 1, sequence, quality))
+
+
+def fastq_counts(fastq_filepath):
+    with gzip.open(fastq_filepath, 'rt') as fastq:
+        sequences = [line.rstrip('\n') for i, line in enumerate(fastq) if i % 4 == 1]
+    return len(sequences), sum([len(sequence) for sequence in sequences])
+
+
+@pytest.mark.skipif(find_executable('cutadapt') is None, reason='cutadapt is not installed')
+@pytest.mark.parametrize('writes_json', [True, False])
+def test_report_of_cutadapt_run(tmpdir, writes_json):
+    reads = [str(tmpdir.join('reads_1.fastq.gz')), str(tmpdir.join('reads_2.fastq.gz'))]
+    trimmed_reads = [str(tmpdir.join('trimmed_1.fastq.gz')), str(tmpdir.join('trimmed_2.fastq.gz'))]
+    write_read_pairs(reads[0], reads[1], 2000, seed=0)
+    summary_filepath = str(tmpdir.join('cutadapt.summary.log'))
+    with open(summary_filepath, 'w') as summary_file:
+        subprocess.check_call(['cutadapt', '--quality-base=33', '--minimum-length=5', '-q', '30',
+                               '--output={}'.format(trimmed_reads[0]), '--paired-output={}'.format(trimmed_reads[1]),
+                               '-a', ADAPTERS[0], '-A', ADAPTERS[1]] +
+                              fastq_tools.cutadapt_report_args(summary_filepath, writes_json) + reads,
+                              stdout=summary_file)
+    assert os.path.isfile(summary_filepath + fastq_tools.CUTADAPT_JSON_SUFFIX) == writes_json
+
+    raw_counts = [fastq_counts(filepath) for filepath in reads]
+    trimmed_counts = [fastq_counts(filepath) for filepath in trimmed_reads]
+    assert trimmed_counts[0][0] < raw_counts[0][0]
+    assert fastq_tools.read_cutadapt_report(summary_filepath) == {
+        'reads_processed': raw_counts[0][0],
+        'reads_written': trimmed_counts[0][0],
+        'bases_processed': [bases for _, bases in raw_counts]
+    }
@@ -0,0 +1,114 @@
+"""
+Tests of atacseq's DuplicateFilter on small coordinate-sorted sets of reads: which of a
+set of duplicates is kept, by base qualities as Picard MarkDuplicates keeps it, and how
+reads without a mapped mate collide with the ends of pairs.
+"""
+import os
+import pytest
+
+pytest.importorskip('numpy')
+pysam = pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+HEADER = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 1000000}]})
+READ_LENGTH = 50
+
+
+def make_read(name, start, quality, flag=0, mate_start=-1, template_length=0):
+    read = pysam.AlignedSegment(HEADER)
+    read.query_name = name
+    read.flag = flag
+    read.query_sequence = 'A' * READ_LENGTH
+    read.query_qualities = pysam.qualitystring_to_array(chr(33 + quality) * READ_LENGTH)
+    read.reference_id = 0
+    read.reference_start = start
+    read.cigarstring = '{}M'.format(READ_LENGTH)
+    read.mapping_quality = 60
+    if flag & 0x1:
+        read.next_reference_id = 0
+        read.next_reference_start = mate_start if mate_start >= 0 else start
+        read.template_length = template_length
+    return read
+
+
+def make_pair(name, start, template_length, quality, mate_quality=None):
+    """A forward first mate at start and a reverse second mate ending at start + template_length."""
+    mate_start = start + template_length - READ_LENGTH
+    return [make_read(name, start, quality, 0x1 | 0x2 | 0x20 | 0x40, mate_start, template_length),
+            make_read(name, mate_start, quality if mate_quality is None else mate_quality,
+                      0x1 | 0x2 | 0x10 | 0x80, start, -template_length)]
+
+
+def run_filter(reads):
+    """Runs the filter over reads, sorted by position, returning the names kept and the metrics."""
+    reads = sorted(reads, key=lambda read: read.reference_start)
+    duplicate_filter = atacseq.DuplicateFilter('duplicates', libraries={})
+    kept = list(duplicate_filter.filter(reads))
+    assert duplicate_filter.dropped == len(reads) - len(kept)
+    return [read.query_name for read in kept], duplicate_filter.metrics.get(atacseq.UNKNOWN_LIBRARY)
+
+
+def test_keeps_highest_quality_pair():
+    kept, metrics = run_filter(make_pair('low', 100, 300, 20) + make_pair('high', 100, 300, 30) +
+                               make_pair('other', 120, 300, 20))
+    assert kept == ['high', 'other', 'high', 'other']
+    assert metrics['READ_PAIRS_EXAMINED'] == 6
+    assert metrics['READ_PAIR_DUPLICATES'] == 2
+
+
+def test_ties_keep_first_pair():
+    kept, _ = run_filter(make_pair('first', 100, 300, 30) + make_pair('second', 100, 300, 30))
+    assert kept == ['first', 'first']
+
+
+def test_pairs_scored_on_both_mates():
+    # Qualities below DUPLICATE_MIN_BASE_QUALITY count for nothing, so the first pair
+    # scores 30 per base against 40 for the second, despite its better first mate
+    kept, _ = run_filter(make_pair('better_first_mate', 100, 300, 30, mate_quality=10) +
+                         make_pair('better_pair', 100, 300, 20, mate_quality=20))
+    assert kept == ['better_pair', 'better_pair']
+
+
+def test_distant_pairs_scored_on_first_mates():
+    template_length = atacseq.DUPLICATE_MATE_WAIT + 1000
+    kept, _ = run_filter(make_pair('better_first_mate', 100, template_length, 30, mate_quality=10) +
+                         make_pair('better_pair', 100, template_length, 20, mate_quality=40))
+    assert kept == ['better_first_mate', 'better_first_mate']
+
+
+def test_unpaired_read_before_pair_end_is_duplicate():
+    kept, metrics = run_filter([make_read('unpaired', 100, 40)] + make_pair('pair', 100, 300, 20))
+    assert kept == ['pair', 'pair']
+    assert metrics['UNPAIRED_READS_EXAMINED'] == 1
+    assert metrics['UNPAIRED_READ_DUPLICATES'] == 1
+    assert metrics['READ_PAIR_DUPLICATES'] == 0
+
+
+def test_mate_unmapped_read_is_duplicate_of_pair_end():
+    mate_unmapped = make_read('mate_unmapped', 370, 40, 0x1 | 0x8 | 0x10 | 0x40)
+    kept, metrics = run_filter(make_pair('pair', 100, 320, 20) + [mate_unmapped])
+    assert kept == ['pair', 'pair']
+    assert metrics['UNPAIRED_READ_DUPLICATES'] == 1
+
+
+def test_keeps_highest_quality_unpaired_read():
+    kept, metrics = run_filter([make_read('low', 100, 20), make_read('high', 100, 30), make_read('other', 101, 20)])
+    assert kept == ['high', 'other']
+    assert metrics['UNPAIRED_READ_DUPLICATES'] == 1
+
+
+def test_reads_kept_in_input_order():
+    reads = (make_pair('a', 100, 300, 20) + make_pair('b', 100, 300, 30) + [make_read('c', 150, 20)] +
+             make_pair('d', 5000, 200, 20) + [make_read('e', 5000, 30, 0x10)])
+    kept, _ = run_filter(reads)
+    assert kept == ['b', 'c', 'b', 'd', 'e', 'd']
@@ -0,0 +1,181 @@
+"""
+Tests of the built-in FASTQ QC in fastq_tools on a synthetic FASTQ: its basic statistics
+and counts, and, when FastQC is installed, or its path is in $FASTQC, every module both
+write against FastQC's report for the same FASTQ. The modules both write must come in
+the same order and match in status and column headers, and their rows in labels and,
+within a tolerance, in values.
+"""
+import os
+import sys
+import gzip
+import random
+import subprocess
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+pytest.importorskip('numpy')
+import fastq_tools
+
+NUM_READS = 20000
+OVERREPRESENTED = 'GATCGGAAGAGCACACGTCTGAACTCCAGTCACATCACGATCTCGTATGC'
+
+
+def read_fastqc_data(fastqc_data_filepath):
+    """
+    Reads a fastqc_data.txt into its FastQC version and a list of modules, each a name,
+    status, header lines, and rows split on tabs.
+    """
+    version, modules = None, []
+    with open(fastqc_data_filepath) as fastqc_data:
+        for line in fastqc_data:
+            line = line.rstrip('\r\n')
+            if line.startswith('##FastQC'):
+                version = line.split('\t')[1]
+            elif line == '>>END_MODULE':
+                modules[-1] = tuple(modules[-1])
+            elif line.startswith('>>'):
+                name, status = line[2:].split('\t')
+                modules.append([name, status, [], []])
+            elif line.startswith('#'):
+                modules[-1][2].append(line)
+            elif line:
+                modules[-1][3].append(line.split('\t'))
+    return version, modules
+
+
+def values_match(value, expected, tolerance):
+    """Whether two fields match, as numbers within a relative tolerance if both are."""
+    try:
+        value, expected = float(value), float(expected)
+    except ValueError:
+        return value == expected
+    return abs(value - expected) <= tolerance * max(1.0, abs(expected))
+
+
+def compare_modules(modules, expected_modules, tolerance):
+    """
+    Lists every difference between the modules two reports both write, empty if they
+    match.
+    """
+    differences = []
+    expected_by_name = dict([(module[0], module) for module in expected_modules])
+    modules = [module for module in modules if module[0] in expected_by_name]
+    names = [module[0] for module in modules]
+    expected_names = [module[0] for module in expected_modules if module[0] in names]
+    if names != expected_names:
+        differences.append('Modules in order {} differ from {}'.format(names, expected_names))
+    for name, status, headers, rows in modules:
+        _, expected_status, expected_headers, expected_rows = expected_by_name[name]
+        if status != expected_status:
+            differences.append('{}: status {} differs from {}'.format(name, status, expected_status))
+        for header, expected_header in zip(headers, expected_headers):
+            fields, expected_fields = header.split('\t'), expected_header.split('\t')
+            if (len(fields) != len(expected_fields) or
+                    not all([values_match(field, expected_field, tolerance)
+                             for field, expected_field in zip(fields, expected_fields)])):
+                differences.append('{}: header {} differs from {}'.format(name, header, expected_header))
+        if len(headers) != len(expected_headers):
+            differences.append('{}: {} header lines differ from {}'.format(name, len(headers), len(expected_headers)))
+        if len(rows) != len(expected_rows):
+            differences.append('{}: {} rows differ from {}'.format(name, len(rows), len(expected_rows)))
+        for row, expected_row in zip(rows, expected_rows):
+            if (len(row) != len(expected_row) or row[0] != expected_row[0] or
+                    not all([values_match(field, expected_field, tolerance)
+                             for field, expected_field in zip(row[1:], expected_row[1:])])):
+                differences.append('{}: row {} differs from {}'.format(name, '\t'.join(row), '\t'.join(expected_row)))
+    return differences
+
+
+def run_fastqc(fastqc_path, fastq_filepath, output_dir):
+    """Runs FastQC on a FASTQ into output_dir and returns the path of its fastqc_data.txt."""
+    os.makedirs(output_dir)
+    subprocess.check_call([fastqc_path, '--extract', '--outdir={}'.format(output_dir), fastq_filepath])
+    report_dirs = [report_dir for report_dir in os.listdir(output_dir)
+                   if os.path.isdir(os.path.join(output_dir, report_dir))]
+    return os.path.join(output_dir, report_dirs[0], 'fastqc_data.txt')
+
+
+def find_fastqc():
+    fastqc_path = os.environ.get('FASTQC')
+    if fastqc_path:
+        return fastqc_path
+    for path_dir in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path_dir, 'fastqc'), os.X_OK):
+            return os.path.join(path_dir, 'fastqc')
+    return None
+
+
+@pytest.fixture(scope='module')
+def fastq(tmpdir_factory):
+    """
+    Reads of 40 and 50 bases with some Ns, duplicates, and an overrepresented sequence,
+    gzipped, along with the sequences written.
+    """
+    rng = random.Random(0)
+    sequences = []
+    for i in range(NUM_READS):
+        if i % 50 == 7:
+            sequence = OVERREPRESENTED
+        elif sequences and i % 10 == 3:
+            sequence = sequences[rng.randrange(len(sequences))]
+        else:
+            sequence = ''.join([rng.choice('ACGT') for _ in range(rng.choice([40, 50]))])
+            if i % 100 == 11:
+                sequence = sequence[:5] + 'N' + sequence[6:]
+        sequences.append(sequence)
+    fastq_filepath = str(tmpdir_factory.mktemp('fastq').join('reads.fastq.gz'))
+    with gzip.open(fastq_filepath, 'wb') as fastq_file:
+        for i, sequence in enumerate(sequences):
+            qualities = ''.join([chr(33 + rng.randrange(2, 41)) for _ in sequence])
+            fastq_file.write('@read{}\n{}\n+\n{}\n'.format(i, sequence, qualities).encode())
+    return fastq_filepath, sequences
+
+
+def builtin_report(fastq_filepath, output_dir):
+    stats = fastq_tools.run_fastq_qc(fastq_filepath, output_dir)
+    report_dir = os.path.join(output_dir, os.listdir(output_dir)[0])
+    return stats, read_fastqc_data(os.path.join(report_dir, 'fastqc_data.txt'))
+
+
+def test_basic_statistics(fastq, tmpdir):
+    fastq_filepath, sequences = fastq
+    stats, (_, modules) = builtin_report(fastq_filepath, str(tmpdir.join('builtin')))
+    assert stats == {'lines': 4 * NUM_READS, 'reads': NUM_READS, 'bases': sum(map(len, sequences))}
+
+    modules = dict([(module[0], module) for module in modules])
+    basic_statistics = dict(modules['Basic Statistics'][3])
+    called = ''.join(sequences).replace('N', '')
+    assert basic_statistics['Filename'] == 'reads.fastq.gz'
+    assert basic_statistics['Total Sequences'] == str(NUM_READS)
+    assert basic_statistics['Sequence length'] == '40-50'
+    assert basic_statistics['%GC'] == str(100 * (called.count('G') + called.count('C')) // len(called))
+    assert modules['Sequence Length Distribution'][3] == [
+        ['40', str(float(sum([len(sequence) == 40 for sequence in sequences])))],
+        ['50', str(float(sum([len(sequence) == 50 for sequence in sequences])))]
+    ]
+    num_overrepresented = sequences.count(OVERREPRESENTED)
+    assert modules['Overrepresented sequences'][3][0][:3] == [
+        OVERREPRESENTED, str(num_overrepresented), str(100.0 * num_overrepresented / NUM_READS)
+    ]
+
+
+def test_compare_modules(fastq, tmpdir):
+    fastq_filepath, _ = fastq
+    _, (_, modules) = builtin_report(fastq_filepath, str(tmpdir.join('builtin')))
+    assert compare_modules(modules, modules, 0.0) == []
+
+    name, status, headers, rows = modules[1]
+    changed_rows = [rows[0][:1] + [str(float(rows[0][1]) * 1.01)] + rows[0][2:]] + rows[1:]
+    changed = modules[:1] + [(name, status, headers, changed_rows)] + modules[2:]
+    assert compare_modules(changed, modules, 0.1) == []
+    assert len(compare_modules(changed, modules, 1e-3)) == 1
+    assert len(compare_modules(modules[::-1], modules, 0.0)) == 1
+
+
+@pytest.mark.skipif(find_fastqc() is None, reason='FastQC is not installed')
+def test_matches_fastqc(fastq, tmpdir):
+    fastq_filepath, _ = fastq
+    _, (_, modules) = builtin_report(fastq_filepath, str(tmpdir.join('builtin')))
+    _, expected_modules = read_fastqc_data(run_fastqc(find_fastqc(), fastq_filepath, str(tmpdir.join('fastqc'))))
+    assert len(set([module[0] for module in modules]) & set([module[0] for module in expected_modules])) >= 10
+    assert compare_modules(modules, expected_modules, 1e-3) == []
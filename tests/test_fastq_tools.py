@@ -0,0 +1,160 @@
+"""
+Tests of the read statistics in fastq_tools: counts of BGZF FASTQs, split across
+processes or not and checked against zcat, of other gzip files, and their cache across
+runs, bounded in size and read without being rewritten; and of the cleanup of a
+TrimmedStream whose aligner never read it.
+"""
+import os
+import sys
+import gzip
+import json
+import zlib
+import struct
+import subprocess
+import pytest
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import fastq_tools
+
+
+def fastq_records(num_reads):
+    return b''.join([b'@read%d\n%s\n+\n%s\n' % (i, b'ACGT' * (i % 7 + 1), b'I' * 4 * (i % 7 + 1))
+                     for i in range(num_reads)])
+
+
+def write_bgzf(filepath, data, block_data_size=1000):
+    """Writes data as BGZF blocks of block_data_size uncompressed bytes, with an EOF block."""
+    with open(filepath, 'wb') as bgzf_file:
+        for start in list(range(0, len(data), block_data_size)) + [len(data)]:
+            block = data[start:start + block_data_size]
+            compress = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            deflated = compress.compress(block) + compress.flush()
+            bgzf_file.write(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' +
+                            struct.pack('<H', len(deflated) + 25) + deflated +
+                            struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block)))
+
+
+@pytest.fixture
+def line_count_cache(tmpdir, monkeypatch):
+    cache_filepath = str(tmpdir.join('line_counts.json'))
+    monkeypatch.setattr(fastq_tools, 'LINE_COUNT_CACHE', cache_filepath)
+    monkeypatch.setattr(fastq_tools, 'LINE_COUNT_CACHE_HITS', {})
+    return cache_filepath
+
+
+def expected_stats(data):
+    lines = data.split(b'\n')[:-1]
+    return {'lines': len(lines), 'reads': len(lines) // 4, 'bases': sum([len(line) for line in lines[1::4]])}
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_bgzf_stats(tmpdir, line_count_cache, monkeypatch, processes):
+    monkeypatch.setattr(fastq_tools, 'FASTQ_STATS_PARALLEL_MIN_SIZE', 0)
+    monkeypatch.setattr(fastq_tools, 'FASTQ_STATS_PROCESSES', processes)
+    data = fastq_records(2000)
+    fastq_filepath = str(tmpdir.join('reads.fastq.gz'))
+    write_bgzf(fastq_filepath, data)
+    assert fastq_tools.fastq_stats(fastq_filepath) == expected_stats(data)
+
+
+def zcat_stats(filepath):
+    """Lines, reads, and bases of a gzipped FASTQ, counted by zcat, wc, and awk."""
+    lines = int(subprocess.check_output('zcat {} | wc -l'.format(filepath), shell=True))
+    bases = int(subprocess.check_output("zcat {} | awk 'NR % 4 == 2 {{n += length($0)}} END {{print n + 0}}'"
+                                        .format(filepath), shell=True))
+    return {'lines': lines, 'reads': lines // 4, 'bases': bases}
+
+
+@pytest.mark.skipif(find_executable('zcat') is None, reason='zcat is not installed')
+@pytest.mark.parametrize('processes, block_data_size', [(1, 65280), (2, 65280), (4, 777), (7, 4096)])
+def test_bgzf_stats_match_zcat(tmpdir, line_count_cache, monkeypatch, processes, block_data_size):
+    monkeypatch.setattr(fastq_tools, 'FASTQ_STATS_PARALLEL_MIN_SIZE', 0)
+    monkeypatch.setattr(fastq_tools, 'FASTQ_STATS_PROCESSES', processes)
+    fastq_filepath = str(tmpdir.join('reads.fastq.gz'))
+    write_bgzf(fastq_filepath, fastq_records(20000), block_data_size)
+    assert fastq_tools.fastq_stats(fastq_filepath) == zcat_stats(fastq_filepath)
+
+
+def test_gzip_stats(tmpdir, line_count_cache):
+    data = fastq_records(2000)
+    fastq_filepath = str(tmpdir.join('reads.fastq.gz'))
+    with gzip.open(fastq_filepath, 'wb') as fastq_file:
+        fastq_file.write(data)
+    assert fastq_tools.fastq_stats(fastq_filepath) == expected_stats(data)
+
+
+def test_cached_stats_follow_file_changes(tmpdir, line_count_cache, monkeypatch):
+    data = fastq_records(100)
+    fastq_filepath = str(tmpdir.join('reads.fastq.gz'))
+    write_bgzf(fastq_filepath, data)
+    assert fastq_tools.fastq_stats(fastq_filepath) == expected_stats(data)
+    assert os.path.isfile(line_count_cache)
+
+    def not_counted(block_range):
+        raise AssertionError('counted {} again'.format(block_range[0]))
+
+    monkeypatch.setattr(fastq_tools, 'summarize_bgzf_range', not_counted)
+    assert fastq_tools.fastq_stats(fastq_filepath) == expected_stats(data)
+
+    monkeypatch.undo()
+    monkeypatch.setattr(fastq_tools, 'LINE_COUNT_CACHE', line_count_cache)
+    monkeypatch.setattr(fastq_tools, 'LINE_COUNT_CACHE_HITS', {})
+    data = fastq_records(150)
+    write_bgzf(fastq_filepath, data)
+    assert fastq_tools.fastq_stats(fastq_filepath) == expected_stats(data)
+
+
+def test_cache_hits_are_read_only(tmpdir, line_count_cache, monkeypatch):
+    data = fastq_records(100)
+    fastq_filepath = str(tmpdir.join('reads.fastq.gz'))
+    write_bgzf(fastq_filepath, data)
+    fastq_tools.fastq_stats(fastq_filepath)
+
+    def not_written(update):
+        raise AssertionError('rewrote the cache on a hit')
+
+    monkeypatch.setattr(fastq_tools, 'update_line_count_cache', not_written)
+    assert fastq_tools.fastq_stats(fastq_filepath) == expected_stats(data)
+    assert list(fastq_tools.LINE_COUNT_CACHE_HITS) == [fastq_filepath]
+
+
+def test_cache_evicts_least_recently_used_by_size(tmpdir, line_count_cache, monkeypatch):
+    fastq_filepaths = []
+    for i in range(3):
+        fastq_filepaths.append(str(tmpdir.join('reads{}.fastq.gz'.format(i))))
+        write_bgzf(fastq_filepaths[-1], fastq_records(100 + i))
+        fastq_tools.fastq_stats(fastq_filepaths[-1])
+    entry_size = os.path.getsize(line_count_cache) // 3
+
+    # A hit on the oldest entry is saved with the next one stored, so the second is evicted
+    monkeypatch.setattr(fastq_tools, 'LINE_COUNT_CACHE_MAX_SIZE', 3 * entry_size + entry_size // 2)
+    fastq_tools.fastq_stats(fastq_filepaths[0])
+    fastq_filepaths.append(str(tmpdir.join('reads3.fastq.gz')))
+    write_bgzf(fastq_filepaths[-1], fastq_records(103))
+    fastq_tools.fastq_stats(fastq_filepaths[-1])
+    with open(line_count_cache) as cache_file:
+        cached = json.load(cache_file)
+    assert os.path.getsize(line_count_cache) <= 3 * entry_size + entry_size // 2
+    assert sorted(cached) == sorted([fastq_filepaths[0], fastq_filepaths[2], fastq_filepaths[3]])
+
+
+def test_trimmed_stream_cleans_up_after_failed_aligner(tmpdir):
+    trimmed_filepaths = [str(tmpdir.join('read1.trimmed.fastq')), str(tmpdir.join('read2.trimmed.fastq'))]
+    tmp_dir = str(tmpdir.mkdir('tmp'))
+    trimmed_stream = fastq_tools.TrimmedStream(trimmed_filepaths, tmp_dir)
+
+    def trim():
+        for source_filepath in trimmed_stream.source_filepaths:
+            with open(source_filepath, 'wb') as source:
+                source.write(fastq_records(100))
+        return 'trimmed'
+
+    # The aligner exits without opening either trimmed pipe
+    trimmed_stream.start(trim)
+    assert trimmed_stream.wait() == 'trimmed'
+    assert not any([os.path.exists(filepath) for filepath in trimmed_filepaths])
+    assert os.listdir(tmp_dir) == []
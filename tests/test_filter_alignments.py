@@ -0,0 +1,280 @@
+"""
+Tests of atacseq's alignment filter chain on a synthetic coordinate-sorted BAM of read
+pairs: filtering in parallel writes the same reads, counts, and collected metrics as
+filtering serially. Pairs are spread over a few references, with duplicates, low
+mapping qualities, base qualities, short templates, mates on other references, reads
+without a mate sharing ends with pairs, and unmapped reads with and without a position
+among them. Pairs with mates on other references are deferred to a serial pass and put
+back in place, in the filtered BAM and the fragment class BAMs.
+"""
+import os
+import bisect
+import random
+import pytest
+
+pytest.importorskip('numpy')
+pysam = pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+REFERENCES = [('chr1', 12000000), ('chr2', 9000000), ('chrX', 6000000), ('chrM', 16569)]
+READ_LENGTH = 50
+NUM_PAIRS = 5000
+
+
+def write_bam(bam_filepath, num_pairs, seed, spanning_template_lengths=False):
+    """
+    Writes num_pairs synthetic read pairs to a coordinate-sorted, indexed BAM. Pairs with
+    mates on different references have a template length of 0, as in the SAM spec, unless
+    spanning_template_lengths is set.
+    """
+    rng = random.Random(seed)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': name, 'LN': length} for name, length in REFERENCES]}
+    cumulative_weights = []
+    for _, length in REFERENCES:
+        cumulative_weights.append(length + (cumulative_weights[-1] if cumulative_weights else 0))
+    fragments = []
+    for i in range(num_pairs):
+        if fragments and rng.random() < 0.2:
+            fragment = fragments[rng.randrange(len(fragments))]
+        else:
+            reference_id = bisect.bisect(cumulative_weights, rng.random() * cumulative_weights[-1])
+            start = rng.randrange(REFERENCES[reference_id][1] - 1000)
+            template_length = rng.randrange(20, 600)
+            mate_reference_id, mate_start = reference_id, max(start + template_length - READ_LENGTH, 0)
+            if rng.random() < 0.05:
+                mate_reference_id = rng.randrange(len(REFERENCES) - 1)
+                mate_start = rng.randrange(REFERENCES[mate_reference_id][1] - 1000)
+            fragment = (reference_id, start, template_length, mate_reference_id, mate_start)
+        fragments.append(fragment)
+
+    reads = []
+    for i, (reference_id, start, template_length, mate_reference_id, mate_start) in enumerate(fragments):
+        unmapped = rng.random() < 0.01
+        mapq = rng.choice([0, 5, 30, 60, 60, 60])
+        for mate in range(2):
+            read = pysam.AlignedSegment()
+            read.query_name = 'pair{}'.format(i)
+            read.query_sequence = 'A' * READ_LENGTH
+            read.query_qualities = pysam.qualitystring_to_array(chr(33 + rng.randrange(10, 41)) * READ_LENGTH)
+            own = (reference_id, start) if mate == 0 else (mate_reference_id, mate_start)
+            other = (mate_reference_id, mate_start) if mate == 0 else (reference_id, start)
+            read.flag = 0x1 | (0x40 if mate == 0 else 0x80) | (0x10 if mate == 1 else 0x20)
+            if unmapped and mate == 1:
+                read.flag |= 0x4
+            if unmapped and mate == 0:
+                read.flag |= 0x8
+            read.reference_id, read.reference_start = own
+            read.next_reference_id, read.next_reference_start = other
+            if not read.is_unmapped:
+                read.cigarstring = '{}M'.format(READ_LENGTH)
+                read.mapping_quality = mapq
+            if (own[0] == other[0] or spanning_template_lengths) and not unmapped:
+                read.template_length = template_length if mate == 0 else -template_length
+            if own[0] == other[0] and not unmapped:
+                read.flag |= 0x2
+            reads.append(read)
+        if rng.random() < 0.05:
+            read = pysam.AlignedSegment()
+            read.query_name = 'single{}'.format(i)
+            read.query_sequence = 'A' * READ_LENGTH
+            read.query_qualities = pysam.qualitystring_to_array(chr(33 + rng.randrange(10, 41)) * READ_LENGTH)
+            read.reference_id, read.reference_start = reference_id, start
+            read.cigarstring = '{}M'.format(READ_LENGTH)
+            read.mapping_quality = mapq
+            reads.append(read)
+
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    with pysam.AlignmentFile(bam_filepath, 'wb', header=header) as bam:
+        for read in reads:
+            bam.write(read)
+        # Unmapped pairs without a position sort last
+        for i in range(num_pairs // 100):
+            for mate in range(2):
+                read = pysam.AlignedSegment()
+                read.query_name = 'unplaced{}'.format(i)
+                read.query_sequence = 'A' * READ_LENGTH
+                read.query_qualities = pysam.qualitystring_to_array('I' * READ_LENGTH)
+                read.flag = 0x1 | 0x4 | 0x8 | (0x40 if mate == 0 else 0x80)
+                read.reference_id = read.next_reference_id = -1
+                read.reference_start = read.next_reference_start = -1
+                bam.write(read)
+    pysam.index(bam_filepath)
+
+
+def read_filters(output_prefix, header, steric=True):
+    """
+    The filter chain atacseq step 4 runs, with an empty blacklist, and optionally
+    without the steric filter, which drops every pair with mates on different references.
+    """
+    return ([atacseq.TemplateLengthFilter('steric', min_length=atacseq.STERIC_HINDRANCE_CUTOFF)]
+            if steric else []) + [
+        atacseq.DuplicateFilter('duplicates', libraries={}),
+        atacseq.FlagFilter('unique', exclude_flags=atacseq.UNIQUE_EXCLUDE_FLAGS,
+                           min_mapq=atacseq.UNIQUE_MIN_MAPQ),
+        atacseq.FlagFilter('unmapped', exclude_flags=atacseq.UNMAPPED_EXCLUDE_FLAGS),
+        atacseq.ReferenceFilter('chromosome', atacseq.KEPT_CHROMOSOMES),
+        atacseq.BlacklistFilter('blacklist', index={}, min_overlap_fraction=0.5),
+        atacseq.InsertSizeCollector('insert_size'),
+        atacseq.FragmentClassWriter('fragment_classes', output_prefix=output_prefix, header=header)
+    ]
+
+
+def bam_reads(bam_filepath):
+    with pysam.AlignmentFile(bam_filepath, 'rb') as bam:
+        return [read.to_string() for read in bam.fetch(until_eof=True)]
+
+
+def is_sorted(bam_filepath):
+    with pysam.AlignmentFile(bam_filepath, 'rb') as bam:
+        positions = [(read.reference_id % (1 << 31), read.reference_start) for read in bam.fetch(until_eof=True)]
+    return positions == sorted(positions)
+
+
+def filter_result(output_dir, input_bam_filepath, name, steric, processes):
+    """Filters the BAM serially, or in parallel with processes, and returns everything written."""
+    output_prefix = os.path.join(output_dir, name)
+    with pysam.AlignmentFile(input_bam_filepath, 'rb') as input_bam:
+        filters = read_filters(output_prefix, input_bam.header.to_dict(), steric)
+    if processes is None:
+        num_reads_in, num_reads_out = atacseq.Pipeline.filter_alignments(
+            input_bam_filepath, output_prefix + '.bam', filters)
+    else:
+        num_reads_in, num_reads_out = atacseq.Pipeline.filter_alignments_parallel(
+            input_bam_filepath, output_prefix + '.bam', filters, processes, output_dir)
+    duplicate_filter = [read_filter for read_filter in filters if read_filter.name == 'duplicates'][0]
+    insert_size_collector, fragment_class_writer = filters[-2:]
+    insert_size_collector.flush()
+    return {
+        'counts': (num_reads_in, num_reads_out),
+        'dropped': [(read_filter.name, read_filter.dropped) for read_filter in filters],
+        'duplication_metrics': duplicate_filter.metrics,
+        'insert_sizes': dict((orientation, list(histogram))
+                             for orientation, histogram in insert_size_collector.histograms.items()),
+        'reads': bam_reads(output_prefix + '.bam'),
+        'fragment_classes': [bam_reads(fragment_class_writer.class_filepath(class_index))
+                             for class_index in range(len(atacseq.FRAGMENT_CLASSES))]
+    }
+
+
+@pytest.fixture(scope='module')
+def input_bam(tmpdir_factory):
+    bam_filepath = str(tmpdir_factory.mktemp('input').join('input.bam'))
+    write_bam(bam_filepath, NUM_PAIRS, seed=0)
+    return bam_filepath
+
+
+@pytest.mark.parametrize('steric', [True, False])
+@pytest.mark.parametrize('processes', [2, 3])
+def test_parallel_matches_serial(tmpdir, input_bam, steric, processes):
+    expected = filter_result(str(tmpdir), input_bam, 'serial', steric, None)
+    assert expected['counts'][1] == len(expected['reads'])
+    assert dict(expected['dropped'])['duplicates'] > 0
+    assert filter_result(str(tmpdir), input_bam, 'parallel', steric, processes) == expected
+
+
+def test_pairs_across_references_are_deferred(tmpdir, input_bam, monkeypatch):
+    """Without the steric filter, pairs spanning references go through the serial pass."""
+    inserted = []
+    interleave_reads = atacseq.interleave_reads
+
+    def spy_interleave_reads(reads, inserted_reads):
+        inserted_reads = list(inserted_reads)
+        inserted.extend([read for _, read in inserted_reads])
+        return interleave_reads(reads, inserted_reads)
+
+    monkeypatch.setattr(atacseq, 'interleave_reads', spy_interleave_reads)
+    filter_result(str(tmpdir), input_bam, 'parallel', False, 2)
+    assert inserted
+    assert all([read.reference_id != read.next_reference_id for read in inserted])
+    assert [filename for filename in os.listdir(str(tmpdir)) if '.shard' in filename or 'deferred' in filename] == []
+
+
+def test_deferred_fragment_classes_stay_sorted(tmpdir):
+    """Deferred pairs with a template length are put back in place in the fragment class BAMs."""
+    input_bam_filepath = str(tmpdir.join('spanning.bam'))
+    write_bam(input_bam_filepath, NUM_PAIRS, seed=1, spanning_template_lengths=True)
+    expected = filter_result(str(tmpdir), input_bam_filepath, 'serial', False, None)
+    assert filter_result(str(tmpdir), input_bam_filepath, 'parallel', False, 2) == expected
+
+    spanning = 0
+    for class_index in range(len(atacseq.FRAGMENT_CLASSES)):
+        class_bam_filepath = str(tmpdir.join('parallel.{}.bam'.format(atacseq.FRAGMENT_CLASSES[class_index][0])))
+        assert is_sorted(class_bam_filepath)
+        with pysam.AlignmentFile(class_bam_filepath, 'rb') as class_bam:
+            spanning += sum([read.reference_id != read.next_reference_id for read in class_bam.fetch(until_eof=True)])
+    assert spanning > 0
+
+
+def make_read(name, reference_id, start, mate_reference_id, mate_start, flag, quality=30, template_length=0):
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.query_sequence = 'A' * READ_LENGTH
+    read.query_qualities = pysam.qualitystring_to_array(chr(33 + quality) * READ_LENGTH)
+    read.flag = flag
+    read.reference_id, read.reference_start = reference_id, start
+    read.next_reference_id, read.next_reference_start = mate_reference_id, mate_start
+    read.cigarstring = '{}M'.format(READ_LENGTH)
+    read.mapping_quality = 60
+    read.template_length = template_length
+    return read
+
+
+def test_deferred_pair_is_put_back(tmpdir):
+    """A pair across chr1 and chr2 and its duplicate: the better one is kept, in place on both."""
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': name, 'LN': length} for name, length in REFERENCES]}
+    reads = []
+    for i, start in enumerate([100, 300, 700]):
+        for reference_id in [0, 1]:
+            name = 'local{}.{}'.format(reference_id, i)
+            reads.append(make_read(name, reference_id, start, reference_id, start + 200, 0x1 | 0x2 | 0x20 | 0x40,
+                                   template_length=250))
+            reads.append(make_read(name, reference_id, start + 200, reference_id, start, 0x1 | 0x2 | 0x10 | 0x80,
+                                   template_length=-250))
+    for name, quality in [('spanning', 35), ('spanning_duplicate', 20)]:
+        reads.append(make_read(name, 0, 500, 1, 400, 0x1 | 0x20 | 0x40, quality, template_length=200))
+        reads.append(make_read(name, 1, 400, 0, 500, 0x1 | 0x10 | 0x80, quality, template_length=-200))
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    input_bam_filepath = str(tmpdir.join('pairs.bam'))
+    with pysam.AlignmentFile(input_bam_filepath, 'wb', header=header) as bam:
+        for read in reads:
+            bam.write(read)
+    pysam.index(input_bam_filepath)
+
+    outputs = {}
+    for name, processes in [('serial', None), ('parallel', 2)]:
+        output_prefix = str(tmpdir.join(name))
+        filters = [atacseq.DuplicateFilter('duplicates', libraries={}),
+                   atacseq.FragmentClassWriter('fragment_classes', output_prefix=output_prefix, header=header)]
+        if processes is None:
+            counts = atacseq.Pipeline.filter_alignments(input_bam_filepath, output_prefix + '.bam', filters)
+        else:
+            counts = atacseq.Pipeline.filter_alignments_parallel(input_bam_filepath, output_prefix + '.bam',
+                                                                 filters, processes, str(tmpdir))
+        with pysam.AlignmentFile(output_prefix + '.bam', 'rb') as output_bam:
+            names = [(read.query_name, read.reference_id, read.reference_start)
+                     for read in output_bam.fetch(until_eof=True)]
+        with pysam.AlignmentFile(output_prefix + '.mono.bam', 'rb') as class_bam:
+            class_names = [(read.query_name, read.reference_id, read.reference_start)
+                           for read in class_bam.fetch(until_eof=True)]
+        outputs[name] = (counts, filters[0].dropped, names, class_names)
+
+    assert outputs['parallel'] == outputs['serial']
+    counts, dropped, names, class_names = outputs['parallel']
+    assert counts == (len(reads), len(reads) - 2) and dropped == 2
+    assert [name for name in names if name[0].startswith('spanning')] == [('spanning', 0, 500), ('spanning', 1, 400)]
+    assert [name for name in class_names if name[0].startswith('spanning')] == [('spanning', 0, 500),
+                                                                                ('spanning', 1, 400)]
+    for written in [names, class_names]:
+        assert [name[1:] for name in written] == sorted([name[1:] for name in written])
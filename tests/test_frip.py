@@ -0,0 +1,92 @@
+"""
+Tests of atacseq's fraction of reads in peaks on a synthetic BAM: the shifted records
+counted in peaks against a direct overlap check of every record with every peak.
+"""
+import os
+import random
+import pytest
+
+np = pytest.importorskip('numpy')
+pysam = pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+GENOME_SIZES = {'chr1': 20000, 'chr2': 10000, 'chrM': 2000}
+PEAKS = [('chr1', 1000, 1200), ('chr1', 1200, 1500), ('chr1', 5000, 5300), ('chr1', 19800, 20000),
+         ('chr2', 0, 150), ('chr2', 7000, 7400)]
+
+
+def write_bam(bam_filepath, num_pairs, seed):
+    """Read pairs, half of them around the peaks and half anywhere in the genome."""
+    rng = random.Random(seed)
+    chroms = sorted(GENOME_SIZES)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': GENOME_SIZES[chrom]} for chrom in chroms]}
+    reads = []
+    for i in range(num_pairs):
+        if rng.random() < 0.5:
+            chrom, peak_start, peak_end = rng.choice(PEAKS)
+            start = rng.randrange(max(peak_start - 100, 0), peak_end)
+        else:
+            chrom = rng.choice(chroms)
+            start = rng.randrange(GENOME_SIZES[chrom])
+        template_length = rng.choice([60, 180, 250])
+        start = min(start, GENOME_SIZES[chrom] - template_length)
+        for mate in range(2):
+            read = pysam.AlignedSegment()
+            read.query_name = 'pair{}'.format(i)
+            read.query_sequence = 'A' * 36
+            read.flag = 0x1 | 0x2 | (0x40 | 0x20 if mate == 0 else 0x80 | 0x10)
+            read.reference_id = read.next_reference_id = chroms.index(chrom)
+            read.reference_start = start if mate == 0 else start + template_length - 36
+            read.next_reference_start = start + template_length - 36 if mate == 0 else start
+            read.cigarstring = '36M'
+            read.mapping_quality = 60
+            read.template_length = template_length if mate == 0 else -template_length
+            reads.append(read)
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    with pysam.AlignmentFile(bam_filepath, 'wb', header=header) as bam:
+        for read in reads:
+            bam.write(read)
+
+
+def test_frip_matches_overlaps(tmpdir, monkeypatch):
+    monkeypatch.setattr(atacseq, 'SHIFT_READS_CHUNK_SIZE', 4096)
+    bam_filepath = str(tmpdir.join('reads.bam'))
+    write_bam(bam_filepath, 2000, seed=0)
+    bed_filepath = str(tmpdir.join('reads.processed.bed'))
+    atacseq.Pipeline.bam_to_shifted_bed(bam_filepath, bed_filepath, GENOME_SIZES, str(tmpdir.join('shift.log')),
+                                        atacseq.MINUS_STRAND_SHIFT, atacseq.PLUS_STRAND_SHIFT)
+    peaks_bed_filepath = str(tmpdir.join('peaks.bed'))
+    with open(peaks_bed_filepath, 'w') as peaks_bed:
+        peaks_bed.write(''.join(['{}\t{}\t{}\n'.format(*peak) for peak in PEAKS]))
+
+    with open(bed_filepath) as bed:
+        records = [line.split('\t')[:3] for line in bed]
+    expected_in_peaks = sum([any(chrom == peak_chrom and int(start) < peak_end and peak_start < int(end)
+                                 for peak_chrom, peak_start, peak_end in PEAKS)
+                             for chrom, start, end in records])
+    assert 0 < expected_in_peaks < len(records)
+
+    peak_index = atacseq.Pipeline.load_peak_index(peaks_bed_filepath)
+    assert sorted(peak_index) == ['chr1', 'chr2']
+    assert peak_index['chr1'][0].tolist() == [1000, 1200, 5000, 19800]
+    assert atacseq.Pipeline.count_reads_in_peaks(bed_filepath, peak_index) == (len(records), expected_in_peaks)
+
+
+def test_book_ended_records_are_outside(tmpdir):
+    bed_filepath = str(tmpdir.join('reads.bed'))
+    with open(bed_filepath, 'w') as bed:
+        bed.write('chr1\t900\t1000\tr0/1\t60\t+\nchr1\t999\t1001\tr1/1\t60\t-\n'
+                  'chr1\t1500\t1600\tr2/1\t60\t+\nchrM\t100\t200\tr3/1\t60\t+\n')
+    peak_index = {'chr1': (np.array([1000], dtype=np.int64), np.array([1500], dtype=np.int64))}
+    assert atacseq.Pipeline.count_reads_in_peaks(bed_filepath, peak_index) == (4, 1)
@@ -0,0 +1,145 @@
+"""
+Tests of atacseq's insert size metrics, in place of Picard CollectInsertSizeMetrics, on
+read pairs of known template lengths: which reads are counted, in which orientation,
+and the median, deviation, trimmed mean and standard deviation, and widths written,
+against the same statistics computed directly from the template lengths.
+"""
+import os
+import math
+import random
+import pytest
+
+np = pytest.importorskip('numpy')
+pysam = pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+HEADER = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 1000000}]})
+
+
+def make_pair(start, template_length, orientation='FR', flags=0):
+    """
+    Both mates of a pair, the first forward and upstream, or reverse and upstream if RF,
+    or both forward if TANDEM.
+    """
+    mates = []
+    for mate in range(2):
+        read = pysam.AlignedSegment(HEADER)
+        read.query_name = 'pair{}'.format(start)
+        read.query_sequence = 'A' * 50
+        read.cigarstring = '50M'
+        read.reference_id = read.next_reference_id = 0
+        mate_starts = [start, start + template_length - 50]
+        read.reference_start, read.next_reference_start = mate_starts[mate], mate_starts[1 - mate]
+        first_reverse = orientation == 'RF'
+        reverse = [first_reverse, not first_reverse] if orientation != 'TANDEM' else [False, False]
+        read.flag = (0x1 | (0x40 if mate == 0 else 0x80) | (0x10 if reverse[mate] else 0) |
+                     (0x20 if reverse[1 - mate] else 0) | flags)
+        read.template_length = template_length if read.reference_start <= read.next_reference_start \
+            else -template_length
+        mates.append(read)
+    return mates
+
+
+def expected_metrics(insert_sizes):
+    """Picard's InsertSizeMetrics columns computed directly from a list of insert sizes."""
+    insert_sizes = sorted(insert_sizes)
+
+    def median(values):
+        values = sorted(values)
+        return (values[(len(values) - 1) // 2] + values[len(values) // 2]) / 2.0
+
+    insert_median = median(insert_sizes)
+    mad = median([abs(insert_size - insert_median) for insert_size in insert_sizes])
+    trimmed = [insert_size for insert_size in insert_sizes
+               if insert_size <= insert_median + atacseq.INSERT_SIZE_DEVIATIONS * mad]
+    mean = float(sum(trimmed)) / len(trimmed)
+    standard_deviation = math.sqrt(sum([(insert_size - mean) ** 2 for insert_size in trimmed]) / (len(trimmed) - 1))
+    widths = []
+    for percent in atacseq.INSERT_SIZE_WIDTH_PERCENTS:
+        half_width = 0
+        while sum([abs(insert_size - int(insert_median)) <= half_width
+                   for insert_size in insert_sizes]) < len(insert_sizes) * percent / 100.0:
+            half_width += 1
+        widths.append(2 * half_width + 1)
+    return ([insert_median, mad, insert_sizes[0], insert_sizes[-1], mean, standard_deviation, len(insert_sizes)],
+            widths)
+
+
+def read_metrics(metrics_filepath):
+    """The metrics rows by orientation, and the histogram rows, of a metrics file."""
+    with open(metrics_filepath) as metrics_file:
+        sections = metrics_file.read().split('\n\n')
+    metrics_lines = sections[1].strip().split('\n')[1:]
+    columns = metrics_lines[0].split('\t')
+    rows = dict((row['PAIR_ORIENTATION'], row)
+                for row in [dict(zip(columns, line.split('\t'))) for line in metrics_lines[1:]])
+    histogram = [line.split('\t') for line in sections[2].strip().split('\n')[2:]] if len(sections) > 2 else []
+    return rows, histogram
+
+
+def test_metrics_match_template_lengths(tmpdir):
+    rng = random.Random(0)
+    fr_sizes = [rng.choice([80, 120, 150, 151, 200, 210, 400]) + rng.randrange(40) for _ in range(500)]
+    fr_sizes += [9000, 9500]
+    rf_sizes = [rng.randrange(110, 300) for _ in range(60)]
+    tandem_sizes = [rng.randrange(100, 300) for _ in range(10)]
+
+    reads = []
+    for insert_sizes, orientation in [(fr_sizes, 'FR'), (rf_sizes, 'RF'), (tandem_sizes, 'TANDEM')]:
+        for insert_size in insert_sizes:
+            reads.extend(make_pair(rng.randrange(100000), insert_size, orientation))
+    # Neither secondary nor duplicate pairs, nor pairs with an unmapped mate, are counted
+    for flags in [0x100, 0x400, 0x8]:
+        reads.extend(make_pair(rng.randrange(100000), 250, 'FR', flags))
+    rng.shuffle(reads)
+
+    collector = atacseq.InsertSizeCollector('insert_size')
+    assert list(collector.filter(reads)) == reads
+    metrics_filepath = str(tmpdir.join('insert_sizes.txt'))
+    atacseq.Pipeline.write_insert_size_metrics(collector, metrics_filepath, str(tmpdir.join('insert_sizes.pdf')),
+                                               'reads.bam')
+    rows, histogram = read_metrics(metrics_filepath)
+
+    # TANDEM holds under INSERT_SIZE_MINIMUM_PCT of the pairs, so it isn't written
+    assert sorted(rows) == ['FR', 'RF']
+    for orientation, insert_sizes in [('FR', fr_sizes), ('RF', rf_sizes)]:
+        metrics, widths = expected_metrics(insert_sizes)
+        row = rows[orientation]
+        assert [float(row[column]) for column in ['MEDIAN_INSERT_SIZE', 'MEDIAN_ABSOLUTE_DEVIATION',
+                                                  'MIN_INSERT_SIZE', 'MAX_INSERT_SIZE', 'MEAN_INSERT_SIZE',
+                                                  'STANDARD_DEVIATION', 'READ_PAIRS']] == \
+            pytest.approx(metrics, abs=1e-6)
+        assert [int(row['WIDTH_OF_{}_PERCENT'.format(percent)])
+                for percent in atacseq.INSERT_SIZE_WIDTH_PERCENTS] == widths
+
+    # The FR outliers are trimmed from the histogram, as from the mean
+    assert [int(line[0]) for line in histogram] == sorted(set([insert_size for insert_size in fr_sizes + rf_sizes
+                                                               if insert_size < 9000]))
+    assert sum([int(line[1]) for line in histogram]) == len(fr_sizes) - 2
+
+
+def test_parallel_collectors_merge(tmpdir):
+    rng = random.Random(1)
+    reads = []
+    for _ in range(200):
+        reads.extend(make_pair(rng.randrange(100000), rng.randrange(60, 700)))
+    whole = atacseq.InsertSizeCollector('insert_size')
+    list(whole.filter(reads))
+    halves = [atacseq.InsertSizeCollector('insert_size') for _ in range(2)]
+    list(halves[0].filter(reads[:150]))
+    list(halves[1].filter(reads[150:]))
+    halves[0].merge(halves[1])
+    whole.flush()
+    for orientation in atacseq.InsertSizeCollector.ORIENTATIONS:
+        assert (halves[0].histograms[orientation] == whole.histograms[orientation]).all()
+        assert halves[0].max_insert_size[orientation] == whole.max_insert_size[orientation]
@@ -0,0 +1,73 @@
+"""
+Tests of LaneStream, which hands cutadapt the lanes of each mate as one FASTQ: the
+lanes, gzipped or not, read through its named pipe in order, as zcat would concatenate
+them, for both mates at once, and its cleanup when the reader fails or never starts.
+"""
+import os
+import sys
+import gzip
+import subprocess
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import fastq_tools
+
+
+def write_lanes(tmpdir, mate, num_lanes):
+    """Lanes of one mate, every other one gzipped. Returns their paths and their reads."""
+    lane_filepaths, reads = [], b''
+    for lane in range(num_lanes):
+        lane_reads = b''.join([b'@lane%d_read%d/%d\nACGTACGT\n+\nIIIIIIII\n' % (lane, i, mate)
+                               for i in range(1000 * (lane + 1))])
+        if lane % 2 == 0:
+            lane_filepaths.append(str(tmpdir.join('reads_L00{}_R{}.fastq.gz'.format(lane, mate))))
+            with gzip.open(lane_filepaths[-1], 'wb') as lane_file:
+                lane_file.write(lane_reads)
+        else:
+            lane_filepaths.append(str(tmpdir.join('reads_L00{}_R{}.fastq'.format(lane, mate))))
+            with open(lane_filepaths[-1], 'wb') as lane_file:
+                lane_file.write(lane_reads)
+        reads += lane_reads
+    return lane_filepaths, reads
+
+
+def test_single_lane_read_as_is(tmpdir):
+    lane_filepaths, _ = write_lanes(tmpdir, 1, 1)
+    fifo_filepath = str(tmpdir.join('combined.fastq'))
+    with fastq_tools.LaneStream(lane_filepaths, fifo_filepath) as read_filepath:
+        assert read_filepath == lane_filepaths[0]
+    assert not os.path.exists(fifo_filepath)
+
+
+def test_lanes_concatenated_for_both_mates(tmpdir):
+    lanes = [write_lanes(tmpdir, mate, 3) for mate in [1, 2]]
+    fifo_filepaths = [str(tmpdir.join('combined.R{}.fastq'.format(mate))) for mate in [1, 2]]
+    # A stale pipe left by an earlier run is replaced
+    os.mkfifo(fifo_filepaths[0])
+    with fastq_tools.LaneStream(lanes[0][0], fifo_filepaths[0]) as read1, \
+            fastq_tools.LaneStream(lanes[1][0], fifo_filepaths[1]) as read2:
+        assert [read1, read2] == fifo_filepaths
+        combined = [subprocess.check_output(['cat', read1]), subprocess.check_output(['cat', read2])]
+    for (lane_filepaths, reads), mate_combined in zip(lanes, combined):
+        assert mate_combined == reads
+        assert mate_combined == subprocess.check_output(['zcat', '-f'] + lane_filepaths)
+    assert not [filepath for filepath in fifo_filepaths if os.path.exists(filepath)]
+
+
+def test_reader_that_never_opens_the_pipe(tmpdir):
+    lane_filepaths, _ = write_lanes(tmpdir, 1, 2)
+    fifo_filepath = str(tmpdir.join('combined.fastq'))
+    with pytest.raises(RuntimeError):
+        with fastq_tools.LaneStream(lane_filepaths, fifo_filepath):
+            raise RuntimeError('cutadapt failed before reading')
+    assert not os.path.exists(fifo_filepath)
+
+
+def test_missing_lane_raises(tmpdir):
+    lane_filepaths, _ = write_lanes(tmpdir, 1, 2)
+    fifo_filepath = str(tmpdir.join('combined.fastq'))
+    with pytest.raises(subprocess.CalledProcessError):
+        with fastq_tools.LaneStream(lane_filepaths + [str(tmpdir.join('missing.fastq.gz'))],
+                                    fifo_filepath) as read_filepath:
+            subprocess.check_output(['cat', read_filepath])
+    assert not os.path.exists(fifo_filepath)
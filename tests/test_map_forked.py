@@ -0,0 +1,69 @@
+"""
+Tests of map_forked, which runs atacseq's concurrent read pairs: results in the order
+of the items, closures run in processes of their own, at most the given number at
+once, and a failing item raising once the others are stopped.
+"""
+import os
+import time
+import subprocess
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+
+def test_results_in_item_order():
+    scale = 3
+
+    # A closure, which a multiprocessing.Pool couldn't pickle
+    def run_item(item):
+        time.sleep(0.05 * (5 - item))
+        return item * scale, os.getpid()
+
+    results = atacseq.map_forked(run_item, list(range(5)), 3)
+    assert [result for result, _ in results] == [0, 3, 6, 9, 12]
+    pids = [pid for _, pid in results]
+    assert len(set(pids)) == 5 and os.getpid() not in pids
+
+
+def test_processes_at_once_bounded(tmpdir):
+    running_dir = str(tmpdir.mkdir('running'))
+
+    def run_item(item):
+        marker = os.path.join(running_dir, str(item))
+        open(marker, 'w').close()
+        time.sleep(0.1)
+        running = len(os.listdir(running_dir))
+        os.remove(marker)
+        return running
+
+    assert max(atacseq.map_forked(run_item, list(range(6)), 2)) <= 2
+
+
+def test_failing_item_raises(tmpdir):
+    finished_dir = str(tmpdir.mkdir('finished'))
+
+    def run_item(item):
+        if item == 0:
+            raise RuntimeError('item failed')
+        time.sleep(5)
+        open(os.path.join(finished_dir, str(item)), 'w').close()
+
+    start = time.time()
+    with pytest.raises(subprocess.CalledProcessError):
+        atacseq.map_forked(run_item, list(range(4)), 2)
+    # The item still running is terminated, and the rest never start
+    assert time.time() - start < 4
+    time.sleep(0.2)
+    assert os.listdir(finished_dir) == []
@@ -0,0 +1,190 @@
+"""
+Tests of atacseq's Tn5 shifting of BED records against the per-record shift_reads it
+replaced, on records near both ends of each chromosome and with malformed strands: the
+same records are written and the same skipped records logged, followed by a summary.
+BAMs streamed straight into shifted BED are checked against bedtools bamtobed, or a
+stand-in for it if it isn't installed, followed by the per-record shift_reads.
+"""
+import os
+import random
+import subprocess
+import pytest
+
+pytest.importorskip('numpy')
+pysam = pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+GENOME_SIZES = [('chr1', 5000), ('chr2', 3000), ('chrM', 1000)]
+
+
+def per_record_shift_reads(input_bed_filepath, output_bed_filepath, log_filepath,
+                           minus_strand_shift, plus_strand_shift):
+    """The per-record shift_reads of atacseq before it was vectorized."""
+    genome_sizes = dict(GENOME_SIZES)
+    with open(input_bed_filepath) as input_bed, open(output_bed_filepath, 'w') as output_bed, \
+            open(log_filepath, 'a') as log_file:
+        for line in input_bed:
+            record = line.strip().split('\t')
+            chrom, start, end, strand = record[0], int(record[1]), int(record[2]), record[5]
+            if strand == '+':
+                new_start, new_end = start + plus_strand_shift, end + plus_strand_shift
+            elif strand == '-':
+                new_start, new_end = start + minus_strand_shift, end + minus_strand_shift
+            else:
+                log_file.write('Mal-formatted line in file, skipping:\n{}\n'.format(line.strip()))
+                continue
+            if not 1 <= new_start <= genome_sizes[chrom]:
+                log_file.write('Shift start site beyond chromosome boundry:\n{}\n'.format(line.strip()))
+                continue
+            if not 1 <= new_end <= genome_sizes[chrom]:
+                log_file.write('Shift end site beyond chromosome boundry:\n{}\n'.format(line.strip()))
+                continue
+            output_bed.write('\t'.join([chrom, str(new_start), str(new_end)] + record[3:]) + '\n')
+
+
+def write_records(bed_filepath, num_records, seed):
+    rng = random.Random(seed)
+    with open(bed_filepath, 'w') as bed:
+        for i in range(num_records):
+            chrom, size = rng.choice(GENOME_SIZES)
+            start = rng.choice([rng.randrange(0, 10), rng.randrange(size - 60, size), rng.randrange(size - 50)])
+            end = start + rng.randrange(1, 50)
+            strand = rng.choice(['+', '-', '+', '-', '.'])
+            bed.write('{}\t{}\t{}\tread{}/1\t{}\t{}\n'.format(chrom, start, end, i, rng.randrange(61), strand))
+
+
+@pytest.fixture
+def genome_sizes_filepath(tmpdir):
+    filepath = str(tmpdir.join('genome.sizes'))
+    with open(filepath, 'w') as genome_sizes:
+        genome_sizes.write(''.join(['{}\t{}\n'.format(chrom, size) for chrom, size in GENOME_SIZES]))
+    return filepath
+
+
+def read_file(filepath):
+    with open(filepath) as read_file:
+        return read_file.read()
+
+
+@pytest.mark.parametrize('chunk_size', [100, 1024 * 1024])
+def test_shift_reads_matches_per_record(tmpdir, genome_sizes_filepath, monkeypatch, chunk_size):
+    monkeypatch.setattr(atacseq, 'SHIFT_READS_CHUNK_SIZE', chunk_size)
+    input_bed_filepath = str(tmpdir.join('reads.bed'))
+    write_records(input_bed_filepath, 2000, seed=0)
+
+    expected_bed_filepath, expected_log_filepath = str(tmpdir.join('expected.bed')), str(tmpdir.join('expected.log'))
+    per_record_shift_reads(input_bed_filepath, expected_bed_filepath, expected_log_filepath,
+                           atacseq.MINUS_STRAND_SHIFT, atacseq.PLUS_STRAND_SHIFT)
+    bed_filepath, log_filepath = str(tmpdir.join('shifted.bed')), str(tmpdir.join('shifted.log'))
+    atacseq.Pipeline.shift_reads(input_bed_filepath, bed_filepath, genome_sizes_filepath, log_filepath,
+                                 atacseq.MINUS_STRAND_SHIFT, atacseq.PLUS_STRAND_SHIFT)
+
+    assert read_file(bed_filepath) == read_file(expected_bed_filepath)
+    expected_log = read_file(expected_log_filepath)
+    log, summary = read_file(log_filepath).split('Summary: ')
+    assert log == expected_log
+    assert summary.startswith('{} of 2000 records skipped'.format(expected_log.count('\n') // 2))
+
+
+def test_unknown_chromosome_raises(tmpdir, genome_sizes_filepath):
+    input_bed_filepath = str(tmpdir.join('reads.bed'))
+    with open(input_bed_filepath, 'w') as bed:
+        bed.write('chr1\t100\t150\tread0/1\t60\t+\nchr9\t100\t150\tread1/1\t60\t-\n')
+    with pytest.raises(KeyError):
+        atacseq.Pipeline.shift_reads(input_bed_filepath, str(tmpdir.join('shifted.bed')), genome_sizes_filepath,
+                                     str(tmpdir.join('shifted.log')), atacseq.MINUS_STRAND_SHIFT,
+                                     atacseq.PLUS_STRAND_SHIFT)
+
+
+def find_bedtools():
+    for path_dir in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path_dir, 'bedtools'), os.X_OK):
+            return os.path.join(path_dir, 'bedtools')
+    return None
+
+
+def write_bam(bam_filepath, num_pairs, seed):
+    """Read pairs with clipped, reverse, and unmapped mates, near both ends of each chromosome."""
+    rng = random.Random(seed)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': size} for chrom, size in GENOME_SIZES]}
+    reads = []
+    for i in range(num_pairs):
+        reference_id = rng.randrange(len(GENOME_SIZES))
+        size = GENOME_SIZES[reference_id][1]
+        template_length = rng.choice([50, 150, 200, 400])
+        start = rng.choice([rng.randrange(0, 10), rng.randrange(size - template_length - 10, size - template_length),
+                            rng.randrange(size - template_length)])
+        for mate in range(2):
+            read = pysam.AlignedSegment()
+            read.query_name = 'pair{}'.format(i)
+            read.query_sequence = 'A' * 36
+            read.flag = 0x1 | 0x2 | (0x40 | 0x20 if mate == 0 else 0x80 | 0x10)
+            read.reference_id = read.next_reference_id = reference_id
+            read.reference_start = start if mate == 0 else start + template_length - 30
+            read.next_reference_start = start + template_length - 30 if mate == 0 else start
+            read.cigarstring = rng.choice(['36M', '6S30M', '30M6S', '10M2D26M'])
+            read.mapping_quality = rng.randrange(61)
+            read.template_length = template_length if mate == 0 else -template_length
+            if rng.random() < 0.02:
+                read.flag |= 0x4
+            reads.append(read)
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    with pysam.AlignmentFile(bam_filepath, 'wb', header=header) as bam:
+        for read in reads:
+            bam.write(read)
+
+
+def bam_to_bed(bam_filepath, bed_filepath):
+    """bedtools bamtobed, or the records it writes for these reads if it isn't installed."""
+    bedtools_path = find_bedtools()
+    with open(bed_filepath, 'w') as bed:
+        if bedtools_path is not None:
+            subprocess.check_call([bedtools_path, 'bamtobed', '-i', bam_filepath], stdout=bed)
+            return
+        with pysam.AlignmentFile(bam_filepath, 'rb') as bam:
+            for read in bam.fetch(until_eof=True):
+                if not read.is_unmapped:
+                    bed.write('{}\t{}\t{}\t{}/{}\t{}\t{}\n'.format(
+                        read.reference_name, read.reference_start, read.reference_end, read.query_name,
+                        1 if read.is_read1 else 2, read.mapping_quality, '-' if read.is_reverse else '+'))
+
+
+def test_bam_to_shifted_bed_matches_bamtobed_and_shift(tmpdir, genome_sizes_filepath, monkeypatch):
+    monkeypatch.setattr(atacseq, 'BAM_TO_BED_CHUNK_SIZE', 300)
+    bam_filepath = str(tmpdir.join('reads.bam'))
+    write_bam(bam_filepath, 1000, seed=0)
+    unshifted_bed_filepath = str(tmpdir.join('unshifted.bed'))
+    bam_to_bed(bam_filepath, unshifted_bed_filepath)
+    expected_bed_filepath, expected_log_filepath = str(tmpdir.join('expected.bed')), str(tmpdir.join('expected.log'))
+    per_record_shift_reads(unshifted_bed_filepath, expected_bed_filepath, expected_log_filepath,
+                           atacseq.MINUS_STRAND_SHIFT, atacseq.PLUS_STRAND_SHIFT)
+
+    bed_filepath, log_filepath = str(tmpdir.join('shifted.bed')), str(tmpdir.join('shifted.log'))
+    class_bed_filepaths = [str(tmpdir.join('shifted.{}.bed'.format(name))) for name, _, _ in atacseq.FRAGMENT_CLASSES]
+    atacseq.Pipeline.bam_to_shifted_bed(bam_filepath, bed_filepath, atacseq.Pipeline.load_genome_sizes(
+        genome_sizes_filepath), log_filepath, atacseq.MINUS_STRAND_SHIFT, atacseq.PLUS_STRAND_SHIFT,
+        class_bed_filepaths)
+
+    expected_bed = read_file(expected_bed_filepath)
+    assert read_file(bed_filepath) == expected_bed
+    assert read_file(log_filepath).split('Summary: ')[0] == read_file(expected_log_filepath)
+
+    # Each record of a read in a fragment class is also in that class's BED
+    with pysam.AlignmentFile(bam_filepath, 'rb') as bam:
+        classes = dict(('{}/{}'.format(read.query_name, 1 if read.is_read1 else 2),
+                        atacseq.fragment_class(read.template_length)) for read in bam.fetch(until_eof=True))
+    for class_index, class_bed_filepath in enumerate(class_bed_filepaths):
+        assert read_file(class_bed_filepath) == ''.join([
+            line + '\n' for line in expected_bed.splitlines() if classes[line.split('\t')[3]] == class_index
+        ])
@@ -0,0 +1,90 @@
+"""
+Tests of subsample_reads, which picks the read pairs a preview runs on: the same pairs
+kept from both mates of every lane, whichever header style names them, about the
+fraction asked for, the same in a pool of processes, and the counts it measures.
+"""
+import os
+import sys
+import gzip
+import random
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import fastq_tools
+
+
+def write_mates(tmpdir, lane, num_pairs, header_style, seed):
+    """Both mates of a lane, read 1 gzipped and read 2 not. Returns their paths and their records."""
+    rng = random.Random(seed)
+    mate_records = [[], []]
+    for i in range(num_pairs):
+        name = 'INST:1:FC:{}:{}:{}'.format(lane, rng.randrange(10000), i)
+        for mate in range(2):
+            if header_style == 'suffix':
+                header = '@{}/{}'.format(name, mate + 1)
+            else:
+                header = '@{} {}:N:0:ACGT'.format(name, mate + 1)
+            sequence = ''.join([rng.choice('ACGT') for _ in range(rng.randrange(20, 40))])
+            mate_records[mate].append('{}\n{}\n+\n{}\n'.format(header, sequence, 'I' * len(sequence)))
+    filepaths = [str(tmpdir.join('L00{}_R1.fastq.gz'.format(lane))), str(tmpdir.join('L00{}_R2.fastq'.format(lane)))]
+    with gzip.open(filepaths[0], 'wt') as read1:
+        read1.write(''.join(mate_records[0]))
+    with open(filepaths[1], 'w') as read2:
+        read2.write(''.join(mate_records[1]))
+    return filepaths, mate_records
+
+
+def read_records(filepath):
+    fastq = gzip.open(filepath, 'rt') if filepath.endswith('.gz') else open(filepath)
+    with fastq:
+        lines = fastq.readlines()
+    return [''.join(lines[record:record + 4]) for record in range(0, len(lines), 4)]
+
+
+def pair_name(record):
+    name = record.split(None, 1)[0]
+    return name[:-2] if name[-2:] in ['/1', '/2'] else name
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_mates_kept_together_across_lanes(tmpdir, monkeypatch, processes):
+    monkeypatch.setattr(fastq_tools, 'PREVIEW_BATCH_SIZE', 700)
+    lanes = [write_mates(tmpdir, lane, 3000, header_style, seed=lane)
+             for lane, header_style in enumerate(['suffix', 'casava', 'suffix'])]
+    output_dir = str(tmpdir.mkdir('preview'))
+    fraction = 0.2
+    previewed_reads, read_counts = fastq_tools.subsample_reads([':'.join(filepaths) for filepaths, _ in lanes],
+                                                               output_dir, fraction, processes)
+
+    assert len(previewed_reads) == len(lanes)
+    for (filepaths, mate_records), previewed_read, counts in zip(lanes, previewed_reads, read_counts):
+        previewed_mates = previewed_read.split(':')
+        assert [os.path.dirname(filepath) for filepath in previewed_mates] == [output_dir] * 2
+        assert [filepath.endswith('.gz') for filepath in previewed_mates] == [True, False]
+        kept = [read_records(filepath) for filepath in previewed_mates]
+
+        # Both mates keep the same pairs, in order, as whole records of the originals
+        assert [pair_name(record) for record in kept[0]] == [pair_name(record) for record in kept[1]]
+        for mate in range(2):
+            assert set(kept[mate]) <= set(mate_records[mate])
+            assert kept[mate] == [record for record in mate_records[mate] if record in set(kept[mate])]
+        assert abs(len(kept[0]) - fraction * len(mate_records[0])) < 0.05 * len(mate_records[0])
+
+        assert counts == [(len(records), sum([len(record.split('\n')[1]) for record in records]), len(kept[0]))
+                          for records in mate_records]
+
+
+def test_pool_matches_serial(tmpdir):
+    filepaths, _ = write_mates(tmpdir, 1, 2000, 'suffix', seed=0)
+    previews = []
+    for processes in [1, 2]:
+        output_dir = str(tmpdir.mkdir('preview{}'.format(processes)))
+        previewed_reads, read_counts = fastq_tools.subsample_reads([':'.join(filepaths)], output_dir, 0.5, processes)
+        previews.append(([read_records(filepath) for filepath in previewed_reads[0].split(':')], read_counts))
+    assert previews[0] == previews[1]
+
+
+def test_whole_preview_keeps_every_read(tmpdir):
+    filepaths, mate_records = write_mates(tmpdir, 1, 500, 'casava', seed=0)
+    previewed_reads, _ = fastq_tools.subsample_reads(filepaths, str(tmpdir.mkdir('preview')), 1.0, 1)
+    assert [read_records(filepath) for filepath in previewed_reads] == mate_records
@@ -0,0 +1,180 @@
+"""
+Tests of the built-in trimmer: quality trimming and adapter positions on cases worked
+by hand, its report as read_cutadapt_report reads it, and, if cutadapt is installed,
+trimmed reads and counts the same as cutadapt's, paired or not, across lanes and batches.
+"""
+import os
+import sys
+import gzip
+import random
+import subprocess
+import pytest
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
+
+np = pytest.importorskip('numpy')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import fastq_tools
+
+ADAPTERS = ['AGATCGGAAGAGCACACGTCTGAACTCCAGTCA', 'AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT']
+
+
+def mutated(sequence, rng, rate):
+    """sequence with about rate substitutions, insertions and deletions per base."""
+    bases = []
+    for base in sequence:
+        edit = rng.random()
+        if edit < rate / 3:
+            bases.append(rng.choice('ACGT'))
+        elif edit < 2 * rate / 3:
+            bases.extend([base, rng.choice('ACGT')])
+        elif edit >= rate:
+            bases.append(base)
+    return ''.join(bases)
+
+
+def write_lanes(tmpdir, num_reads, num_mates, seed):
+    """
+    Two lanes of each mate, the first gzipped, of reads of varied lengths, many reading into
+    the adapters, with errors, some with low quality tails or Ns. Returns their paths by mate.
+    """
+    rng = random.Random(seed)
+    mate_records = [[] for _ in range(num_mates)]
+    for i in range(num_reads):
+        insert = ''.join([rng.choice('ACGTN' if rng.random() < 0.05 else 'ACGT') for _ in range(rng.randrange(150))])
+        for mate in range(num_mates):
+            adapter = mutated(ADAPTERS[mate], rng, rng.choice([0, 0.05, 0.1, 0.2]))
+            sequence = (insert + adapter + 'ACGT' * 40)[:rng.choice([36, 75, 151])]
+            qualities = [38] * len(sequence)
+            if rng.random() < 0.3:
+                tail = rng.randrange(len(sequence) + 1)
+                qualities[len(qualities) - tail:] = [rng.randrange(2, 35) for _ in range(tail)]
+            quality = ''.join([chr(33 + q) for q in qualities])
+            mate_records[mate].append('@read{}/{}\n{}\n+\n{}\n'.format(i, mate + 1, sequence, quality))
+
+    mate_lane_filepaths = []
+    for mate, records in enumerate(mate_records):
+        lane_filepaths = [str(tmpdir.join('L001_R{}.fastq.gz'.format(mate + 1))),
+                          str(tmpdir.join('L002_R{}.fastq'.format(mate + 1)))]
+        with gzip.open(lane_filepaths[0], 'wt') as lane:
+            lane.write(''.join(records[:num_reads // 3]))
+        with open(lane_filepaths[1], 'w') as lane:
+            lane.write(''.join(records[num_reads // 3:]))
+        mate_lane_filepaths.append(lane_filepaths)
+    return mate_lane_filepaths
+
+
+def read_fastq(filepath):
+    with (gzip.open(filepath, 'rb') if filepath.endswith('.gz') else open(filepath, 'rb')) as fastq:
+        return fastq.read()
+
+
+def fastq_buffer(sequences, qualities):
+    """Records of sequences and qualities as an array of their bytes, and where their lines start and end."""
+    data = np.frombuffer(b''.join([b'@read\n' + sequence + b'\n+\n' + quality + b'\n'
+                                   for sequence, quality in zip(sequences, qualities)]), dtype=np.uint8)
+    return (data,) + fastq_tools.fastq_buffer_lines(data)
+
+
+def test_quality_trimming():
+    # From the 3' end, 30 - quality sums to 18, 16, 24, 22, 28, then falls until negative
+    qualities = [b''.join([chr(33 + q).encode() for q in read_qualities])
+                 for read_qualities in [[38, 38, 38, 38, 38, 38, 38, 38, 24, 32, 22, 32, 12], [38, 38, 30],
+                                        [38, 38, 31], [10, 10, 10], []]]
+    data, line_starts, line_ends = fastq_buffer([b'N' * len(quality) for quality in qualities], qualities)
+    trimmed_lengths = fastq_tools.quality_trimmed_lengths(data, line_starts[3::4], line_ends[3::4] - line_starts[3::4],
+                                                          30, 33)
+    assert trimmed_lengths.tolist() == [8, 3, 3, 0, 0]
+
+
+@pytest.mark.parametrize('sequence, adapter_start', [
+    # The whole adapter, exactly and with one error, and what follows it
+    ('ACGTTGCAAGATCGGAAGAGCACAGGGG', 8),
+    ('ACGTTGCAAGATCGGTAGAGCACAGGGG', 8),
+    ('ACGTTGCAAGATCGGAGAGCACAGGGG', 8),
+    # A prefix at the 3' end, down to three bases, but no fewer
+    ('ACGTTGCAAGATCGG', 8),
+    ('ACGTTGCAAGA', 8),
+    ('ACGTTGCAAG', 10),
+    # Too many errors
+    ('ACGTTGCAAGTTCGGTAGTGCACAGGGG', 28),
+])
+def test_adapter_positions(sequence, adapter_start):
+    adapter = fastq_tools.trimmer_adapter('agatcggaagagcaca')
+    data, line_starts, line_ends = fastq_buffer([sequence.encode(), b''], [b'I' * len(sequence), b''])
+    trimmed_lengths = fastq_tools.adapter_trimmed_lengths(data, line_starts[1::4], line_ends[1::4] - line_starts[1::4],
+                                                          adapter)
+    assert trimmed_lengths.tolist() == [adapter_start, 0]
+
+
+@pytest.mark.parametrize('adapter', ['AGATCGGNAGAGC', 'A' * 65])
+def test_adapters_it_cannot_align(adapter):
+    with pytest.raises(ValueError):
+        fastq_tools.trimmer_adapter(adapter)
+
+
+def test_report(tmpdir):
+    mate_lane_filepaths = write_lanes(tmpdir, 1000, 2, seed=0)
+    output_filepaths = [str(tmpdir.join('trimmed_1.fastq')), str(tmpdir.join('trimmed_2.fastq'))]
+    summary_filepath = str(tmpdir.join('trimming.summary'))
+    num_reads, num_written = fastq_tools.trim_reads(mate_lane_filepaths, output_filepaths, ADAPTERS, 30, 33, 20,
+                                                    1, None, summary_filepath)
+    raw_bases = [sum([len(line) - 1 for line in subprocess.check_output(['zcat', '-f'] + lane_filepaths)
+                      .splitlines(True)[1::4]])
+                 for lane_filepaths in mate_lane_filepaths]
+    trimmed_reads = [read_fastq(filepath).count(b'\n') // 4 for filepath in output_filepaths]
+    assert num_reads == 1000 and trimmed_reads == [num_written] * 2 and num_written < num_reads
+    expected = {'reads_processed': 1000, 'reads_written': num_written, 'bases_processed': raw_bases}
+    assert fastq_tools.read_cutadapt_report(summary_filepath) == expected
+    os.remove(summary_filepath + fastq_tools.CUTADAPT_JSON_SUFFIX)
+    assert fastq_tools.read_cutadapt_report(summary_filepath) == expected
+
+
+def test_mates_of_different_lengths(tmpdir):
+    mate_lane_filepaths = write_lanes(tmpdir, 100, 2, seed=0)
+    with open(mate_lane_filepaths[1][1], 'a') as lane:
+        lane.write('@extra/2\nACGT\n+\nIIII\n')
+    with pytest.raises(ValueError):
+        fastq_tools.trim_reads(mate_lane_filepaths, [str(tmpdir.join('trimmed_1.fastq')),
+                                                     str(tmpdir.join('trimmed_2.fastq'))],
+                               ADAPTERS, 30, 33, 5, 1, None, str(tmpdir.join('trimming.summary')))
+
+
+@pytest.mark.skipif(find_executable('cutadapt') is None, reason='cutadapt is not installed')
+@pytest.mark.parametrize('num_mates, processes, compression_level', [(2, 1, None), (2, 2, 6), (1, 2, 1)])
+def test_matches_cutadapt(tmpdir, monkeypatch, num_mates, processes, compression_level):
+    monkeypatch.setattr(fastq_tools, 'TRIMMER_BATCH_SIZE', 1500)
+    monkeypatch.setattr(fastq_tools, 'TRIMMER_ALIGNMENT_GROUP_SIZE', 700)
+    mate_lane_filepaths = write_lanes(tmpdir, 5000, num_mates, seed=num_mates)
+    suffix = '.fastq.gz' if compression_level else '.fastq'
+    outputs = {}
+    for trimmer in fastq_tools.TRIMMERS:
+        output_filepaths = [str(tmpdir.join('{}_{}{}'.format(trimmer, mate + 1, suffix)))
+                            for mate in range(num_mates)]
+        summary_filepath = str(tmpdir.join('{}.summary'.format(trimmer)))
+        if trimmer == 'builtin':
+            fastq_tools.trim_reads(mate_lane_filepaths, output_filepaths, ADAPTERS[:num_mates], 30, 33, 20,
+                                   processes, compression_level, summary_filepath)
+        else:
+            combined_filepaths = []
+            for mate, lane_filepaths in enumerate(mate_lane_filepaths):
+                combined_filepaths.append(str(tmpdir.join('combined_{}.fastq'.format(mate + 1))))
+                with open(combined_filepaths[-1], 'wb') as combined:
+                    subprocess.check_call(['zcat', '-f'] + lane_filepaths, stdout=combined)
+            output_args = ['--output={}'.format(output_filepaths[0])]
+            adapter_args = ['-a', ADAPTERS[0]]
+            if num_mates == 2:
+                output_args.append('--paired-output={}'.format(output_filepaths[1]))
+                adapter_args.extend(['-A', ADAPTERS[1]])
+            with open(summary_filepath, 'w') as summary:
+                subprocess.check_call(['cutadapt', '--quality-base=33', '--minimum-length=20', '-q', '30'] +
+                                      output_args + adapter_args +
+                                      fastq_tools.cutadapt_report_args(summary_filepath, True) + combined_filepaths,
+                                      stdout=summary)
+        outputs[trimmer] = ([read_fastq(filepath) for filepath in output_filepaths],
+                            fastq_tools.read_cutadapt_report(summary_filepath))
+
+    assert outputs['builtin'] == outputs['cutadapt']
+    assert outputs['builtin'][1]['reads_written'] < 5000
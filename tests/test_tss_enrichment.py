@@ -0,0 +1,134 @@
+"""
+Tests of atacseq's TSS enrichment on a synthetic BAM: the TSS read from a BED and a
+gzipped GTF, the aggregate cut-site profile against a direct count around every TSS,
+and the enrichment score of a profile with known flanks and summit.
+"""
+import os
+import gzip
+import random
+import pytest
+
+np = pytest.importorskip('numpy')
+pysam = pytest.importorskip('pysam')
+pytest.importorskip('chunkypipes')
+try:
+    from importlib.machinery import SourceFileLoader
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, pathname):
+        return SourceFileLoader(name, pathname).load_module()
+
+atacseq = load_source('atacseq', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                              'atacseq.py'))
+
+GENOME_SIZES = {'chr1': 50000, 'chr2': 20000}
+# Transcripts as (chrom, start, end, strand), one of them on a chromosome without reads
+TRANSCRIPTS = [('chr1', 5000, 9000, '+'), ('chr1', 5000, 6000, '+'), ('chr1', 20000, 30000, '-'),
+               ('chr1', 49000, 49990, '+'), ('chr2', 1000, 3000, '-'), ('chrX', 100, 900, '+')]
+
+
+def write_bam(bam_filepath, num_pairs, seed):
+    """Read pairs, a third of them starting near a TSS and the rest anywhere in the genome."""
+    rng = random.Random(seed)
+    chroms = sorted(GENOME_SIZES)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': GENOME_SIZES[chrom]} for chrom in chroms]}
+    reads = []
+    for i in range(num_pairs):
+        template_length = rng.choice([60, 180, 250])
+        if rng.random() < 0.3:
+            chrom, start, end, strand = rng.choice(TRANSCRIPTS[:-1])
+            start = (end - 1 if strand == '-' else start) + rng.randrange(-300, 300)
+        else:
+            chrom = rng.choice(chroms)
+            start = rng.randrange(GENOME_SIZES[chrom])
+        start = max(min(start, GENOME_SIZES[chrom] - template_length), 0)
+        for mate in range(2):
+            read = pysam.AlignedSegment()
+            read.query_name = 'pair{}'.format(i)
+            read.query_sequence = 'A' * 36
+            read.flag = 0x1 | 0x2 | (0x40 | 0x20 if mate == 0 else 0x80 | 0x10)
+            read.reference_id = read.next_reference_id = chroms.index(chrom)
+            read.reference_start = start if mate == 0 else start + template_length - 36
+            read.next_reference_start = start + template_length - 36 if mate == 0 else start
+            read.cigarstring = '36M'
+            read.mapping_quality = 60
+            read.template_length = template_length if mate == 0 else -template_length
+            reads.append(read)
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    with pysam.AlignmentFile(bam_filepath, 'wb', header=header) as bam:
+        for read in reads:
+            bam.write(read)
+
+
+@pytest.fixture
+def tss_filepaths(tmpdir):
+    bed_filepath = str(tmpdir.join('tss.bed'))
+    with open(bed_filepath, 'w') as bed:
+        bed.write('track name=transcripts\n')
+        for chrom, start, end, strand in TRANSCRIPTS:
+            bed.write('{}\t{}\t{}\ttx\t0\t{}\n'.format(chrom, start, end, strand))
+    gtf_filepath = str(tmpdir.join('genes.gtf.gz'))
+    with gzip.open(gtf_filepath, 'wt') as gtf:
+        gtf.write('#!genome-build test\n')
+        for chrom, start, end, strand in TRANSCRIPTS:
+            for feature in ['gene', 'transcript', 'exon']:
+                gtf.write('{}\ttest\t{}\t{}\t{}\t.\t{}\t.\tgene_id "g";\n'.format(
+                    chrom, feature, start + 1, end if feature != 'exon' else start + 100, strand))
+    return bed_filepath, gtf_filepath
+
+
+def test_tss_from_bed_and_gtf(tss_filepaths):
+    expected = {'chr1': ([5000, 29999, 49000], [False, True, False]), 'chr2': ([2999], [True]),
+                'chrX': ([100], [False])}
+    for tss_filepath in tss_filepaths:
+        tss = atacseq.Pipeline.load_tss(tss_filepath)
+        assert dict((chrom, (positions.tolist(), is_minus.tolist()))
+                    for chrom, (positions, is_minus) in tss.items()) == expected
+
+
+def test_profile_matches_cut_sites_around_tss(tmpdir, tss_filepaths):
+    bam_filepath = str(tmpdir.join('reads.bam'))
+    write_bam(bam_filepath, 3000, seed=0)
+    bed_filepath = str(tmpdir.join('reads.processed.bed'))
+    atacseq.Pipeline.bam_to_shifted_bed(bam_filepath, bed_filepath, GENOME_SIZES, str(tmpdir.join('shift.log')),
+                                        atacseq.MINUS_STRAND_SHIFT, atacseq.PLUS_STRAND_SHIFT)
+    cut_sites = atacseq.Pipeline.load_cut_sites(bed_filepath)
+    tss = atacseq.Pipeline.load_tss(tss_filepaths[0])
+
+    expected = np.zeros(2 * atacseq.TSS_WINDOW + 1, dtype=np.int64)
+    for chrom, (positions, is_minus) in tss.items():
+        for position, tss_is_minus in zip(positions.tolist(), is_minus.tolist()):
+            for cut_site in cut_sites.get(chrom, np.zeros(0, dtype=np.int64)).tolist():
+                offset = (position - cut_site) if tss_is_minus else (cut_site - position)
+                if abs(offset) <= atacseq.TSS_WINDOW:
+                    expected[offset + atacseq.TSS_WINDOW] += 1
+    profile = atacseq.Pipeline.tss_profile(cut_sites, tss)
+    assert expected.sum() > 0
+    assert profile.tolist() == expected.tolist()
+
+    enrichment = atacseq.Pipeline.write_tss_enrichment(profile, str(tmpdir.join('tss_profile.txt')))
+    assert enrichment > 1
+
+
+def test_enrichment_of_known_profile(tmpdir):
+    # Flanks of 2 cut sites per base and a block of 10 per base around the TSS
+    profile = np.full(2 * atacseq.TSS_WINDOW + 1, 2, dtype=np.int64)
+    summit = slice(atacseq.TSS_WINDOW - 100, atacseq.TSS_WINDOW + 101)
+    profile[summit] = 10
+    profile_filepath = str(tmpdir.join('tss_profile.txt'))
+    assert atacseq.Pipeline.write_tss_enrichment(profile, profile_filepath) == pytest.approx(5.0)
+
+    with open(profile_filepath) as profile_file:
+        lines = [line.rstrip('\n').split('\t') for line in profile_file]
+    assert lines[0] == ['offset', 'cut_sites', 'normalized', 'smoothed']
+    assert [int(line[0]) for line in lines[1:]] == list(range(-atacseq.TSS_WINDOW, atacseq.TSS_WINDOW + 1))
+    assert [int(line[1]) for line in lines[1:]] == profile.tolist()
+    assert float(lines[1 + atacseq.TSS_WINDOW][2]) == pytest.approx(5.0)
+
+
+def test_empty_flanks_score_zero(tmpdir):
+    profile = np.zeros(2 * atacseq.TSS_WINDOW + 1, dtype=np.int64)
+    profile[atacseq.TSS_WINDOW] = 7
+    assert atacseq.Pipeline.write_tss_enrichment(profile, str(tmpdir.join('tss_profile.txt'))) == 0.0
@@ -1,7 +1,12 @@
 import os
+import sys
 import subprocess
 from datetime import datetime
 from chunkypipes.components import Software, Parameter, Redirect, BasePipeline
+# Shared FASTQ helpers, installed next to the pipelines
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fastq_tools import (LaneStream, TRIMMED_OUTPUT_MODES, TRIMMERS, cutadapt_trimming_args, preview_fraction,
+                         subsample_reads, trim_reads, trimmed_compression_level, trimmed_fastq_filepath)
 
 FIRST_READS_PAIR = 0
 
@@ -42,6 +47,19 @@ class Pipeline(BasePipeline):
         parser.add_argument('--reverse-adapter', default='ZZZ',
                             help='Adapter sequnce for the reverse strand.')
         parser.add_argument('--sailfish-libtype')  # TODO Find out what the choices are
+        parser.add_argument('--trim-cores', default=1, type=int,
+                            help='Number of cores cutadapt trims on, if its version supports it.')
+        parser.add_argument('--trimmed-output', default='gzip', choices=TRIMMED_OUTPUT_MODES,
+                            help=('How trimmed reads are written: gzipped at the default level (gzip, '
+                                  'the default), gzipped at level 1 (fast), or uncompressed (plain), '
+                                  'which is fastest and largest.'))
+        parser.add_argument('--trimmer', default='cutadapt', choices=TRIMMERS,
+                            help=('Trim reads with cutadapt, or with the built-in trimmer, which trims '
+                                  'them the same way in batches on --trim-cores processes, whatever '
+                                  'the cutadapt version. It needs numpy.'))
+        parser.add_argument('--preview', default=None, type=preview_fraction, metavar='FRACTION',
+                            help=('Run on this fraction of read pairs, picked by a hash of their '
+                                  'names so mates stay together across files and lanes.'))
         return parser
 
     def run_pipeline(self, pipeline_args, pipeline_config):
@@ -52,6 +70,10 @@ class Pipeline(BasePipeline):
         forward_adapter = pipeline_args['forward_adapter']
         reverse_adapter = pipeline_args['reverse_adapter']
         sailfish_libtype = pipeline_args['sailfish_libtype']
+        trim_cores = pipeline_args['trim_cores']
+        trimmed_output = pipeline_args['trimmed_output']
+        trimmer = pipeline_args['trimmer']
+        preview = pipeline_args['preview']
 
         # Determine if run is paired-end from input
         run_is_paired_end = len(reads[FIRST_READS_PAIR].split(':')) > 1
@@ -67,7 +89,12 @@ class Pipeline(BasePipeline):
         kallisto = Software('kallisto', pipeline_config['kallisto']['path'])
         sailfish = Software('sailfish', pipeline_config['sailfish']['path'])
 
-        # Combine reads with extra sequencing depth
+        # Preview: Run on the read pairs a hash of their names picks, subsampled into tmp
+        if preview is not None:
+            reads = subsample_reads(reads, tmp_dir, preview, trim_cores)[0]
+
+        # Stream reads with extra sequencing depth to cutadapt as one, rather than combining
+        # them on disk
         if run_is_paired_end:
             # Aggregate read1s and read2s
             read1s, read2s = [], []
@@ -75,40 +102,31 @@ class Pipeline(BasePipeline):
                 read1, read2 = read.split(':')
                 read1s.append(read1)
                 read2s.append(read2)
+            raw_read_groups = [read1s, read2s]
 
-            # Combine reads groups
-            combined_reads = []
-            for name, reads_group in [('read1', read1s), ('read2', read2s)]:
-                combined_read_filename = os.path.join(output_dir, '{}.combined.{}.fastq.gz'.format(lib_prefix, name))
-                combined_reads.append(combined_read_filename)
-                staging_delete.append(combined_read_filename)
-                with open(combined_read_filename, 'w') as combined_reads_fastq:
-                    subprocess.call(['cat'] + [read for read in reads_group], stdout=combined_reads_fastq)
-
-            # Update reads list
-            reads = ':'.join(combined_reads)
+            lane_streams = [
+                LaneStream(reads_group, os.path.join(tmp_dir, '{}.combined.{}.fastq'.format(lib_prefix, name)))
+                for name, reads_group in [('read1', read1s), ('read2', read2s)]
+            ]
         else:
-            # Combine reads
-            combined_read_filename = os.path.join(output_dir, '{}.combined.fastq.gz'.format(lib_prefix))
-            staging_delete.append(combined_read_filename)
-            with open(combined_read_filename, 'w') as combined_reads_fastq:
-                subprocess.call(['cat'] + [read for read in reads], stdout=combined_reads_fastq)
-
-            # Update reads list
-            reads = combined_read_filename
+            raw_read_groups = [reads]
+            lane_streams = [LaneStream(reads, os.path.join(tmp_dir, '{}.combined.fastq'.format(lib_prefix)))]
 
         cutadapt_common = [
             Parameter('--quality-base={}'.format(pipeline_config['cutadapt']['quality-base'])),
             Parameter('--minimum-length={}'.format(pipeline_config['cutadapt']['minimum-length'])),
             Parameter('-q', '30'),
+            Parameter(*cutadapt_trimming_args(pipeline_config['cutadapt']['path'], trim_cores, trimmed_output)),
             Redirect(stream=Redirect.STDOUT, dest=os.path.join(logs_dir, 'cutadapt.summary'))
         ]
 
         if run_is_paired_end:
-            read1, read2 = reads.split(':')
-            trimmed_read1_filename = os.path.join(output_dir, lib_prefix + '_read1.trimmed.fastq.gz')
-            trimmed_read2_filename = os.path.join(output_dir, lib_prefix + '_read2.trimmed.fastq.gz')
+            trimmed_read1_filename = trimmed_fastq_filepath(os.path.join(output_dir, lib_prefix + '_read1.trimmed'),
+                                                            trimmed_output)
+            trimmed_read2_filename = trimmed_fastq_filepath(os.path.join(output_dir, lib_prefix + '_read2.trimmed'),
+                                                            trimmed_output)
 
+            trimmed_filenames = [trimmed_read1_filename, trimmed_read2_filename]
             staging_delete.append(trimmed_read1_filename)
             staging_delete.append(trimmed_read2_filename)
 
@@ -116,30 +134,39 @@ class Pipeline(BasePipeline):
                 Parameter('--output={}'.format(trimmed_read1_filename)),
                 Parameter('--paired-output={}'.format(trimmed_read2_filename)),
                 Parameter('-a', forward_adapter),
-                Parameter('-A', reverse_adapter),
-                Parameter(read1),
-                Parameter(read2)
+                Parameter('-A', reverse_adapter)
             ]
 
             # Update reads list
             reads = ':'.join([trimmed_read1_filename, trimmed_read2_filename])
         else:
             # Construct new filename
-            trimmed_read_filename = os.path.join(output_dir, lib_prefix + '.trimmed.fastq.gz')
+            trimmed_read_filename = trimmed_fastq_filepath(os.path.join(output_dir, lib_prefix + '.trimmed'),
+                                                           trimmed_output)
 
+            trimmed_filenames = [trimmed_read_filename]
             staging_delete.append(trimmed_read_filename)
 
             cutadapt_specific = [
                 Parameter('--output={}'.format(trimmed_read_filename)),
-                Parameter('-a', forward_adapter),
-                Parameter(reads)
+                Parameter('-a', forward_adapter)
             ]
 
             # Update reads list
             reads = [trimmed_read_filename]
 
-        # Run cutadapt
-        cutadapt.run(*(cutadapt_common + cutadapt_specific))
+        # Run cutadapt, or the built-in trimmer, which reads the lanes themselves, one after another
+        if trimmer == 'builtin':
+            trim_reads(raw_read_groups, trimmed_filenames, [forward_adapter, reverse_adapter][:len(raw_read_groups)],
+                       30, int(pipeline_config['cutadapt']['quality-base']),
+                       int(pipeline_config['cutadapt']['minimum-length']), trim_cores,
+                       trimmed_compression_level(trimmed_output), os.path.join(logs_dir, 'cutadapt.summary'))
+        elif run_is_paired_end:
+            with lane_streams[0] as read1, lane_streams[1] as read2:
+                cutadapt.run(*(cutadapt_common + cutadapt_specific + [Parameter(read1, read2)]))
+        else:
+            with lane_streams[0] as read:
+                cutadapt.run(*(cutadapt_common + cutadapt_specific + [Parameter(read)]))
 
         # Step 3: Kallisto Quantification
         kallisto_common = [
@@ -168,15 +195,16 @@ class Pipeline(BasePipeline):
             Parameter('--output', os.path.join(output_dir, 'sailfish_quant'))
         ]
 
+        # zcat -f passes trimmed reads written uncompressed through as is
         if run_is_paired_end:
             read1, read2 = reads.split(':')
             sailfish_ended = [
-                Parameter('-1', '<(zcat {})'.format(read1)),
-                Parameter('-2', '<(zcat {})'.format(read2)),
+                Parameter('-1', '<(zcat -f {})'.format(read1)),
+                Parameter('-2', '<(zcat -f {})'.format(read2)),
             ]
         else:
             sailfish_ended = [
-                Parameter('-r', '<(zcat {})'.format(reads))
+                Parameter('-r', '<(zcat -f {})'.format(reads))
             ]
 
         sailfish.run(*(sailfish_common + sailfish_ended), shell=True)